@@ -26,7 +26,7 @@ freely, subject to the following restrictions:
 
 from argparse import ArgumentParser
 
-from http.server import BaseHTTPRequestHandler, HTTPServer, HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer, HTTPStatus
 from urllib.parse import urlparse
 from urllib.parse import urljoin
 from urllib.parse import quote_plus as urlquote
@@ -36,6 +36,12 @@ import os
 import os.path as p
 import sys
 import json # for json.dumps()
+import threading
+import hashlib
+import email.utils
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import partial
 
 from typing import Optional
 
@@ -44,6 +50,7 @@ import xml.etree.ElementTree as ETree
 #from xml.sax.saxutils import escape as xmlescape
 import re
 import gzip
+import zlib
 
 
 
@@ -55,21 +62,242 @@ def path_is_readable(path):
 def dquotes(s):
     return json.dumps(s)
 
+def file_stamp(path) -> Optional[tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def tree_stamp(path) -> Optional[tuple[int, int]]:
+    '''
+    Stamp of a folder and everything in it at any depth, which changes when a
+    file is added, removed or edited anywhere under it. It's the newest mtime
+    and a hash of the stamps of every file and folder.
+    '''
+    entries = []
+    for folder, _, files in os.walk(path):
+        for entry_path in [folder] + [p.join(folder, name) for name in files]:
+            stamp = file_stamp(entry_path)
+            if stamp is not None:
+                entries.append((entry_path, stamp))
+    if not entries:
+        return None
+    return (max(stamp[0] for _, stamp in entries), hash(tuple(entries)))
+
+
+# default total size of the cached responses, in bytes
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+# content encodings the server can compress with, in order of preference
+CONTENT_ENCODINGS = ('gzip', 'deflate')
+
+# content types that are worth compressing, meshes are already compressed
+COMPRESSIBLE_TYPES = ('text/xml', 'text/plain')
+
+# bodies smaller than this are sent as they are, since compressing them
+# barely changes how many packets they take
+COMPRESS_MIN_SIZE = 1024
+
+COMPRESS_LEVEL = 6
+
+# seconds an idle keep-alive connection is kept open for
+KEEP_ALIVE_TIMEOUT = 10
+
+
+def encode_content(content : bytes, encoding : str) -> bytes:
+    if encoding == 'gzip':
+        # no timestamp, so the same body always has the same ETag
+        return gzip.compress(content, compresslevel=COMPRESS_LEVEL, mtime=0)
+    elif encoding == 'deflate':
+        return zlib.compress(content, COMPRESS_LEVEL)
+    raise ValueError(f'Unknown content encoding {encoding}')
+
+
+def stamp_mtime(stamp : tuple) -> Optional[float]:
+    '''
+    Get the newest modification time in a stamp, which holds file stamps and
+    plain mtimes
+    '''
+    mtimes = []
+    for item in stamp:
+        if isinstance(item, tuple):
+            mtimes.append(item[0] / 1e9)
+        elif item:
+            mtimes.append(item)
+    return max(mtimes, default=None)
+
+
+class CachedResponse:
+    def __init__(self, key : tuple, stamp : tuple, content : bytes):
+        self.key : tuple = key
+        self.stamp : tuple = stamp
+        self.content : bytes = content
+        self.size : int = len(content)
+        self.mtime : Optional[float] = stamp_mtime(stamp)
+        # compressed copies of the content, None if compressing didn't help
+        self.encoded : dict[str, Optional[bytes]] = {}
+        # held while a compressed copy is made, so it's only made once
+        self.encode_lock = threading.Lock()
+        self._etag : Optional[str] = None
+
+    @property
+    def etag(self) -> str:
+        # hashed on first use, so cached responses are only hashed once
+        if self._etag is None:
+            self._etag = content_etag(self.content)
+        return self._etag
+
+
+def content_etag(content : bytes) -> str:
+    return '"' + hashlib.sha256(content).hexdigest()[:32] + '"'
+
+
+class ResponseCache:
+    '''
+    Least recently used cache of generated responses, bounded by the total
+    size of their content. Each entry keeps the stamp (mtimes and sizes) of
+    the files it was made from and is only used while the stamp matches.
+    '''
+
+    def __init__(self, max_size : int):
+        self.max_size : int = max_size
+        self.size : int = 0
+        self.hits : int = 0
+        self.misses : int = 0
+        self.evictions : int = 0
+        self._entries : OrderedDict[tuple, CachedResponse] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key : tuple, stamp : tuple) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry.stamp == stamp:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+            # the files changed since the entry was made
+            if entry is not None:
+                del self._entries[key]
+                self.size -= entry.size
+
+            self.misses += 1
+            return None
+
+    def put(self, key : tuple, entry : CachedResponse):
+        if entry.size > self.max_size:
+            return
+
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry.size
+
+            self._entries[key] = entry
+            self.size += entry.size
+            self._evict()
+
+    def grow(self, entry : CachedResponse, size : int):
+        '''
+        Count memory added to an entry after it was cached, like a compressed
+        copy of its content
+        '''
+        with self._lock:
+            entry.size += size
+            if self._entries.get(entry.key) is not entry:
+                return
+            self.size += size
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.size
+            self.evictions += 1
+
+    def get_stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (self.hits / total) if total else 0.0,
+            'entries': len(self._entries),
+            'size': self.size,
+        }
+
+    def get_stats_string(self) -> str:
+        stats = self.get_stats()
+        return f"{stats['hits']} hits, {stats['misses']} misses, {round(stats['hit_rate'] * 100)}% hit rate, {stats['entries']} entries using {stats['size']} bytes"
+
 
 class AdServerAssetReader:
-    def __init__(self, asset_dir : str, default_level : Optional[str], do_obstacle_testing : bool):
+    def __init__(self, asset_dir : str, default_level : Optional[str], do_obstacle_testing : bool, cache_size : int = DEFAULT_CACHE_SIZE):
         self.asset_dir : str = asset_dir
         self.default_level : Optional[str] = default_level
         self.do_obstacle_loading : bool = do_obstacle_testing
+        self.cache : Optional[ResponseCache] = ResponseCache(cache_size) if cache_size > 0 else None
         self._templates : Optional[dict[str, dict[str, str]]] = None
         self._templates_mtime : float = 0.0
+        self._templates_lock = threading.Lock()
+        self.encoded_responses : int = 0
+        self.bytes_saved : int = 0
+        self._stats_lock = threading.Lock()
         self.update_templates()
 
     def _get_asset_path(self, path):
         return p.join(self.asset_dir, path + '.mp3')
 
-    def _template_exists(self, name):
-        return (name is not None) and (name in self._templates.keys())
+    def _get_asset_stamp(self, path : str) -> Optional[tuple[int, int]]:
+        return file_stamp(self._get_asset_path(path))
+
+    def _read_cached(self, key : tuple, stamp : tuple, read) -> Optional[CachedResponse]:
+        if self.cache is not None:
+            entry = self.cache.get(key, stamp)
+            if entry is not None:
+                return entry
+
+        # the stamp is taken before reading, so if a file changes while it's
+        # being read the entry is just made again on the next request
+        content = read()
+        if content is None:
+            return
+
+        entry = CachedResponse(key, stamp, content)
+        if self.cache is not None:
+            self.cache.put(key, entry)
+
+        return entry
+
+
+    def encode(self, asset : CachedResponse, encoding : str) -> Optional[bytes]:
+        '''
+        Get the asset's content compressed with an encoding, or None if that
+        doesn't make it smaller. The compressed copy is kept with the asset.
+        '''
+        # other threads asking for the same copy wait for it instead of
+        # compressing it again and counting its size in the cache twice
+        with asset.encode_lock:
+            if encoding in asset.encoded:
+                return asset.encoded[encoding]
+
+            encoded = encode_content(asset.content, encoding)
+            if len(encoded) >= len(asset.content):
+                encoded = None
+
+            asset.encoded[encoding] = encoded
+            if encoded is not None and self.cache is not None:
+                self.cache.grow(asset, len(encoded))
+
+        return encoded
+
+
+    def count_bytes_saved(self, saved : int):
+        with self._stats_lock:
+            self.encoded_responses += 1
+            self.bytes_saved += saved
 
 
     def read_asset(self, path : str) -> Optional[bytes]:
@@ -83,6 +311,12 @@ class AdServerAssetReader:
 
 
     def update_templates(self):
+        # requests can be served from several threads, so only one of them
+        # reloads the templates and the others never see a half-built dict
+        with self._templates_lock:
+            self._update_templates()
+
+    def _update_templates(self):
         templates_path = self._get_asset_path('templates.xml')
 
         if not path_is_readable(templates_path):
@@ -103,8 +337,7 @@ class AdServerAssetReader:
         except ETree.ParseError:
             return
 
-        self._templates = {}
-        self._templates_mtime = templates_mtime
+        templates : dict[str, dict[str, str]] = {}
 
         for template in templates_root.iter('template'):
             template_name = template.get('name')
@@ -114,15 +347,25 @@ class AdServerAssetReader:
             if properties_el is None:
                 continue
             properties : dict[str, str] = properties_el.attrib
-            self._templates[template_name] = properties
+            templates[template_name] = properties
+
+        self._templates = templates
+        self._templates_mtime = templates_mtime
 
 
-    def read_level(self, level_type : Optional[str], pv : Optional[int], hostname) -> Optional[bytes]:
+    def read_level(self, level_type : Optional[str], pv : Optional[int], hostname) -> Optional[CachedResponse]:
         if level_type is None:
             if self.default_level is None:
                 return
             level_type = self.default_level
 
+        stamp = (self._get_asset_stamp(p.join('levels', level_type + '.xml')),)
+
+        return self._read_cached(('level', level_type, pv, hostname), stamp,
+                lambda: self._read_level(level_type, pv, hostname))
+
+
+    def _read_level(self, level_type : str, pv : Optional[int], hostname) -> Optional[bytes]:
         level_content = self.read_asset(p.join('levels', level_type + '.xml'))
 
         if level_content is None:
@@ -146,10 +389,17 @@ class AdServerAssetReader:
         return ETree.tostring(level_root, encoding='utf-8', method='xml')
 
 
-    def read_room(self, room_type : Optional[str], pv : Optional[int], hostname) -> Optional[bytes]:
+    def read_room(self, room_type : Optional[str], pv : Optional[int], hostname) -> Optional[CachedResponse]:
         if room_type is None:
             return
 
+        stamp = (self._get_asset_stamp(p.join('rooms', room_type + '.lua')),)
+
+        return self._read_cached(('room', room_type, pv, hostname), stamp,
+                lambda: self._read_room(room_type, pv, hostname))
+
+
+    def _read_room(self, room_type : str, pv : Optional[int], hostname) -> Optional[bytes]:
         room_content = self.read_asset(p.join('rooms', room_type + '.lua'))
         if room_content is None:
             return
@@ -172,10 +422,28 @@ end
         return mgSegment_wrapper + bytes(re_mgSeg.sub(repl, room_content.decode('utf-8')), 'utf-8')
 
 
-    def read_segment(self, segment_type : Optional[str], pv : Optional[int], hostname) -> Optional[bytes]:
+    def read_segment(self, segment_type : Optional[str], pv : Optional[int], hostname) -> Optional[CachedResponse]:
         if segment_type is None:
             return
 
+        self.update_templates()
+
+        stamp = (
+            self._get_asset_stamp(p.join('segments', segment_type + '.xml')),
+            self._get_asset_stamp(p.join('segments', segment_type + '.xml.gz')),
+            self._templates_mtime,
+        )
+
+        # obstacle types are rewritten depending on which obstacle files
+        # exist, which can be in folders inside the obstacles folder
+        if pv and pv >= 3 and self.do_obstacle_loading:
+            stamp += (tree_stamp(p.join(self.asset_dir, 'obstacles')),)
+
+        return self._read_cached(('segment', segment_type, pv, hostname), stamp,
+                lambda: self._read_segment(segment_type, pv, hostname))
+
+
+    def _read_segment(self, segment_type : str, pv : Optional[int], hostname) -> Optional[bytes]:
         segment_content = self.read_asset(p.join('segments', segment_type + '.xml'))
         if segment_content is None:
             segment_content = self.read_asset(p.join('segments', segment_type + '.xml.gz'))
@@ -192,15 +460,16 @@ end
             return segment_content
 
         self.update_templates()
+        templates = self._templates
 
-        if self._templates is not None:
+        if templates is not None:
             for iterator in segment_root.iter('box'), segment_root.iter('obstacle'):
                 for obj in iterator:
                     template_name = obj.get('template')
-                    if not self._template_exists(template_name):
+                    if template_name is None or template_name not in templates:
                         continue
                     del obj.attrib['template']
-                    obj.attrib = {**self._templates[template_name], **obj.attrib}
+                    obj.attrib = {**templates[template_name], **obj.attrib}
 
         pv_string = f'&pv={pv}' if pv else ''
 
@@ -219,14 +488,26 @@ end
         return ETree.tostring(segment_root, encoding='utf-8', method='xml')
 
 
-    def read_segment_mesh(self, segment_type : Optional[str]) -> Optional[bytes]:
-        segment_content = self.read_asset(p.join('segments', segment_type + '.mesh'))
-        return segment_content
+    def read_segment_mesh(self, segment_type : Optional[str]) -> Optional[CachedResponse]:
+        if segment_type is None:
+            return
+
+        mesh_path = p.join('segments', segment_type + '.mesh')
+        stamp = (self._get_asset_stamp(mesh_path),)
+
+        return self._read_cached(('mesh', segment_type, None, None), stamp,
+                lambda: self.read_asset(mesh_path))
+
+
+    def read_obstacle(self, obstacle_type) -> Optional[CachedResponse]:
+        if obstacle_type is None:
+            return
 
+        obstacle_path = p.join('obstacles', obstacle_type + '.lua')
+        stamp = (self._get_asset_stamp(obstacle_path),)
 
-    def read_obstacle(self, obstacle_type) -> Optional[bytes]:
-        obstacle_content = self.read_asset(p.join('obstacles', obstacle_type + '.lua'))
-        return obstacle_content
+        return self._read_cached(('obstacle', obstacle_type, None, None), stamp,
+                lambda: self.read_asset(obstacle_path))
 
 
 
@@ -247,6 +528,10 @@ class HTTPResponse:
     def ok(cls, headers:dict[str, str]={}, content:bytes=b''):
         return cls(200, headers, content)
 
+    @classmethod
+    def not_modified(cls, headers:dict[str, str]={}):
+        return cls(304, headers)
+
     @classmethod
     def not_found(cls):
         return cls(404,
@@ -256,6 +541,19 @@ class HTTPResponse:
 
 
 class AdRequestHandler(BaseHTTPRequestHandler):
+    # keep connections open between requests, so a room load doesn't connect
+    # again for every segment and mesh. Every response has a Content-Length
+    # and idle connections are closed after the timeout.
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEP_ALIVE_TIMEOUT
+    # headers and body are written separately, and with Nagle's algorithm
+    # the body waits for the client's delayed ACK on a reused connection
+    disable_nagle_algorithm = True
+
+    # content encoding of the response being sent and how much it saved
+    _encoding : Optional[str] = None
+    _bytes_saved : int = 0
+
     def log_request(self, code='-', size='-'):
         if isinstance(code, HTTPStatus):
             code = code.value
@@ -282,10 +580,36 @@ class AdRequestHandler(BaseHTTPRequestHandler):
             if self._get_query("pv") is not None:
                 pv_string = f', pv.{self._get_query("pv")}'
 
+        code_string = str(code)
+        if self._encoding is not None:
+            code_string += f', {self._encoding} saved {self._bytes_saved} bytes'
+
         if kind is not None:
-            self.log_message('get %s %s%s (%s)', kind, type_string, pv_string, str(code))
+            self.log_message('get %s %s%s (%s)', kind, type_string, pv_string, code_string)
         else:
-            self.log_message('%s (%s)', dquotes(self.requestline), str(code))
+            self.log_message('%s (%s)', dquotes(self.requestline), code_string)
+
+
+    def handle_one_request(self):
+        # cleared so log_error can tell if the connection timed out before
+        # any of the next request came in
+        self.raw_requestline = b''
+        try:
+            super().handle_one_request()
+        except ConnectionResetError:
+            # clients can also drop a connection they aren't using any more
+            # without closing it
+            if self.raw_requestline:
+                raise
+            self.close_connection = True
+
+
+    def log_error(self, format, *args):
+        # idle kept-alive connections are closed by timing out while waiting
+        # for the next request, which isn't an error
+        if not self.raw_requestline and format.startswith('Request timed out'):
+            return
+        super().log_error(format, *args)
 
 
     def log_message(self, format, *args):
@@ -295,18 +619,105 @@ class AdRequestHandler(BaseHTTPRequestHandler):
                           self.address_string(),
                           message))
 
+    def _is_not_modified(self, response:HTTPResponse) -> bool:
+        # If-None-Match wins over If-Modified-Since when both are sent
+        if_none_match = self.headers['If-None-Match']
+        if if_none_match is not None:
+            etag = response.headers['ETag']
+            for tag in if_none_match.split(','):
+                tag = tag.strip()
+                if tag == '*' or tag.removeprefix('W/') == etag:
+                    return True
+            return False
+
+        if_modified_since = self.headers['If-Modified-Since']
+        last_modified = response.headers.get('Last-Modified')
+        if if_modified_since is None or last_modified is None:
+            return False
+
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+            modified = email.utils.parsedate_to_datetime(last_modified)
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return False
+
+        if since.tzinfo is None:
+            return False
+
+        return modified <= since
+
     def _send_response(self, response:HTTPResponse):
+        if response.status == 200:
+            if 'ETag' not in response.headers:
+                response.headers['ETag'] = content_etag(response.content)
+
+            # the device already has this body, only send the headers
+            if self._is_not_modified(response):
+                validators = {key: response.headers[key] for key in ('ETag', 'Last-Modified', 'Vary') if key in response.headers}
+                response = HTTPResponse.not_modified(validators)
+                self._encoding = None
+
         self.send_response(response.status)
-        response.generate_content_len()
+        if response.status != 304:
+            response.generate_content_len()
         for key in response.headers.keys():
             self.send_header(key, response.headers[key])
+        # let clients waiting for a connection have this one
+        is_full = getattr(self.server, 'is_full', None)
+        if is_full is not None and is_full() and not self.close_connection:
+            self.send_header('Connection', 'close')
         self.end_headers()
         self.wfile.write(response.content)
 
-    def _conditional_response(self, content : Optional[bytes], content_type : str):
-        if content is None:
+    def _get_accepted_encodings(self) -> list[str]:
+        accept_encoding = self.headers['Accept-Encoding']
+        if accept_encoding is None:
+            return []
+
+        qvalues : dict[str, float] = {}
+        for item in accept_encoding.split(','):
+            name, _, params = item.partition(';')
+            qvalue = 1.0
+            params = params.strip().replace(' ', '')
+            if params.startswith('q='):
+                try:
+                    qvalue = float(params[2:])
+                except ValueError:
+                    qvalue = 0.0
+            qvalues[name.strip().lower()] = qvalue
+
+        wildcard = qvalues.get('*', 0.0)
+        return [encoding for encoding in CONTENT_ENCODINGS if qvalues.get(encoding, wildcard) > 0.0]
+
+    def _conditional_response(self, asset : Optional[CachedResponse], content_type : str):
+        if asset is None:
             return self._send_response(HTTPResponse.not_found())
-        return self._send_response(HTTPResponse.ok({'Content-Type': content_type}, content))
+
+        headers = {'Content-Type': content_type, 'ETag': asset.etag}
+        if asset.mtime is not None:
+            headers['Last-Modified'] = email.utils.formatdate(asset.mtime, usegmt=True)
+
+        content = asset.content
+
+        if content_type in COMPRESSIBLE_TYPES and asset.size >= COMPRESS_MIN_SIZE:
+            headers['Vary'] = 'Accept-Encoding'
+            for encoding in self._get_accepted_encodings():
+                encoded = asset_reader.encode(asset, encoding)
+                if encoded is None:
+                    continue
+                # each encoding is a different body, so it needs its own ETag
+                headers['Content-Encoding'] = encoding
+                headers['ETag'] = asset.etag[:-1] + '-' + encoding + '"'
+                self._encoding = encoding
+                self._bytes_saved = len(content) - len(encoded)
+                content = encoded
+                break
+
+        response = HTTPResponse.ok(headers, content)
+        self._send_response(response)
+
+        if response.status == 200 and self._encoding is not None:
+            asset_reader.count_bytes_saved(self._bytes_saved)
 
     def _get_query(self, name:str) -> Optional[str]:
         if not name in self._queries.keys():
@@ -321,6 +732,15 @@ class AdRequestHandler(BaseHTTPRequestHandler):
 
 
     def do_GET(self):
+        # only as many requests as the server allows are handled at once,
+        # connections waiting for their next request don't count
+        with getattr(self.server, 'request_slots', None) or nullcontext():
+            self._handle_get()
+
+
+    def _handle_get(self):
+        self._encoding = None
+        self._bytes_saved = 0
         self._url = urlparse(self.path)
         self._hostname = self.headers['Host'].split(':')[0]
         self._queries = parse_url_qs(self._url.query)
@@ -345,10 +765,60 @@ class AdRequestHandler(BaseHTTPRequestHandler):
             self._send_response(HTTPResponse.not_found())
 
 
-def runAdServer(server_class, handler_class, asset_dir : str, default_level : Optional[str], do_obstacle_loading : bool):
+class BoundedHTTPServer(ThreadingHTTPServer):
+    '''
+    HTTP server that gives each connection its own thread, so a slow client,
+    a large mesh transfer or an idle kept-alive connection doesn't hold up
+    the other clients, but only handles max_workers requests at the same
+    time. Requests beyond that wait for one of the others to finish.
+
+    The request slots only limit the work being done, not the threads, so
+    there are also at most max_connections connections open at once. New
+    connections beyond that wait to be accepted until one closes, and while
+    the server is full responses close their connection instead of keeping
+    it alive, so the waiting clients get their turn.
+    '''
+
+    def __init__(self, server_address, handler_class, max_workers : int = 8, max_connections : int = 64):
+        super().__init__(server_address, handler_class)
+        self.request_slots = threading.BoundedSemaphore(max_workers)
+        self.max_connections = max(max_connections, 1)
+        self.connections = 0
+        self._connection_slots = threading.BoundedSemaphore(self.max_connections)
+        self._connections_lock = threading.Lock()
+
+    def is_full(self) -> bool:
+        with self._connections_lock:
+            return self.connections >= self.max_connections
+
+    def process_request(self, request, client_address):
+        # runs on the thread accepting connections, so waiting here leaves
+        # new connections in the listen backlog until a thread is free
+        self._connection_slots.acquire()
+        with self._connections_lock:
+            self.connections += 1
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self._release_connection()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._release_connection()
+
+    def _release_connection(self):
+        with self._connections_lock:
+            self.connections -= 1
+        self._connection_slots.release()
+
+
+def runAdServer(server_class, handler_class, asset_dir : str, default_level : Optional[str], do_obstacle_loading : bool, cache_size : int = DEFAULT_CACHE_SIZE):
     global asset_reader
 
-    asset_reader = AdServerAssetReader(asset_dir, default_level, do_obstacle_loading)
+    asset_reader = AdServerAssetReader(asset_dir, default_level, do_obstacle_loading, cache_size)
     server = server_class(("0.0.0.0", 8000), handler_class)
 
     print("Smash Hit asset server running!")
@@ -359,6 +829,11 @@ def runAdServer(server_class, handler_class, asset_dir : str, default_level : Op
         print("Smash Hit asset server is down:\n" + e)
     except KeyboardInterrupt:
         print("Exiting...")
+    finally:
+        server.server_close()
+        if asset_reader.cache is not None:
+            print("Response cache: " + asset_reader.cache.get_stats_string())
+        print(f"Compression saved {asset_reader.bytes_saved} bytes over {asset_reader.encoded_responses} responses")
 
 
 
@@ -367,12 +842,28 @@ def main():
     parser.add_argument('asset_dir', metavar='asset-directory', help='SH asset directory')
     parser.add_argument('-l', '--default-level', dest='default_level', metavar='default-level', help='level that will be accessible at https://localhost:8000/level by default, required for compatibility with Shatter Client')
     parser.add_argument('-o', '--obstacle-loading', dest='do_obstacle_loading', action='store_true', help='Load obstacles from asset directory. Requires Shatter Client version 3.3.0 or later')
+    parser.add_argument('-c', '--cache-size', dest='cache_size', metavar='cache-size', type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024), help='Memory used to cache generated levels, rooms and segments in MiB (default %(default)s), 0 disables the cache')
+    parser.add_argument('-j', '--workers', dest='workers', metavar='workers', type=int, default=8, help='Number of requests served at the same time (default 8), 0 serves one request at a time')
+    parser.add_argument('-m', '--max-connections', dest='max_connections', metavar='connections', type=int, default=64, help='Number of connections open at the same time, each with its own thread (default %(default)s), ignored with 0 workers')
+    parser.add_argument('-k', '--keep-alive', dest='keep_alive', metavar='seconds', type=int, default=KEEP_ALIVE_TIMEOUT, help='Seconds to keep idle connections open for reuse (default %(default)s), 0 closes the connection after every request')
 
     args = parser.parse_args()
 
     print('WARNING: BE CAREFUL WITH UNTRUSTED XML FILES!\nMORE DETAILS: https://docs.python.org/3/library/xml.html#xml-vulnerabilities\n')
 
-    runAdServer(HTTPServer, AdRequestHandler, p.join(os.getcwd(), args.asset_dir), args.default_level, args.do_obstacle_loading)
+    server_class = HTTPServer
+    if args.workers > 0:
+        server_class = partial(BoundedHTTPServer, max_workers=args.workers, max_connections=args.max_connections)
+
+    # an idle connection would hold up everyone else when there's only one
+    # worker, so connections are only kept open when serving several at once
+    if args.workers > 0 and args.keep_alive > 0:
+        AdRequestHandler.timeout = args.keep_alive
+    else:
+        AdRequestHandler.protocol_version = 'HTTP/1.0'
+        AdRequestHandler.timeout = None
+
+    runAdServer(server_class, AdRequestHandler, p.join(os.getcwd(), args.asset_dir), args.default_level, args.do_obstacle_loading, args.cache_size * 1024 * 1024)
 
 
 
@@ -11,12 +11,29 @@ Problems:
 """
 
 import struct
+import array
 import zlib
+import io
 import sys
 import xml.etree.ElementTree as et
 import random
 import math
 import gzip
+import argparse
+import multiprocessing
+import collections
+import time
+import threading
+import os
+import glob
+import traceback
+import importlib.machinery
+
+# NumPy is optional, it is only used by the vectorised baking engine
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 # Version of mesh baker
 VERSION = (0, 15, 6)
@@ -44,19 +61,185 @@ TILE_BITE_COL = 0.03125
 # includes back faces, so both must be enabled for those.
 BAKE_UNSEEN_FACES = False
 
+# Don't bake the parts of faces that are covered up by another box touching or
+# overlapping them. You can't see them anyways, so this only makes the mesh
+# smaller.
+CULL_HIDDEN_FACES = False
+
 # Enable ambient occlusion using delta boxes
 ABMIENT_OCCLUSION_ENABLED = True
 
 # Half of the size of the delta box when using the delta-box AO method
 ABMIENT_OCCLUSION_DELTA_BOX_SIZE = 0.5
 
+# Use a uniform grid over the boxes to only test the boxes near a vertex for
+# ambient occlusion. The result is exactly the same as testing every box, so
+# this is mainly here to compare the two.
+ABMIENT_OCCLUSION_USE_GRID = True
+
+# Size of a cell in the ambient occlusion grid
+ABMIENT_OCCLUSION_GRID_CELL_SIZE = 2.0
+
+# Find the boxes near a face once for all of its vertices and only compute
+# ambient occlusion once for corners shared by more than one tile. Like the
+# grid, the result is exactly the same either way.
+ABMIENT_OCCLUSION_PER_FACE = True
+
 # Enable lighting
 LIGHTING_ENABLED = False
 
+# Lights are skipped for a vertex when the most they could add to any colour
+# channel is less than this. Zero means every light is used for every vertex,
+# which gives exactly the same mesh as older versions.
+LIGHTING_CUTOFF = 0.0
+
+# Merge vertices that have exactly the same position, texture coordinates and
+# colour so they are only stored once. Every tile quad has its own texture
+# coordinates, so corners shared by neighbouring tiles almost never match and
+# this usually saves well under 1% of the vertices (none on a plain tiled
+# floor). It's not on by default since it changes the mesh layout.
+WELD_VERTICES = False
+
+# Use the vectorised NumPy baking engine when NumPy is available. It produces
+# exactly the same mesh as the pure Python engine, which is still used when
+# NumPy can't be imported.
+NUMPY_ENGINE_ENABLED = True
+
+# Merge faces of different boxes that are on the same plane, look exactly the
+# same and touch or overlap into bigger faces before they are split into tiles.
+# Faces are only merged when that gives exactly the same tiles, so this doesn't
+# change how the segment looks, but the order of the quads in the mesh changes.
+# It's not used when re-baking only the boxes that changed.
+MERGE_COPLANAR_FACES = False
+
+# zlib compression level for the mesh file, from 0 (not compressed, fastest)
+# to 9 (smallest, slowest), or -1 for zlib's default (which is 6)
+COMPRESSION_LEVEL = -1
+
+# zlib compression strategy for the mesh file, one of the names in
+# COMPRESSION_STRATEGIES
+COMPRESSION_STRATEGY = "default"
+
+# Compress the mesh with every (level, strategy) in COMPRESSION_BEST_CANDIDATES
+# and keep the smallest one instead of using the level and strategy above.
+# Higher levels aren't always smaller, so this is worth it for release builds,
+# but it is a lot slower.
+COMPRESSION_BEST = False
+COMPRESSION_BEST_CANDIDATES = [
+	(6, "default"),
+	(7, "default"),
+	(8, "default"),
+	(9, "default"),
+	(9, "filtered"),
+]
+
 ################################################################################
 ### END OF CONFIGURATION #######################################################
 ################################################################################
 
+# Names of all of the settings above, these are passed on to worker processes
+SETTINGS = [
+	"INCLUDE_VERSION_AND_INFO",
+	"TILE_ROWS",
+	"TILE_COLS",
+	"TILE_BITE_ROW",
+	"TILE_BITE_COL",
+	"BAKE_UNSEEN_FACES",
+	"CULL_HIDDEN_FACES",
+	"ABMIENT_OCCLUSION_ENABLED",
+	"ABMIENT_OCCLUSION_DELTA_BOX_SIZE",
+	"ABMIENT_OCCLUSION_USE_GRID",
+	"ABMIENT_OCCLUSION_GRID_CELL_SIZE",
+	"ABMIENT_OCCLUSION_PER_FACE",
+	"LIGHTING_ENABLED",
+	"LIGHTING_CUTOFF",
+	"WELD_VERTICES",
+	"NUMPY_ENGINE_ENABLED",
+	"MERGE_COPLANAR_FACES",
+	"COMPRESSION_LEVEL",
+	"COMPRESSION_STRATEGY",
+	"COMPRESSION_BEST",
+	"COMPRESSION_BEST_CANDIDATES",
+]
+
+# Settings that change the geometry or vertex colours baked for a box, so they
+# are part of the fragment cache keys. The others only change how the mesh is
+# packed, or are faster ways to get exactly the same result.
+FRAGMENT_SETTINGS = [
+	"TILE_ROWS",
+	"TILE_COLS",
+	"TILE_BITE_ROW",
+	"TILE_BITE_COL",
+	"BAKE_UNSEEN_FACES",
+	"CULL_HIDDEN_FACES",
+	"ABMIENT_OCCLUSION_ENABLED",
+	"ABMIENT_OCCLUSION_DELTA_BOX_SIZE",
+	"LIGHTING_ENABLED",
+	"LIGHTING_CUTOFF",
+]
+
+# zlib strategies that can be used for COMPRESSION_STRATEGY
+COMPRESSION_STRATEGIES = {
+	"default": zlib.Z_DEFAULT_STRATEGY,
+	"filtered": zlib.Z_FILTERED,
+	"huffman_only": zlib.Z_HUFFMAN_ONLY,
+	"rle": zlib.Z_RLE,
+	"fixed": zlib.Z_FIXED,
+}
+
+def getSettings():
+	"""
+	Get the current settings as a dict
+	"""
+	
+	return {name: globals()[name] for name in SETTINGS}
+
+def applySettings(settings):
+	"""
+	Set the settings from a dict like the one from getSettings
+	"""
+	
+	for name in settings:
+		if (name in SETTINGS):
+			globals()[name] = settings[name]
+
+class BakeSettings:
+	"""
+	The settings for one bake, with an attribute for each name in SETTINGS.
+	Anything that isn't given comes from the module globals, which are only
+	the defaults (and what the command line changes). The baker reads the
+	settings from here instead of the globals, so bakes with different
+	settings can run in more than one thread at the same time.
+	"""
+	
+	__slots__ = tuple(SETTINGS)
+	
+	def __init__(self, settings = None):
+		defaults = globals()
+		
+		for name in SETTINGS:
+			setattr(self, name, defaults[name])
+		
+		for name in (settings or {}):
+			if (name in SETTINGS):
+				setattr(self, name, settings[name])
+	
+	@classmethod
+	def get(cls, settings = None):
+		"""
+		Get the BakeSettings for a dict of settings, None for the defaults, or
+		an existing BakeSettings
+		"""
+		
+		return settings if isinstance(settings, BakeSettings) else cls(settings)
+	
+	def asDict(self):
+		"""
+		Get the settings as a dict like the one from getSettings
+		"""
+		
+		return {name: getattr(self, name) for name in SETTINGS}
+
 def log(msg, newline = True):
 	"""
 	Log a message to the console
@@ -83,8 +266,13 @@ def removeEverythingEqualTo(array, value):
 class Vector3:
 	"""
 	(Hopefully) simple implementation of a Vector3
+	
+	Lots of these are made while baking, so they use slots instead of a dict
+	to save memory.
 	"""
 	
+	__slots__ = ("x", "y", "z", "a")
+	
 	def __init__(self, x = 0.0, y = 0.0, z = 0.0, a = 1.0):
 		self.x = x
 		self.y = y
@@ -212,6 +400,135 @@ class BakeProgressInfo():
 	def update(self, value):
 		self.callback(value)
 
+class BakeThreadState(threading.local):
+	"""
+	Things about the bake running on the current thread
+	"""
+	
+	# Profile of the bake, if it is being profiled
+	profile = None
+
+gBakeThread = BakeThreadState()
+
+class BakeProfile:
+	"""
+	Timers and counters for the phases of a bake. Pass one to
+	bakeMeshFromBytesToBytes to have it filled in.
+	
+	Timers include the time of any timers inside of them (for example, the
+	mesh data timer includes ambient occlusion). When baking with worker
+	processes, the time is added up across all of the workers.
+	"""
+	
+	def __init__(self):
+		self.timers = {}
+		self.calls = {}
+		self.counters = {}
+		self.info = {}
+	
+	def addTime(self, name, seconds):
+		self.timers[name] = self.timers.get(name, 0.0) + seconds
+		self.calls[name] = self.calls.get(name, 0) + 1
+	
+	def count(self, name, amount = 1):
+		self.counters[name] = self.counters.get(name, 0) + amount
+	
+	def setInfo(self, name, value):
+		"""
+		Record something about the bake that isn't a time or a count, like
+		which compression level was used
+		"""
+		
+		self.info[name] = value
+	
+	def asDict(self):
+		"""
+		Get the profile as a dict of plain values
+		"""
+		
+		return {
+			"timers": dict(self.timers),
+			"calls": dict(self.calls),
+			"counters": dict(self.counters),
+			"info": dict(self.info),
+		}
+	
+	def merge(self, other):
+		"""
+		Add the results from a dict like the one from asDict
+		"""
+		
+		for name, seconds in other["timers"].items():
+			self.timers[name] = self.timers.get(name, 0.0) + seconds
+		
+		for name, calls in other["calls"].items():
+			self.calls[name] = self.calls.get(name, 0) + calls
+		
+		for name, amount in other["counters"].items():
+			self.count(name, amount)
+		
+		self.info.update(other.get("info", {}))
+	
+	def report(self):
+		"""
+		Get a human readable report of the profile
+		"""
+		
+		lines = [f"{'Phase':<20}{'Time':>12}{'Calls':>10}"]
+		
+		for name in self.timers:
+			lines.append(f"{name:<20}{self.timers[name] * 1000:>10.1f}ms{self.calls[name]:>10}")
+		
+		lines.append(f"{'Counter':<20}{'Count':>12}")
+		
+		for name in self.counters:
+			lines.append(f"{name:<20}{self.counters[name]:>12}")
+		
+		if (self.info):
+			lines.append(f"{'Info':<20}{'Value':>12}")
+		
+		for name in self.info:
+			lines.append(f"{name:<20}{str(self.info[name]):>12}")
+		
+		return "\n".join(lines)
+
+class ProfileTimer:
+	"""
+	Adds the time spent in a with block to a profile
+	"""
+	
+	def __init__(self, profile, name):
+		self.profile = profile
+		self.name = name
+	
+	def __enter__(self):
+		self.start = time.perf_counter()
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.profile.addTime(self.name, time.perf_counter() - self.start)
+
+class NullTimer:
+	"""
+	Stands in for ProfileTimer when not profiling
+	"""
+	
+	def __enter__(self):
+		pass
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		pass
+
+NULL_TIMER = NullTimer()
+
+def profileTimer(name):
+	"""
+	Time a with block if the bake is being profiled
+	"""
+	
+	profile = gBakeThread.profile
+	
+	return ProfileTimer(profile, name) if profile else NULL_TIMER
+
 def parseIntTriplet(string):
 	"""
 	Parse either a single int or three ints in a string to a tuple of three ints
@@ -249,9 +566,12 @@ class SegmentInfo:
 	Info about the segment and its global information.
 	"""
 	
-	def __init__(self, attribs, templates = None, boxes = None):
+	def __init__(self, attribs, templates = None, boxes = None, settings = None):
 		self.template = attribs.get("template", None)
 		
+		# BakeSettings the segment is baked with
+		self.settings = BakeSettings.get(settings)
+		
 		self.front = float(getFromTemplate(attribs, templates, self.template, "lightFront", "1.0"))
 		self.back = float(getFromTemplate(attribs, templates, self.template, "lightBack", "1.0"))
 		self.left = float(getFromTemplate(attribs, templates, self.template, "lightLeft", "1.0"))
@@ -263,6 +583,20 @@ class SegmentInfo:
 		self.ambient = Vector3.fromString(getFromTemplate(attribs, templates, self.template, "ambient", "0 0 0"))
 		
 		self.boxes = boxes
+		self.grid = None
+		self.lights = None
+		
+		# Number of quads that were not baked because they are hidden
+		self.culled_quads = 0
+	
+	def buildIndex(self):
+		"""
+		Build the spatial index over the boxes, needs to be done again if the
+		boxes change.
+		"""
+		
+		self.grid = BoxGrid(self.boxes, self.settings.ABMIENT_OCCLUSION_GRID_CELL_SIZE)
+		self.lights = LightIndex(self.boxes, self.settings.LIGHTING_CUTOFF)
 	
 	def boxcast(self, pos, size):
 		"""
@@ -273,23 +607,226 @@ class SegmentInfo:
 		total = 0.0
 		intersected = 0
 		
-		for b in self.boxes:
-			result = b.testAABB_optimisedBC(pos, size)
+		if (self.settings.ABMIENT_OCCLUSION_USE_GRID and self.grid):
+			boxes = [self.boxes[i] for i in self.grid.query(pos, size)]
+		else:
+			boxes = self.boxes
+		
+		px, py, pz = pos.x, pos.y, pos.z
+		sx, sy, sz = size.x, size.y, size.z
+		
+		for b in boxes:
+			volume = b.overlapVolume(px, py, pz, sx, sy, sz)
 			
-			if (result):
-				volume = (2.0 * result[1].x) * (2.0 * result[1].y) * (2.0 * result[1].z)
-				
+			if (volume != None):
 				intersected += 1
 				total += volume
 		
+		profile = gBakeThread.profile
+		
+		if (profile):
+			profile.count("boxcast_tests", len(boxes))
+			profile.count("boxcast_hits", intersected)
+		
 		return (total, intersected)
+	
+	def getFragmentKeys(self):
+		"""
+		Get a key for each box that changes when anything that affects the baked
+		geometry of that box changes: the box itself, the boxes near enough to
+		shade or cover it, the lights and the segment's own properties.
+		"""
+		
+		settings = self.settings
+		box_keys = [box.getKey() for box in self.boxes]
+		bounds = [box.getBounds() for box in self.boxes]
+		
+		# Segment wide things that affect every box
+		common = (
+			(self.front, self.back, self.left, self.right, self.top, self.bottom, self.ambient.asTuple()),
+			tuple((name, getattr(settings, name)) for name in FRAGMENT_SETTINGS),
+			VERSION,
+			tuple(box_keys[i] for i, box in enumerate(self.boxes) if box.glow != 0.0) if settings.LIGHTING_ENABLED else (),
+		)
+		
+		# Ambient occlusion looks at boxes up to two delta box sizes out from
+		# the box, and culling only looks at boxes that touch it
+		margin = 2.0 * settings.ABMIENT_OCCLUSION_DELTA_BOX_SIZE if settings.ABMIENT_OCCLUSION_ENABLED else 0.0
+		
+		keys = []
+		
+		for i, (lo, hi) in enumerate(bounds):
+			lo = tuple(v - margin for v in lo)
+			hi = tuple(v + margin for v in hi)
+			
+			candidates = self.grid.queryBounds(lo, hi) if self.grid else range(len(self.boxes))
+			
+			# The order of the boxes matters since it changes the order the
+			# shading is added up in
+			neighbours = tuple(box_keys[j] for j in candidates if all(bounds[j][0][a] <= hi[a] and lo[a] <= bounds[j][1][a] for a in range(3)))
+			
+			keys.append((common, box_keys[i], neighbours))
+		
+		return keys
+
+class BoxGrid:
+	"""
+	Uniform grid over the boxes of a segment, for quickly finding the boxes
+	that might touch some region.
+	"""
+	
+	# Boxes that would cover more cells than this are kept in their own list
+	# and returned by every query instead
+	MAX_CELLS_PER_BOX = 4096
+	
+	def __init__(self, boxes, cell_size):
+		self.cell_size = cell_size
+		self.cells = {}
+		self.large = []
+		
+		for i, box in enumerate(boxes):
+			ranges = self.cellRanges(*box.getBounds())
+			
+			if (len(ranges[0]) * len(ranges[1]) * len(ranges[2]) > self.MAX_CELLS_PER_BOX):
+				self.large.append(i)
+				continue
+			
+			for x in ranges[0]:
+				for y in ranges[1]:
+					for z in ranges[2]:
+						self.cells.setdefault((x, y, z), []).append(i)
+	
+	def cellRanges(self, lo, hi):
+		"""
+		Get the range of cells on each axis that the region from lo to hi covers.
+		A region that only touches the edge of a cell counts as being in it.
+		"""
+		
+		c = self.cell_size
+		
+		return [range(math.floor(lo[a] / c), math.floor(hi[a] / c) + 1) for a in range(3)]
+	
+	def query(self, pos, size):
+		"""
+		Find the indices of boxes that could intersect the box with the given
+		position and half size, in the order they are in the segment.
+		"""
+		
+		lo = (pos.x - size.x, pos.y - size.y, pos.z - size.z)
+		hi = (pos.x + size.x, pos.y + size.y, pos.z + size.z)
+		
+		return self.queryBounds(
+			(min(lo[0], hi[0]), min(lo[1], hi[1]), min(lo[2], hi[2])),
+			(max(lo[0], hi[0]), max(lo[1], hi[1]), max(lo[2], hi[2])),
+		)
+	
+	def queryBounds(self, lo, hi):
+		"""
+		Find the indices of boxes that could intersect the region from lo to hi,
+		in the order they are in the segment.
+		"""
+		
+		ranges = self.cellRanges(lo, hi)
+		
+		result = set(self.large)
+		
+		for x in ranges[0]:
+			for y in ranges[1]:
+				for z in ranges[2]:
+					result.update(self.cells.get((x, y, z), ()))
+		
+		return sorted(result)
+
+class LightIndex:
+	"""
+	The boxes that give off light, and a grid for finding the ones that are
+	close enough to a point to light it by more than the cutoff.
+	
+	A light adds at most (light colour * point colour * glow * 0.01) / (d - r)^2
+	to a colour channel, where d is the distance to the light and r is its
+	size. So with the brightest channels of both colours, it can be skipped
+	when d is more than r + sqrt(brightest * glow * 0.01 / cutoff).
+	"""
+	
+	# With fewer lights than this, checking all of them is quicker than using
+	# the grid
+	MIN_LIGHTS_FOR_GRID = 8
+	
+	def __init__(self, boxes, cutoff):
+		# In the same order as in the segment, since that is the order the light
+		# is added up in
+		self.lights = [box for box in boxes if box.glow != 0.0]
+		self.culling = bool(cutoff and self.lights)
+		self.cells = None
+		
+		# Without a cutoff every light is always used
+		self.everything = [(light, math.inf) for light in self.lights]
+		
+		if (not self.culling):
+			return
+		
+		# How far past its size each light reaches for a point colour of 1.0
+		self.sizes = [max(abs(light.size.x), abs(light.size.y), abs(light.size.z)) for light in self.lights]
+		self.reaches = [math.sqrt(max(abs(c) for color in light.color for c in color.asTuple()) * abs(light.glow) * 0.01 / cutoff) for light in self.lights]
+		self.max_reach = max(self.reaches)
+		
+		if (len(self.lights) < self.MIN_LIGHTS_FOR_GRID):
+			return
+		
+		# Each light goes in the cells its box covers, queries then look as far
+		# out as the lights can reach
+		self.cell_size = max(self.max_reach, 1.0)
+		self.cells = {}
+		
+		for i, light in enumerate(self.lights):
+			size = self.sizes[i]
+			
+			for x in self.cellRange(light.pos.x - size, light.pos.x + size):
+				for y in self.cellRange(light.pos.y - size, light.pos.y + size):
+					for z in self.cellRange(light.pos.z - size, light.pos.z + size):
+						self.cells.setdefault((x, y, z), []).append(i)
+	
+	def cellRange(self, lo, hi):
+		return range(math.floor(lo / self.cell_size), math.floor(hi / self.cell_size) + 1)
+	
+	def near(self, point, brightness):
+		"""
+		Find the lights that might light up a point with the given brightest
+		colour channel by more than the cutoff, in segment order.
+		
+		Returns list of (light box, distance past which it can be skipped)
+		"""
+		
+		if (not self.culling):
+			return self.everything
+		
+		scale = math.sqrt(brightness)
+		
+		if (self.cells == None):
+			found = range(len(self.lights))
+		else:
+			# A little bit of extra room so rounding can't cause a light to be
+			# missed
+			reach = self.max_reach * scale * 1.000001 + 0.000001
+			found = set()
+			
+			for x in self.cellRange(point.x - reach, point.x + reach):
+				for y in self.cellRange(point.y - reach, point.y + reach):
+					for z in self.cellRange(point.z - reach, point.z + reach):
+						found.update(self.cells.get((x, y, z), ()))
+			
+			found = sorted(found)
+		
+		return [(self.lights[i], self.sizes[i] + self.reaches[i] * scale) for i in found]
 
 class Quad:
 	"""
 	Representation of a quadrelaterial (a shape with four sides)
 	"""
 	
-	def __init__(self, p1, p2, p3, p4, color, tile, tileRot, seg, normal, gradient):
+	__slots__ = ("p1", "p2", "p3", "p4", "color", "tile", "tileRot", "seg", "normal", "gradient", "occlusion")
+	
+	def __init__(self, p1, p2, p3, p4, color, tile, tileRot, seg, normal, gradient, occlusion = None):
 		self.p1 = p1
 		self.p2 = p2
 		self.p3 = p3
@@ -300,6 +837,7 @@ class Quad:
 		self.seg = seg
 		self.normal = normal
 		self.gradient = gradient
+		self.occlusion = occlusion
 	
 	def __format__(self, _unused):
 		return f"{{ {self.p1} {self.p2} {self.p3} {self.p4} }}"
@@ -312,173 +850,491 @@ class Quad:
 		Returns tuple of (vertex bytes, index bytes, number of vertexes, number of indicies)
 		"""
 		
-		p1, p2, p3, p4, col, gc, normal, gradient = self.p1, self.p2, self.p3, self.p4, self.color, self.seg, self.normal, self.gradient
-		tex = getTextureCoords(TILE_ROWS, TILE_COLS, TILE_BITE_ROW, TILE_BITE_COL, self.tileRot, self.tile)
+		vertexes = bytearray(4 * MESH_VERTEX_STRUCT.size)
+		indexes = bytearray(MESH_QUAD_INDEX_STRUCT.size)
 		
-		vertexes = bytearray()
-		vertexes += meshPointBytes(p1.x, p1.y, p1.z, tex[0][0], tex[0][1], col.x, col.y, col.z, col.a if hasattr(col, "a") else 1, gc, normal, gradient)
-		vertexes += meshPointBytes(p2.x, p2.y, p2.z, tex[1][0], tex[1][1], col.x, col.y, col.z, col.a if hasattr(col, "a") else 1, gc, normal, gradient)
-		vertexes += meshPointBytes(p3.x, p3.y, p3.z, tex[2][0], tex[2][1], col.x, col.y, col.z, col.a if hasattr(col, "a") else 1, gc, normal, gradient)
-		vertexes += meshPointBytes(p4.x, p4.y, p4.z, tex[3][0], tex[3][1], col.x, col.y, col.z, col.a if hasattr(col, "a") else 1, gc, normal, gradient)
+		self.packInto(vertexes, 0, indexes, 0, offset)
 		
-		index = [offset + 0, offset + 1, offset + 2, offset + 0, offset + 2, offset + 3]
+		return (vertexes, indexes, 4, 6)
+	
+	def packInto(self, vertexes, vertex_pos, indexes, index_pos, offset = 0, colors = None, color_pos = 0):
+		"""
+		Write the quad's four vertices and six indices into existing buffers at
+		the given byte positions. Offset is the current count of verticies in
+		the mesh file.
 		
-		# Swap winding order in some situations so triangles don't get culled
-		if ((p1.x == p3.x and p1.x > 0) or (p1.y == p3.y and p1.y <= 1)):
-			index[0], index[2] = index[2], index[0]
-			index[3], index[5] = index[5], index[3]
+		colors can be a list from quadVertexColors, in which case the colours of
+		the vertices are taken from it starting at color_pos instead of being
+		worked out here.
+		"""
 		
-		indexes = bytearray()
-		indexes += meshIndexBytes(index[0], index[1], index[2])
-		indexes += meshIndexBytes(index[3], index[4], index[5])
+		p1, p2, p3, p4, col, gc, normal, gradient, occlusion = self.p1, self.p2, self.p3, self.p4, self.color, self.seg, self.normal, self.gradient, self.occlusion
+		settings = gc.settings
+		tex = getTextureCoords(settings.TILE_ROWS, settings.TILE_COLS, settings.TILE_BITE_ROW, settings.TILE_BITE_COL, self.tileRot, self.tile)
+		a = col.a if hasattr(col, "a") else 1
+		size = MESH_VERTEX_STRUCT.size
 		
-		return (vertexes, indexes, 4, 6)
+		if (colors != None):
+			c1, c2, c3, c4 = colors[color_pos], colors[color_pos + 1], colors[color_pos + 2], colors[color_pos + 3]
+			meshVertexPackInto(vertexes, vertex_pos, p1.x, p1.y, p1.z, tex[0][0], tex[0][1], *c1)
+			meshVertexPackInto(vertexes, vertex_pos + size, p2.x, p2.y, p2.z, tex[1][0], tex[1][1], *c2)
+			meshVertexPackInto(vertexes, vertex_pos + 2 * size, p3.x, p3.y, p3.z, tex[2][0], tex[2][1], *c3)
+			meshVertexPackInto(vertexes, vertex_pos + 3 * size, p4.x, p4.y, p4.z, tex[3][0], tex[3][1], *c4)
+		else:
+			meshPointPackInto(vertexes, vertex_pos, p1.x, p1.y, p1.z, tex[0][0], tex[0][1], col.x, col.y, col.z, a, gc, normal, gradient, occlusion)
+			meshPointPackInto(vertexes, vertex_pos + size, p2.x, p2.y, p2.z, tex[1][0], tex[1][1], col.x, col.y, col.z, a, gc, normal, gradient, occlusion)
+			meshPointPackInto(vertexes, vertex_pos + 2 * size, p3.x, p3.y, p3.z, tex[2][0], tex[2][1], col.x, col.y, col.z, a, gc, normal, gradient, occlusion)
+			meshPointPackInto(vertexes, vertex_pos + 3 * size, p4.x, p4.y, p4.z, tex[3][0], tex[3][1], col.x, col.y, col.z, a, gc, normal, gradient, occlusion)
+		
+		# Swap winding order in some situations so triangles don't get culled
+		if ((p1.x == p3.x and p1.x > 0) or (p1.y == p3.y and p1.y <= 1)):
+			MESH_QUAD_INDEX_STRUCT.pack_into(indexes, index_pos, offset + 2, offset + 1, offset + 0, offset + 3, offset + 2, offset + 0)
+		else:
+			MESH_QUAD_INDEX_STRUCT.pack_into(indexes, index_pos, offset + 0, offset + 1, offset + 2, offset + 0, offset + 2, offset + 3)
 
-class Box:
+class Face:
 	"""
-	Very simple container for box data
+	One side of a box that will be subdivided into tiles. The corners are
+	relative to the box, offset is where the box actually is.
 	"""
 	
-	def __init__(self, seg, pos, size, color = [Vector3(1.0, 1.0, 1.0), Vector3(1.0, 1.0, 1.0), Vector3(1.0, 1.0, 1.0)], tile = (0, 0, 0), tileSize = (1.0, 1.0, 1.0), tileRot = (0, 0, 0), glow = 0.0, gradient = None):
+	__slots__ = ("minest", "maxest", "s_size", "t_size", "color", "tile", "tileRot", "normal", "gradient", "offset", "occluders")
+	
+	def __init__(self, minest, maxest, s_size, t_size, color, tile, tileRot, normal, gradient, offset):
+		self.minest = minest
+		self.maxest = maxest
+		self.s_size = s_size
+		self.t_size = t_size
+		self.color = color
+		self.tile = tile
+		self.tileRot = tileRot
+		self.normal = normal
+		self.gradient = gradient
+		self.offset = offset
+		
+		# Bounds of boxes that partly cover this face, see Box.cullHiddenFaces
+		self.occluders = []
+	
+	def getAxis(self):
 		"""
-		seg: global segment context
-		pos: position
-		size: size of the box
-		color: list or tuple of the face colors of the box
-		tile: list or tuple of tiles to use
-		tileSize: size of the box tiles
-		tileRot: rotation of the boxes
-		glow: The power of the light (when using lighting extensions)
+		Get the axis that the face is flat on
 		"""
 		
-		# Expand shorthands for vectors
-		if (type(color) == Vector3):
-			color = [color]
+		return [getattr(self.minest, a) == getattr(self.maxest, a) for a in ['x', 'y', 'z']].index(True)
+	
+	def getBounds(self):
+		"""
+		Get the (min, max) corners of the face in segment coordinates
+		"""
 		
-		if (len(color) == 1):
-			color = [color[0], color[0], color[0]]
+		a = (self.minest + self.offset).asTuple()
+		b = (self.maxest + self.offset).asTuple()
 		
-		# Set attributes
-		self.segment_info = seg
-		self.pos = pos
-		self.size = size
-		self.color = color
-		self.tile = tile
-		self.tileSize = tileSize
-		self.tileRot = tileRot
-		self.glow = glow
-		self.gradient = gradient
+		return (tuple(min(a[i], b[i]) for i in range(3)), tuple(max(a[i], b[i]) for i in range(3)))
 	
-	def bakeGeometry(self):
+	def countQuads(self):
 		"""
-		Convert the box to the split geometry. This is also where a lot of
-		fixes occur, like setting the tile index per face and fixing tile
-		rotation per side.
+		Count how many quads the face will be split into
 		"""
 		
-		# Tip: When reading this section it helps to draw a diagram of what is
-		# happening.
+		ax_e = self.getAxis()
+		ax_s, ax_t = [a for a in range(3) if a != ax_e]
+		lo, hi = self.minest.asTuple(), self.maxest.asTuple()
 		
-		# Shorthands
-		pos, tileSize, color, tile, seg, tileRot = self.pos, self.tileSize, self.color, self.tile, self.segment_info, self.tileRot
+		s_count = len(getTileSteps(min(lo[ax_s], hi[ax_s]), max(lo[ax_s], hi[ax_s]), self.s_size)[0])
+		t_count = len(getTileSteps(min(lo[ax_t], hi[ax_t]), max(lo[ax_t], hi[ax_t]), self.t_size)[0])
 		
-		# Get the eight points (verticies) of the cube
-		p1 = self.size.partialOpposite(False, False, False)
-		p2 = self.size.partialOpposite(False, False, True )
-		p3 = self.size.partialOpposite(False, True , True )
-		p4 = self.size.partialOpposite(False, True , False)
-		p5 = self.size.partialOpposite(True , False, False)
-		p6 = self.size.partialOpposite(True , False, True )
-		p7 = self.size.partialOpposite(True , True , True )
-		p8 = self.size.partialOpposite(True , True , False)
+		return s_count * t_count
+	
+	def getTiles(self):
+		"""
+		Get the set of tiles the face will be split into, as tuples of (e, s
+		min, s max, t min, t max) in segment coordinates. These are worked out
+		the same way as the corners of the quads from subdivide, so two faces
+		with the same tiles make exactly the same quads.
+		"""
 		
-		# Compute the quads (note the min/max don't matter so long as its a square)
-		# Only some are baked based on config settings
-		quads = []
+		ax_e = self.getAxis()
+		ax_s, ax_t = [a for a in range(3) if a != ax_e]
+		lo, hi, offset = self.minest.asTuple(), self.maxest.asTuple(), self.offset.asTuple()
 		
-		# Right
-		if (BAKE_UNSEEN_FACES or pos.x < 0.0):
-			quads += generateSubdividedFaceGeometry(
-				p1, p3,
-				tileSize[2], tileSize[2],
-				color[0].withLight(seg.right),
-				tile[0],
-				(tileRot[0] + 1) % 4,
-				seg,
-				Vector3(1.0, 0.0, 0.0),
-				self.gradient
-			)
+		s_starts, s_lengths = getTileSteps(min(lo[ax_s], hi[ax_s]), max(lo[ax_s], hi[ax_s]), self.s_size)
+		t_starts, t_lengths = getTileSteps(min(lo[ax_t], hi[ax_t]), max(lo[ax_t], hi[ax_t]), self.t_size)
 		
-		# Left
-		if (BAKE_UNSEEN_FACES or pos.x > 0.0):
-			quads += generateSubdividedFaceGeometry(
-				p5, p7,
-				tileSize[2], tileSize[2],
-				color[0].withLight(seg.left),
-				tile[0],
-				(tileRot[0] + 1) % 4,
-				seg,
-				Vector3(-1.0, 0.0, 0.0),
-				self.gradient
-			)
+		e = lo[ax_e] + offset[ax_e]
+		s_tiles = [(s + offset[ax_s], (s + l) + offset[ax_s]) for s, l in zip(s_starts, s_lengths)]
+		t_tiles = [(t + offset[ax_t], (t + l) + offset[ax_t]) for t, l in zip(t_starts, t_lengths)]
 		
-		# Top
-		if (BAKE_UNSEEN_FACES or pos.y < 1.0):
-			quads += generateSubdividedFaceGeometry(
+		return {(e, *s_tile, *t_tile) for s_tile in s_tiles for t_tile in t_tiles}
+	
+	def getMergeKey(self):
+		"""
+		Get a tuple that is the same for faces that are on the same plane and
+		look the same, or None if the face can't be merged with other faces
+		"""
+		
+		ax_e = self.getAxis()
+		
+		# Partly hidden faces and degenerate faces of flat boxes are left alone
+		if (self.occluders or self.normal.asTuple()[ax_e] == 0.0):
+			return None
+		
+		return (
+			ax_e,
+			self.minest.asTuple()[ax_e] + self.offset.asTuple()[ax_e],
+			self.normal.asTuple(),
+			(self.color.x, self.color.y, self.color.z, self.color.a),
+			self.tile,
+			self.tileRot,
+			self.s_size,
+			self.t_size,
+			tuple(self.gradient) if self.gradient else None,
+		)
+	
+	def isQuadHidden(self, p1, p3):
+		"""
+		Check if the quad with opposite corners p1 and p3 (in segment
+		coordinates) is completely inside one of the occluders
+		"""
+		
+		p1, p3 = p1.asTuple(), p3.asTuple()
+		
+		for lo, hi in self.occluders:
+			if (all(lo[a] <= min(p1[a], p3[a]) and max(p1[a], p3[a]) <= hi[a] for a in range(3))):
+				return True
+		
+		return False
+	
+	def subdivide(self, seg):
+		"""
+		Split the face into tile quads, in segment coordinates
+		"""
+		
+		with profileTimer("subdivide"):
+			quads = generateSubdividedFaceGeometry(self.minest, self.maxest, self.s_size, self.t_size, self.color, self.tile, self.tileRot, seg, self.normal, self.gradient)
+		
+		# Translation transform, done in place since the points are new
+		ox, oy, oz = self.offset.x, self.offset.y, self.offset.z
+		
+		for q in quads:
+			for p in (q.p1, q.p2, q.p3, q.p4):
+				p.x = p.x + ox
+				p.y = p.y + oy
+				p.z = p.z + oz
+		
+		# Remove tiles that are covered by other boxes
+		if (self.occluders):
+			count = len(quads)
+			quads = [q for q in quads if not self.isQuadHidden(q.p1, q.p3)]
+			seg.culled_quads += count - len(quads)
+		
+		# All of the tiles share the ambient occlusion for the face
+		if (seg.settings.ABMIENT_OCCLUSION_ENABLED and seg.settings.ABMIENT_OCCLUSION_PER_FACE and quads):
+			occlusion = FaceOcclusion(seg, *self.getBounds(), self.normal)
+			
+			for q in quads:
+				q.occlusion = occlusion
+		
+		return quads
+
+class FaceOcclusion:
+	"""
+	Ambient occlusion for the vertices of one face. The boxes that could be
+	near any vertex of the face are found once, and each corner is only
+	computed once even though up to four tiles share it. The result is exactly
+	the same as doAmbientOcclusion.
+	"""
+	
+	__slots__ = ("boxes", "normal", "delta", "values")
+	
+	def __init__(self, seg, lo, hi, normal):
+		d = seg.settings.ABMIENT_OCCLUSION_DELTA_BOX_SIZE
+		
+		# Region covered by the delta boxes of every vertex on the face, with
+		# a little extra in case a tile corner rounds to just outside of the
+		# face. Extra boxes don't change anything since they don't intersect.
+		margin = d + 0.001
+		lo = tuple(lo[a] + d * n - margin for a, n in enumerate(normal.asTuple()))
+		hi = tuple(hi[a] + d * n + margin for a, n in enumerate(normal.asTuple()))
+		
+		# Boxes stay in segment order so the volumes are added up in the same
+		# order as boxcast
+		if (seg.settings.ABMIENT_OCCLUSION_USE_GRID and seg.grid):
+			self.boxes = [seg.boxes[i] for i in seg.grid.queryBounds(lo, hi)]
+		else:
+			self.boxes = seg.boxes
+		
+		self.normal = normal
+		self.delta = d
+		self.values = {}
+	
+	def sample(self, x, y, z, a):
+		"""
+		Get the ambient occlusion for a vertex on the face
+		"""
+		
+		key = (x, y, z, a)
+		value = self.values.get(key, None)
+		
+		if (value != None):
+			return value
+		
+		d = self.delta
+		normal = self.normal
+		px, py, pz = x + d * normal.x, y + d * normal.y, z + d * normal.z
+		
+		total = 0.0
+		intersected = 0
+		
+		for b in self.boxes:
+			volume = b.overlapVolume(px, py, pz, d, d, d)
+			
+			if (volume != None):
+				intersected += 1
+				total += volume
+		
+		profile = gBakeThread.profile
+		
+		if (profile):
+			profile.count("boxcast_tests", len(self.boxes))
+			profile.count("boxcast_hits", intersected)
+		
+		value = ambientOcclusionShade(total, a, d)
+		self.values[key] = value
+		
+		return value
+
+class Box:
+	"""
+	Very simple container for box data
+	"""
+	
+	__slots__ = ("segment_info", "pos", "size", "color", "tile", "tileSize", "tileRot", "glow", "gradient")
+	
+	def __init__(self, seg, pos, size, color = [Vector3(1.0, 1.0, 1.0), Vector3(1.0, 1.0, 1.0), Vector3(1.0, 1.0, 1.0)], tile = (0, 0, 0), tileSize = (1.0, 1.0, 1.0), tileRot = (0, 0, 0), glow = 0.0, gradient = None):
+		"""
+		seg: global segment context
+		pos: position
+		size: size of the box
+		color: list or tuple of the face colors of the box
+		tile: list or tuple of tiles to use
+		tileSize: size of the box tiles
+		tileRot: rotation of the boxes
+		glow: The power of the light (when using lighting extensions)
+		"""
+		
+		# Expand shorthands for vectors
+		if (type(color) == Vector3):
+			color = [color]
+		
+		if (len(color) == 1):
+			color = [color[0], color[0], color[0]]
+		
+		# Set attributes
+		self.segment_info = seg
+		self.pos = pos
+		self.size = size
+		self.color = color
+		self.tile = tile
+		self.tileSize = tileSize
+		self.tileRot = tileRot
+		self.glow = glow
+		self.gradient = gradient
+	
+	def bakeFaces(self):
+		"""
+		Find the faces of the box that should be baked. This is also where a lot
+		of fixes occur, like setting the tile index per face and fixing tile
+		rotation per side.
+		"""
+		
+		# Tip: When reading this section it helps to draw a diagram of what is
+		# happening.
+		
+		# Shorthands
+		pos, tileSize, color, tile, seg, tileRot = self.pos, self.tileSize, self.color, self.tile, self.segment_info, self.tileRot
+		unseen = seg.settings.BAKE_UNSEEN_FACES
+		
+		# Get the eight points (verticies) of the cube
+		p1 = self.size.partialOpposite(False, False, False)
+		p2 = self.size.partialOpposite(False, False, True )
+		p3 = self.size.partialOpposite(False, True , True )
+		p4 = self.size.partialOpposite(False, True , False)
+		p5 = self.size.partialOpposite(True , False, False)
+		p6 = self.size.partialOpposite(True , False, True )
+		p7 = self.size.partialOpposite(True , True , True )
+		p8 = self.size.partialOpposite(True , True , False)
+		
+		# Compute the faces (note the min/max don't matter so long as its a square)
+		# Only some are baked based on config settings
+		faces = []
+		
+		# Right
+		if (unseen or pos.x < 0.0):
+			faces.append(Face(
+				p1, p3,
+				tileSize[2], tileSize[2],
+				color[0].withLight(seg.right),
+				tile[0],
+				(tileRot[0] + 1) % 4,
+				Vector3(1.0, 0.0, 0.0),
+				self.gradient,
+				pos
+			))
+		
+		# Left
+		if (unseen or pos.x > 0.0):
+			faces.append(Face(
+				p5, p7,
+				tileSize[2], tileSize[2],
+				color[0].withLight(seg.left),
+				tile[0],
+				(tileRot[0] + 1) % 4,
+				Vector3(-1.0, 0.0, 0.0),
+				self.gradient,
+				pos
+			))
+		
+		# Top
+		if (unseen or pos.y < 1.0):
+			faces.append(Face(
 				p1, p6,
 				tileSize[1], tileSize[1],
 				color[1].withLight(seg.top),
 				tile[1],
 				(tileRot[1] + 2) % 4,
-				seg,
 				Vector3(0.0, 1.0, 0.0),
-				self.gradient
-			)
+				self.gradient,
+				pos
+			))
 		
 		# Bottom
-		if (BAKE_UNSEEN_FACES or pos.y > 1.0):
-			quads += generateSubdividedFaceGeometry(
+		if (unseen or pos.y > 1.0):
+			faces.append(Face(
 				p4, p7,
 				tileSize[1], tileSize[1],
 				color[1].withLight(seg.bottom),
 				tile[1],
 				(tileRot[1] + 2) % 4,
-				seg,
 				Vector3(0.0, -1.0, 0.0),
-				self.gradient
-			)
+				self.gradient,
+				pos
+			))
 		
 		# Front
-		quads += generateSubdividedFaceGeometry(
+		faces.append(Face(
 			p1, p8,
 			tileSize[0], tileSize[0],
 			color[2].withLight(seg.front),
 			tile[2],
 			tileRot[2],
-			seg, 
 			Vector3(0.0, 0.0, 1.0),
-			self.gradient
-		)
+			self.gradient,
+			pos
+		))
 		
 		# Back
-		if (BAKE_UNSEEN_FACES):
-			quads += generateSubdividedFaceGeometry(
+		if (unseen):
+			faces.append(Face(
 				p2, p7,
 				tileSize[0], tileSize[0],
 				color[2].withLight(seg.back),
 				tile[2],
 				tileRot[2],
-				seg,
 				Vector3(0.0, 0.0, -1.0),
-				self.gradient
-			)
+				self.gradient,
+				pos
+			))
 		
-		# Translation transform
-		for q in quads:
-			q.p1 += self.pos
-			q.p2 += self.pos
-			q.p3 += self.pos
-			q.p4 += self.pos
+		if (seg.settings.CULL_HIDDEN_FACES):
+			faces = self.cullHiddenFaces(faces)
+		
+		return faces
+	
+	def getKey(self):
+		"""
+		Get a tuple of everything about the box that changes how it looks
+		"""
+		
+		return (
+			self.pos.asTuple(),
+			self.size.asTuple(),
+			tuple((c.x, c.y, c.z, c.a) for c in self.color),
+			tuple(self.tile),
+			tuple(self.tileSize),
+			tuple(self.tileRot),
+			self.glow,
+			tuple(self.gradient) if self.gradient else None,
+		)
+	
+	def getBounds(self):
+		"""
+		Get the (min, max) corners of the box
+		"""
+		
+		lo = (self.pos - self.size).asTuple()
+		hi = (self.pos + self.size).asTuple()
+		
+		return (tuple(min(lo[i], hi[i]) for i in range(3)), tuple(max(lo[i], hi[i]) for i in range(3)))
+	
+	def cullHiddenFaces(self, faces):
+		"""
+		Remove faces that are completely covered by another box, and remember
+		which boxes cover part of the other faces so the covered tiles can be
+		skipped when they are subdivided.
+		"""
+		
+		seg = self.segment_info
+		
+		# Boxes that touch or overlap this one
+		others = [seg.boxes[i] for i in seg.grid.query(self.pos, self.size)] if seg.grid else seg.boxes
+		others = [b.getBounds() for b in others if b is not self]
+		
+		result = []
+		
+		for face in faces:
+			ax_e = face.getAxis()
+			normal = face.normal.asTuple()
+			
+			# Degenerate faces of flat boxes might not be flat on the axis of
+			# their normal, so just leave them alone
+			if (normal[ax_e] == 0.0):
+				result.append(face)
+				continue
+			
+			lo, hi = face.getBounds()
+			plane = lo[ax_e]
+			
+			for o_lo, o_hi in others:
+				# The other box has to be right on the outside of the face
+				if (normal[ax_e] > 0.0 and not (o_lo[ax_e] <= plane < o_hi[ax_e])): continue
+				if (normal[ax_e] < 0.0 and not (o_lo[ax_e] < plane <= o_hi[ax_e])): continue
+				
+				# ... and overlap it on the other axes
+				if (any(o_hi[a] <= lo[a] or hi[a] <= o_lo[a] for a in range(3) if a != ax_e)):
+					continue
+				
+				# Covers all of the face
+				if (all(o_lo[a] <= lo[a] and hi[a] <= o_hi[a] for a in range(3) if a != ax_e)):
+					seg.culled_quads += face.countQuads()
+					break
+				
+				face.occluders.append((o_lo, o_hi))
+			else:
+				result.append(face)
+		
+		return result
+	
+	def bakeGeometry(self):
+		"""
+		Convert the box to the split geometry.
+		"""
+		
+		quads = []
+		
+		with profileTimer("geometry"):
+			for face in self.bakeFaces():
+				quads += face.subdivide(self.segment_info)
 		
 		return quads
 	
@@ -532,96 +1388,253 @@ class Box:
 		testAABB but optimised for boxcast
 		"""
 		
-		def test_aabb_axis(a_min, a_max, b_min, b_max):
-			"""
-			Test a single aabb axis returning the midpoint and half-difference
-			of two values
-			
-			2023-08-30: I forget what the fuck "half-difference" means, I think
-			I meant "half of the length of the intersection"
-			
-			optimised version is regular diff
-			"""
-			
-			if (a_min > a_max):
-				a_min, a_max = a_max, a_min
-			
-			if (b_min > b_max):
-				b_min, b_max = b_max, b_min
-			
-			if (a_max >= b_min and b_max >= a_min):
-				return min(a_max, b_max) - max(a_min, b_min)
-			else:
-				return None
-		
-		########################################################################
-		
 		# 2023-08-30: Did some optimisation by only computing these in a short
 		# curcit style. Maybe it would be nice to find which order of these is
 		# optimal for most cases.
-		x = test_aabb_axis(self.pos.x - self.size.x, self.pos.x + self.size.x, other_pos.x - other_size.x, other_pos.x + other_size.x)
+		x = testAABBAxisDiff(self.pos.x - self.size.x, self.pos.x + self.size.x, other_pos.x - other_size.x, other_pos.x + other_size.x)
 		
 		if (x != None):
-			y = test_aabb_axis(self.pos.y - self.size.y, self.pos.y + self.size.y, other_pos.y - other_size.y, other_pos.y + other_size.y)
+			y = testAABBAxisDiff(self.pos.y - self.size.y, self.pos.y + self.size.y, other_pos.y - other_size.y, other_pos.y + other_size.y)
 			
 			if (y != None):
-				z = test_aabb_axis(self.pos.z - self.size.z, self.pos.z + self.size.z, other_pos.z - other_size.z, other_pos.z + other_size.z)
+				z = testAABBAxisDiff(self.pos.z - self.size.z, self.pos.z + self.size.z, other_pos.z - other_size.z, other_pos.z + other_size.z)
 				
 				if (z != None):
 					#       Origin                     Size
 					return (None, Vector3(0.5 * x, 0.5 * y, 0.5 * z))
 		
 		return None
+	
+	def overlapVolume(self, px, py, pz, sx, sy, sz):
+		"""
+		Same as the volume of the intersection from testAABB_optimisedBC, but
+		takes plain floats and doesn't make any vectors. Returns None if the
+		boxes don't intersect.
+		"""
+		
+		pos, size = self.pos, self.size
+		
+		x = testAABBAxisDiff(pos.x - size.x, pos.x + size.x, px - sx, px + sx)
+		
+		if (x == None):
+			return None
+		
+		y = testAABBAxisDiff(pos.y - size.y, pos.y + size.y, py - sy, py + sy)
+		
+		if (y == None):
+			return None
+		
+		z = testAABBAxisDiff(pos.z - size.z, pos.z + size.z, pz - sz, pz + sz)
+		
+		if (z == None):
+			return None
+		
+		return (2.0 * (0.5 * x)) * (2.0 * (0.5 * y)) * (2.0 * (0.5 * z))
 
-def parseGradient(pos, size, gradient):
+def testAABBAxisDiff(a_min, a_max, b_min, b_max):
 	"""
-	Parse a gradient to the standard 12 length float list
+	Test a single aabb axis returning the midpoint and half-difference
+	of two values
+	
+	2023-08-30: I forget what the fuck "half-difference" means, I think
+	I meant "half of the length of the intersection"
+	
+	optimised version is regular diff
 	"""
 	
-	if (not gradient):
-		return []
-	elif (gradient.startswith('A ')):
-		return [float(x) for x in gradient[2:].split()]
+	if (a_min > a_max):
+		a_min, a_max = a_max, a_min
+	
+	if (b_min > b_max):
+		b_min, b_max = b_max, b_min
+	
+	if (a_max >= b_min and b_max >= a_min):
+		return min(a_max, b_max) - max(a_min, b_min)
 	else:
-		gradient = [float(x) for x in gradient.split()]
-		
-		# Convert first point to absolute coords
-		gradient[0] = pos.x + (size.x * gradient[0])
-		gradient[1] = pos.y + (size.y * gradient[1])
-		gradient[2] = pos.z + (size.z * gradient[2])
-		
-		# Convert second point to absolute coords
-		gradient[3] = pos.x + (size.x * gradient[3])
-		gradient[4] = pos.y + (size.y * gradient[4])
-		gradient[5] = pos.z + (size.z * gradient[5])
+		return None
+
+def mergeCoplanarFaces(faces):
+	"""
+	Merge faces that are on the same plane, look the same and touch or overlap
+	into bigger faces, see MERGE_COPLANAR_FACES.
+	
+	Since every tile gets the whole tile texture, merging two faces that only
+	touch gives the same number of quads. Faces that overlap have some tiles in
+	common though, and those are only baked once after merging.
+	
+	Returns the new list of faces
+	"""
+	
+	# Faces that can be merged with each other, the others are kept in the
+	# same order
+	groups = {}
+	order = []
+	
+	for face in faces:
+		key = face.getMergeKey()
 		
-		return gradient
+		if (key == None):
+			order.append((face, None))
+		elif (key in groups):
+			groups[key].append(face)
+		else:
+			groups[key] = [face]
+			order.append((None, key))
+	
+	result = []
+	saved_quads = 0
+	
+	for face, key in order:
+		if (face):
+			result.append(face)
+		elif (len(groups[key]) == 1):
+			result += groups[key]
+		else:
+			merged, saved = mergeFaceGroup(groups[key])
+			result += merged
+			saved_quads += saved
+	
+	log(f"Merged {len(faces)} faces into {len(result)}, {saved_quads} fewer quads")
+	
+	profile = gBakeThread.profile
+	
+	if (profile):
+		profile.count("merged_faces", len(faces) - len(result))
+		profile.count("merged_quads", saved_quads)
+	
+	return result
 
-def parseSegmentXML(data, templates = {}):
+def mergeFaceGroup(faces):
 	"""
-	Parse a segment string for its boxes, and resolve any templates if they are
-	given.
+	Merge a list of faces that all have the same merge key, first along the s
+	axis and then along the t axis until nothing else can be merged.
+	
+	Returns tuple of (merged faces, number of quads saved)
 	"""
 	
-	root = et.fromstring(data)
-	boxes = []
+	first = faces[0]
+	ax_e = first.getAxis()
+	ax_s, ax_t = [a for a in range(3) if a != ax_e]
 	
-	if (root.tag != "segment"):
-		return None
+	# (s min, s max, t min, t max, tiles, face) in segment coordinates
+	rects = []
 	
-	seg = SegmentInfo(root.attrib, templates, boxes)
+	for face in faces:
+		lo, hi = face.getBounds()
+		rects.append((lo[ax_s], hi[ax_s], lo[ax_t], hi[ax_t], face.getTiles(), face))
 	
-	# Create a box for each box in the segment
-	for e in root:
-		if (e.tag == "box"):
-			a = e.attrib
-			t = a.get("template", None)
-			
-			if (getFromTemplate(a, templates, t, "visible", "1") != "0"):
-				# Get properties
-				
-				# Position -- x y z
-				pos = Vector3.fromString(getFromTemplate(a, templates, t, "pos", "0 0 0"))
+	before = sum(len(r[4]) for r in rects)
+	
+	def tryMerge(a, b):
+		"""
+		Merge two rects if the merged face has exactly the tiles of both
+		"""
+		
+		s_min, s_max, t_min, t_max = min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])
+		
+		minest = Vector3()
+		setattr(minest, "xyz"[ax_e], first.minest.asTuple()[ax_e] + first.offset.asTuple()[ax_e])
+		setattr(minest, "xyz"[ax_s], s_min)
+		setattr(minest, "xyz"[ax_t], t_min)
+		
+		maxest = minest.copy()
+		setattr(maxest, "xyz"[ax_s], s_max)
+		setattr(maxest, "xyz"[ax_t], t_max)
+		
+		face = Face(minest, maxest, first.s_size, first.t_size, first.color, first.tile, first.tileRot, first.normal, first.gradient, Vector3(0.0, 0.0, 0.0))
+		tiles = face.getTiles()
+		
+		if (tiles != a[4] | b[4]):
+			return None
+		
+		return (s_min, s_max, t_min, t_max, tiles, face)
+	
+	def mergePass(rects, along_s):
+		"""
+		Merge neighbouring rects along one axis, returns the new rects
+		"""
+		
+		if (along_s):
+			rects = sorted(rects, key = lambda r: (r[2], r[3], r[0], r[1]))
+		else:
+			rects = sorted(rects, key = lambda r: (r[0], r[1], r[2], r[3]))
+		
+		result = [rects[0]]
+		
+		for rect in rects[1:]:
+			last = result[-1]
+			merged = None
+			
+			if (along_s and last[2] == rect[2] and last[3] == rect[3] and rect[0] <= last[1]):
+				merged = tryMerge(last, rect)
+			elif (not along_s and last[0] == rect[0] and last[1] == rect[1] and rect[2] <= last[3]):
+				merged = tryMerge(last, rect)
+			
+			if (merged):
+				result[-1] = merged
+			else:
+				result.append(rect)
+		
+		return result
+	
+	count = None
+	
+	while (count != len(rects)):
+		count = len(rects)
+		rects = mergePass(mergePass(rects, True), False)
+	
+	return ([r[5] for r in rects], before - sum(len(r[4]) for r in rects))
+
+def parseGradient(pos, size, gradient):
+	"""
+	Parse a gradient to the standard 12 length float list
+	"""
+	
+	if (not gradient):
+		return []
+	elif (gradient.startswith('A ')):
+		return [float(x) for x in gradient[2:].split()]
+	else:
+		gradient = [float(x) for x in gradient.split()]
+		
+		# Convert first point to absolute coords
+		gradient[0] = pos.x + (size.x * gradient[0])
+		gradient[1] = pos.y + (size.y * gradient[1])
+		gradient[2] = pos.z + (size.z * gradient[2])
+		
+		# Convert second point to absolute coords
+		gradient[3] = pos.x + (size.x * gradient[3])
+		gradient[4] = pos.y + (size.y * gradient[4])
+		gradient[5] = pos.z + (size.z * gradient[5])
+		
+		return gradient
+
+def parseSegmentXML(data, templates = {}, settings = None):
+	"""
+	Parse a segment string for its boxes, and resolve any templates if they are
+	given. settings is the BakeSettings (or a dict of settings) the segment
+	will be baked with, or None for the defaults.
+	"""
+	
+	root = et.fromstring(data)
+	boxes = []
+	
+	if (root.tag != "segment"):
+		return None
+	
+	seg = SegmentInfo(root.attrib, templates, boxes, settings)
+	
+	# Create a box for each box in the segment
+	for e in root:
+		if (e.tag == "box"):
+			a = e.attrib
+			t = a.get("template", None)
+			
+			if (getFromTemplate(a, templates, t, "visible", "1") != "0"):
+				# Get properties
+				
+				# Position -- x y z
+				pos = Vector3.fromString(getFromTemplate(a, templates, t, "pos", "0 0 0"))
 				
 				# Size -- x y z
 				size = Vector3.fromString(getFromTemplate(a, templates, t, "size", "0 0 0"))
@@ -646,6 +1659,8 @@ def parseSegmentXML(data, templates = {}):
 				
 				boxes.append(Box(seg, pos, size, color, tile, tileSize, tileRot, glow, gradient))
 	
+	seg.buildIndex()
+	
 	return seg
 
 def getFromTemplate(boxattr, template_list, template, attr, default):
@@ -684,6 +1699,24 @@ def parseTemplatesXml(path):
 		return result
 
 
+def getTileSteps(start, end, size):
+	"""
+	Find where each tile along one axis of a face begins and how long it is, in
+	the same way generateSubdividedFaceGeometry does.
+	"""
+	
+	starts = []
+	lengths = []
+	
+	current = start
+	
+	while (current < end):
+		starts.append(current)
+		lengths.append((abs(end - start) % size) if (current + size > end) else size)
+		current += size
+	
+	return starts, lengths
+
 def generateSubdividedFaceGeometry(minest, maxest, s_size, t_size, color, tile, tileRot, seg, normal, gradient):
 	"""
 	Generates subdivided quadrelaterials for any given axis where the min/max
@@ -752,9 +1785,10 @@ def generateSubdividedFaceGeometry(minest, maxest, s_size, t_size, color, tile,
 		t_max = getattr(maxest, ax_t)
 		
 		while (t_current < t_max):
-			# Set the actual unit to be used
-			s_scunitpart = s_scunit.copy()
-			t_scunitpart = t_scunit.copy()
+			# Set the actual unit to be used, only copied when it needs to
+			# change since they are never modified otherwise
+			s_scunitpart = s_scunit
+			t_scunitpart = t_scunit
 			
 			# Check that there is enough space, if not, truncate the tile (for s and t axis)
 			# How this works:
@@ -762,9 +1796,11 @@ def generateSubdividedFaceGeometry(minest, maxest, s_size, t_size, color, tile,
 			#   - if so, then compute the length of the box and modulo it with its size (get remainder)
 			#   - set that new value as the tile size
 			if (s_current + s_size > s_max):
+				s_scunitpart = s_scunit.copy()
 				setattr(s_scunitpart, ax_s, abs(getattr(maxest, ax_s) - getattr(minest, ax_s)) % s_size)
 			
 			if (t_current + t_size > t_max):
+				t_scunitpart = t_scunit.copy()
 				setattr(t_scunitpart, ax_t, abs(getattr(maxest, ax_t) - getattr(minest, ax_t)) % t_size)
 			
 			# Create first point (hardest one!)
@@ -784,295 +1820,1316 @@ def generateSubdividedFaceGeometry(minest, maxest, s_size, t_size, color, tile,
 			# Add new size to total count (for this major axis)
 			t_current += t_size
 		
-		# Count this row as being generated for major axis
-		s_current += s_size
+		# Count this row as being generated for major axis
+		s_current += s_size
+	
+	return quads
+
+# Layouts of one vertex (position, texture coordinates and colour) and of the
+# indices of one quad (two triangles) in the mesh file
+MESH_VERTEX_STRUCT = struct.Struct('5f4B')
+MESH_QUAD_INDEX_STRUCT = struct.Struct('6I')
+MESH_TRIANGLE_STRUCT = struct.Struct('3I')
+
+def meshIndexBytes(i0, i1, i2):
+	"""
+	Return the bytes for an index in the mesh
+	"""
+	
+	return MESH_TRIANGLE_STRUCT.pack(i0, i1, i2)
+
+def rotateList(e, n):
+	"""
+	Rotate n elements of a list e
+	"""
+	
+	n %= len(e)
+	
+	for i in range(n):
+		e.append(e.pop(0))
+	
+	return e
+
+def getTextureCoords(rows, cols, bite_row, bite_col, rot, tile):
+	"""
+	Gets the texture coordinates given the tile number.
+	
+	The tile bite is a small region of the tile that is clipped off.
+	
+	Returns ((u1, v1), (u2, v2), (u3, v3), (u4, v4))
+	"""
+	
+	bite_row = (bite_row / rows)
+	bite_col = (bite_col / cols)
+	u = ((tile % rows) / rows) + bite_row
+	v = ((tile // rows) / cols) + bite_col
+	w = (1 / rows) - (2 * bite_row)
+	h = (1 / cols) - (2 * bite_col)
+	
+	return rotateList([(u, v), (u, v + h), (u + w, v + h), (u + w, v)], rot)
+
+def doAmbientOcclusion(x, y, z, a, gc, normal):
+	"""
+	Compute the light at a vertex
+	
+	The following method is an idea that I had to get percise light information
+	about a point very quickly when a scene has only AABBs. Basically, we pick
+	a vertex then create a cube of a certian length, width and height around
+	that vertex. We then find every intersection with that box and sum the
+	volume of the union of those intersections. After this, we take the ratio
+	between the volume of half the delta box and the accumulated volume. With
+	this, we subtract half of the delta box volume from our accumulated volume,
+	max it with 0, divide that by half of the delta box volume and finally cube
+	root it which should give us an apprimation of the light that reaches this
+	point without preforming many many raycasts.
+	
+	This has some issues: overlaping boxes can cause the algorithm to overshade
+	some point dramatically.
+	
+	Updated for 0.13: Now it increments the position by normal * deltaboxsize so
+	we are closer to just a raycast
+	"""
+	
+	# Find the size of the delta box
+	d = gc.settings.ABMIENT_OCCLUSION_DELTA_BOX_SIZE
+	delta_box_size = Vector3(d, d, d)
+	
+	# Find the box with largest volume intresecting the box around this vertex
+	accum, isect = gc.boxcast(Vector3(x + d * normal.x, y + d * normal.y, z + d * normal.z), delta_box_size)
+	
+	return ambientOcclusionShade(accum, a, d)
+
+def ambientOcclusionShade(accum, a, d):
+	"""
+	Find the light at a vertex given the volume of boxes in its delta box, d
+	being half of the size of the delta box
+	"""
+	
+	delta_box_volume = (2 * d) ** 3
+	
+	# Find the light based on the volume taken
+	# This is min/max'd to not cause major issues if there is an overlaping box
+	shade = min(max(accum, 0), delta_box_volume) / delta_box_volume
+	
+	return (a ** 2) * (1.0 - 0.47 * shade ** 0.3)
+
+def doLighting(x, y, z, r, g, b, gc):
+	"""
+	Does a rough approximation of illumination for the current point.
+	This is very engineered and very approximate.
+	"""
+	
+	# Get amount of ambient light
+	ambient_light = gc.ambient
+	
+	# Find the intensity of light
+	findIntenstity = lambda size, dist : min(max(1 / (((max(dist, size + 0.0001) - size) ** 2)), 0), 1)
+	
+	# Color that will be added to old color. This is done with plain floats
+	# instead of vectors since it runs for every vertex.
+	add_r, add_g, add_b = 0.0, 0.0, 0.0
+	
+	# Make a proper vector for the current point coordintes
+	point = Vector3(x, y, z)
+	
+	for box, limit in gc.lights.near(point, max(abs(r), abs(g), abs(b))):
+		# Compute difference from point to box origin
+		dx, dy, dz = box.pos.x - x, box.pos.y - y, box.pos.z - z
+		distance = math.sqrt(dx * dx + dy * dy + dz * dz)
+		
+		# Skip lights that are too far away to make a difference
+		if (distance > limit): continue
+		
+		# Find the nearest side coordinate index
+		facing_side = (0 if ((abs(dx) > abs(dy)) and (abs(dx) > abs(dz))) else (1 if (abs(dy) > abs(dz)) else 2))
+		
+		# Set box color
+		box_color = box.color[facing_side]
+		
+		# Find the "radius" of the box used to make sure box size is less likely
+		# to affect the amount of light cast
+		radius = (box.size.x, box.size.y, box.size.z)[facing_side]
+		
+		# Find the new color of the point based on how much light was added to
+		# the point and its intensity.
+		intensity = findIntenstity(radius, distance)
+		glow = box.glow
+		add_r += 0.01 * (glow * (intensity * (box_color.x * r)))
+		add_g += 0.01 * (glow * (intensity * (box_color.y * g)))
+		add_b += 0.01 * (glow * (intensity * (box_color.z * b)))
+	
+	# Get the final color by adding to base box color
+	return ((r * ambient_light.x) + add_r, (g * ambient_light.y) + add_g, (b * ambient_light.z) + add_b)
+
+def doComputeLinearGradient(x, y, z, r, g, b, gradient):
+	# Endpoints of the gradient
+	pa = Vector3(gradient[0], gradient[1], gradient[2])
+	pb = Vector3(gradient[3], gradient[4], gradient[5])
+	
+	# Color values of the gradient at each endpoint
+	ca = Vector3(gradient[6], gradient[7], gradient[8])
+	cb = Vector3(gradient[9], gradient[10], gradient[11])
+	
+	# Make points relative to an origin (pa in this case)
+	rv = pb - pa
+	ra = Vector3(x, y, z) - pa
+	
+	# Dot product between them to find how far along the vector is when project
+	# against the other i fucking hate this shit i dont understand it anymore
+	# and im tired as FUCK aaaaaauhghghghghghh FUCK FUCK FUCK
+	alongness = ((max(rv * ra, 0.0) * rv) / rv.lengthSquared()).length() / rv.length()
+	
+	# Now we lerp which is much nicer :3
+	r, g, b = (alongness * cb + (1.0 - alongness) * ca).asTuple()
+	
+	return (r, g, b)
+
+def doVertexColor(x, y, z, r, g, b, a, gc, normal, gradient, occlusion = None):
+	"""
+	Do any final color correction operations and per-vertex lighting.
+	
+	occlusion is the FaceOcclusion for the face the vertex is on, if there is
+	one.
+	"""
+	
+	if (gradient):
+		r, g, b = doComputeLinearGradient(x, y, z, r, g, b, gradient)
+	
+	if (gc.settings.ABMIENT_OCCLUSION_ENABLED):
+		if (occlusion):
+			a = occlusion.sample(x, y, z, a)
+		else:
+			a = doAmbientOcclusion(x, y, z, a, gc, normal)
+	
+	if (gc.settings.LIGHTING_ENABLED):
+		r, g, b = doLighting(x, y, z, r, g, b, gc)
+	
+	return r * 0.5, g * 0.5, b * 0.5, a
+
+def quadVertexColors(quads):
+	"""
+	Work out the final colour of every vertex of the quads, the same as
+	doVertexColor does for one vertex. Each step is done for all of the quads
+	before the next one, so ambient occlusion and lighting can be timed once
+	for the whole batch instead of for every vertex.
+	
+	Returns a list of [r, g, b, a], four for each quad
+	"""
+	
+	if (not quads):
+		return []
+	
+	# The quads are all from the same segment
+	settings = quads[0].seg.settings
+	colors = []
+	
+	for q in quads:
+		col, gradient = q.color, q.gradient
+		a = col.a if hasattr(col, "a") else 1
+		
+		for p in (q.p1, q.p2, q.p3, q.p4):
+			if (gradient):
+				r, g, b = doComputeLinearGradient(p.x, p.y, p.z, col.x, col.y, col.z, gradient)
+			else:
+				r, g, b = col.x, col.y, col.z
+			
+			colors.append([r, g, b, a])
+	
+	if (settings.ABMIENT_OCCLUSION_ENABLED):
+		with profileTimer("ambient_occlusion"):
+			i = 0
+			
+			for q in quads:
+				occlusion = q.occlusion
+				
+				for p in (q.p1, q.p2, q.p3, q.p4):
+					c = colors[i]
+					
+					if (occlusion):
+						c[3] = occlusion.sample(p.x, p.y, p.z, c[3])
+					else:
+						c[3] = doAmbientOcclusion(p.x, p.y, p.z, c[3], q.seg, q.normal)
+					
+					i += 1
+	
+	if (settings.LIGHTING_ENABLED):
+		with profileTimer("lighting"):
+			i = 0
+			
+			for q in quads:
+				for p in (q.p1, q.p2, q.p3, q.p4):
+					c = colors[i]
+					c[0], c[1], c[2] = doLighting(p.x, p.y, p.z, c[0], c[1], c[2], q.seg)
+					i += 1
+	
+	for c in colors:
+		c[0] *= 0.5
+		c[1] *= 0.5
+		c[2] *= 0.5
+	
+	return colors
+
+def meshPointBytes(x, y, z, u, v, r, g, b, a, gc, normal, gradient, occlusion = None):
+	"""
+	Return bytes for the point in the mesh
+	
+	gc is the segment context that contains the box list for lighting
+	"""
+	
+	c = bytearray(MESH_VERTEX_STRUCT.size)
+	
+	meshPointPackInto(c, 0, x, y, z, u, v, r, g, b, a, gc, normal, gradient, occlusion)
+	
+	return c
+
+def meshPointPackInto(buffer, pos, x, y, z, u, v, r, g, b, a, gc, normal, gradient, occlusion = None):
+	"""
+	Write the point into a buffer at the given byte position, like
+	meshPointBytes
+	"""
+	
+	r, g, b, a = doVertexColor(x, y, z, r, g, b, a, gc, normal, gradient, occlusion)
+	
+	meshVertexPackInto(buffer, pos, x, y, z, u, v, r, g, b, a)
+
+def meshVertexPackInto(buffer, pos, x, y, z, u, v, r, g, b, a):
+	"""
+	Write a vertex that already has its final colour into a buffer at the given
+	byte position
+	"""
+	
+	# Same as int(max(min(c, 1.0), 0.0) * 255) but without the calls
+	MESH_VERTEX_STRUCT.pack_into(
+		buffer, pos,
+		x, y, z,
+		u, v,
+		int((1.0 if r > 1.0 else (0.0 if r < 0.0 else r)) * 255),
+		int((1.0 if g > 1.0 else (0.0 if g < 0.0 else g)) * 255),
+		int((1.0 if b > 1.0 else (0.0 if b < 0.0 else b)) * 255),
+		int((1.0 if a > 1.0 else (0.0 if a < 0.0 else a)) * 255),
+	)
+
+def generateMeshData(data, seg = None, progress = None, extra_data = None):
+	"""
+	Generates mesh data bytes
+	"""
+	
+	vertex, index, vertex_count, index_count = generateMeshBuffers(data, progress)
+	
+	return packMeshData(vertex_count, vertex, index_count, index, extra_data)
+
+# Number of quads that have their vertex colours worked out together by the
+# pure Python engine
+MESH_COLOR_BATCH_SIZE = 1024
+
+def generateMeshBuffers(data, progress = None):
+	"""
+	Convert a list of quads to vertex and index data
+	
+	Returns tuple of (vertex bytes, index bytes, number of vertexes, number of indicies)
+	"""
+	
+	l = len(data)
+	
+	# Vertex and index data arrays, each quad has four vertices and six indices
+	vertex = bytearray(l * 4 * MESH_VERTEX_STRUCT.size)
+	index = bytearray(l * MESH_QUAD_INDEX_STRUCT.size)
+	
+	# Convert data to bytes, working out the vertex colours for a batch of
+	# quads at a time
+	for start in range(0, l, MESH_COLOR_BATCH_SIZE):
+		batch = data[start:start + MESH_COLOR_BATCH_SIZE]
+		colors = quadVertexColors(batch)
+		
+		for j, d in enumerate(batch):
+			i = start + j
+			d.packInto(vertex, i * 4 * MESH_VERTEX_STRUCT.size, index, i * MESH_QUAD_INDEX_STRUCT.size, i * 4, colors, j * 4)
+			
+			if (progress):
+				progress.update(0.5 + 0.5 * ((i + 1) / l))
+	
+	return (vertex, index, l * 4, l * 6)
+
+def bakeFacesToBuffers(faces, seg, progress = None, counts = False):
+	"""
+	Subdivide faces and convert them to vertex and index data, using the NumPy
+	engine if it can be used
+	
+	Returns tuple of (vertex bytes, index bytes, number of vertexes, number of indicies)
+	
+	If counts is True, a list with the number of quads baked for each face is
+	added to the end of the tuple.
+	"""
+	
+	with profileTimer("mesh_data"):
+		if (numpy and seg.settings.NUMPY_ENGINE_ENABLED):
+			result = bakeFacesNumpy(faces, seg, counts)
+		else:
+			quads = []
+			face_quads = []
+			
+			for face in faces:
+				face_geometry = face.subdivide(seg)
+				face_quads.append(len(face_geometry))
+				quads += face_geometry
+			
+			result = generateMeshBuffers(quads, progress)
+			result = (*result, face_quads) if counts else result
+	
+	profile = gBakeThread.profile
+	
+	if (profile):
+		profile.count("faces", len(faces))
+		profile.count("quads", result[2] // 4)
+		profile.count("vertices", result[2])
+		profile.count("indices", result[3])
+	
+	return result
+
+def joinMeshBuffers(parts):
+	"""
+	Join a list of (vertex bytes, index bytes, number of vertexes, number of
+	indicies) tuples into one, with the indices of each part offset by the
+	number of vertices before it
+	"""
+	
+	vertex = bytearray()
+	index = bytearray()
+	
+	vertex_count = 0
+	index_count = 0
+	
+	for part_vertex, part_index, part_vertex_count, part_index_count in parts:
+		vertex += part_vertex
+		
+		if (not vertex_count):
+			index += part_index
+		elif (numpy):
+			index += (numpy.frombuffer(bytes(part_index), dtype = numpy.uint32) + numpy.uint32(vertex_count)).tobytes()
+		else:
+			index += array.array('I', (i + vertex_count for i in array.array('I', bytes(part_index)))).tobytes()
+		
+		vertex_count += part_vertex_count
+		index_count += part_index_count
+	
+	return (vertex, index, vertex_count, index_count)
+
+def splitMeshBuffers(vertex, index, quad_counts):
+	"""
+	Split vertex and index data made of quads (four vertices and six indices
+	each) into parts with the given numbers of quads, the opposite of
+	joinMeshBuffers
+	
+	Returns list of (vertex bytes, index bytes, number of vertexes, number of indicies)
+	"""
+	
+	parts = []
+	start = 0
+	
+	for count in quad_counts:
+		end = start + count
+		part_vertex = bytes(vertex[start * 4 * MESH_VERTEX_SIZE:end * 4 * MESH_VERTEX_SIZE])
+		part_index = bytes(index[start * 6 * 4:end * 6 * 4])
+		
+		if (start and numpy):
+			part_index = (numpy.frombuffer(part_index, dtype = numpy.uint32) - numpy.uint32(start * 4)).tobytes()
+		elif (start):
+			part_index = array.array('I', (i - start * 4 for i in array.array('I', part_index))).tobytes()
+		
+		parts.append((part_vertex, part_index, count * 4, count * 6))
+		start = end
+	
+	return parts
+
+def packMeshData(vertex_count, vertex, index_count, index, extra_data = None, settings = None):
+	"""
+	Put the vertex and index data together with any extra data and the bake
+	info, then compress it into the final mesh file bytes
+	
+	settings is the BakeSettings (or a dict of settings) to pack the mesh
+	with, or None for the defaults.
+	"""
+	
+	f = io.BytesIO()
+	writeMeshData(f, vertex_count, vertex, index_count, index, extra_data, settings)
+	
+	return f.getvalue()
+
+# How much uncompressed data is given to zlib at once when writing a mesh
+MESH_WRITE_CHUNK_SIZE = 1024 * 1024
+
+def writeMeshData(f, vertex_count, vertex, index_count, index, extra_data = None, settings = None):
+	"""
+	Same as packMeshData, but the mesh is compressed a piece at a time and
+	written to the file object f as it goes, so the whole uncompressed mesh
+	file is never put together in memory
+	"""
+	
+	settings = BakeSettings.get(settings)
+	
+	if (settings.WELD_VERTICES):
+		with profileTimer("weld"):
+			vertex, index, vertex_count = weldMeshData(vertex, index, settings)
+	
+	if (settings.COMPRESSION_BEST):
+		candidates = settings.COMPRESSION_BEST_CANDIDATES
+	else:
+		candidates = [(settings.COMPRESSION_LEVEL, settings.COMPRESSION_STRATEGY)]
+	
+	compressors = [zlib.compressobj(level, strategy = COMPRESSION_STRATEGIES[strategy]) for level, strategy in candidates]
+	
+	# With more than one candidate, the compressed data needs to be kept until
+	# it's known which one is the smallest
+	outputs = [f] if (len(compressors) == 1) else [io.BytesIO() for c in compressors]
+	
+	uncompressed_size = 0
+	sizes = [0] * len(compressors)
+	
+	with profileTimer("compress"):
+		for chunk in meshDataChunks(vertex_count, vertex, index_count, index, extra_data, settings):
+			uncompressed_size += len(chunk)
+			
+			for i, compressor in enumerate(compressors):
+				compressed = compressor.compress(chunk)
+				outputs[i].write(compressed)
+				sizes[i] += len(compressed)
+		
+		for i, compressor in enumerate(compressors):
+			compressed = compressor.flush()
+			outputs[i].write(compressed)
+			sizes[i] += len(compressed)
+	
+	best = sizes.index(min(sizes))
+	
+	if (len(outputs) > 1):
+		f.write(outputs[best].getbuffer())
+	
+	profile = gBakeThread.profile
+	
+	if (profile):
+		profile.setInfo("compression_level", candidates[best][0])
+		profile.setInfo("compression_strategy", candidates[best][1])
+		profile.count("compressed_bytes", sizes[best])
+		profile.count("uncompressed_bytes", uncompressed_size)
+
+def meshDataChunks(vertex_count, vertex, index_count, index, extra_data = None, settings = None):
+	"""
+	Yield the uncompressed mesh file in pieces. The vertex and index data are
+	not copied, only sliced.
+	"""
+	
+	settings = BakeSettings.get(settings)
+	
+	yield struct.pack('I', vertex_count)
+	
+	vertex = memoryview(vertex)
+	
+	for i in range(0, len(vertex), MESH_WRITE_CHUNK_SIZE):
+		yield vertex[i:i + MESH_WRITE_CHUNK_SIZE]
+	
+	yield struct.pack('I', index_count)
+	
+	index = memoryview(index)
+	
+	for i in range(0, len(index), MESH_WRITE_CHUNK_SIZE):
+		yield index[i:i + MESH_WRITE_CHUNK_SIZE]
+	
+	if (extra_data):
+		yield extra_data.encode('utf-8')
+	
+	if (settings.INCLUDE_VERSION_AND_INFO):
+		info = bytearray()
+		info += b"MB"
+		info += struct.pack('!H', VERSION[0])
+		info += struct.pack('!H', VERSION[1])
+		info += struct.pack('!H', VERSION[2])
+		info += struct.pack('!H', (0b1 if settings.BAKE_UNSEEN_FACES else 0) | (0b10 if settings.ABMIENT_OCCLUSION_ENABLED else 0) | (0b100 if settings.LIGHTING_ENABLED else 0))
+		info += struct.pack('!H', settings.TILE_ROWS)
+		info += struct.pack('!H', settings.TILE_COLS)
+		info += struct.pack('!f', settings.TILE_BITE_ROW)
+		info += struct.pack('!f', settings.TILE_BITE_COL)
+		info += struct.pack('!f', settings.ABMIENT_OCCLUSION_DELTA_BOX_SIZE)
+		yield info
+
+# Size of one vertex in the mesh file
+MESH_VERTEX_SIZE = 24
+
+def weldMeshData(vertex, index, settings = None):
+	"""
+	Merge vertices with exactly the same bytes (so the same position, texture
+	coordinates and colour) and point the indices at the merged ones. Vertices
+	stay in the order they first appear in, so the indices of a face are close
+	together.
+	
+	Returns tuple of (vertex bytes, index bytes, number of vertexes)
+	"""
+	
+	old_count = len(vertex) // MESH_VERTEX_SIZE
+	
+	if (numpy and BakeSettings.get(settings).NUMPY_ENGINE_ENABLED):
+		vertices = numpy.frombuffer(bytes(vertex), dtype = f"V{MESH_VERTEX_SIZE}")
+		unique, first, inverse = numpy.unique(vertices, return_index = True, return_inverse = True)
+		
+		# numpy.unique sorts the vertices, so put them back in order of first use
+		order = numpy.argsort(first, kind = "stable")
+		rank = numpy.empty(len(order), dtype = numpy.uint32)
+		rank[order] = numpy.arange(len(order), dtype = numpy.uint32)
+		
+		remap = rank[inverse.reshape(-1)]
+		new_vertex = vertices[first[order]].tobytes()
+		new_index = remap[numpy.frombuffer(bytes(index), dtype = numpy.uint32)].tobytes()
+	else:
+		seen = {}
+		remap = array.array('I')
+		new_vertex = bytearray()
+		
+		for i in range(0, len(vertex), MESH_VERTEX_SIZE):
+			v = bytes(vertex[i:i + MESH_VERTEX_SIZE])
+			n = seen.get(v, None)
+			
+			if (n == None):
+				n = len(seen)
+				seen[v] = n
+				new_vertex += v
+			
+			remap.append(n)
+		
+		new_index = array.array('I', (remap[i] for i in array.array('I', bytes(index)))).tobytes()
+	
+	new_count = len(new_vertex) // MESH_VERTEX_SIZE
+	
+	log(f"Welded {old_count} vertices down to {new_count}" + (" (indices fit in 16 bits)" if new_count <= 0x10000 else ""))
+	
+	return (new_vertex, new_index, new_count)
+
+################################################################################
+### NumPy engine ###############################################################
+################################################################################
+
+# These work on whole arrays of quads and vertices instead of one Quad at a
+# time, but they must give exactly the same bytes as the functions above. This
+# is why most operations are written out in the same order as the pure Python
+# versions, including ones that look redundant (like adding zero).
+
+def pyPowNumpy(array, exponent):
+	"""
+	Raise each element of an array to a power using Python's float power.
+	NumPy's power (and even x * x for x ** 2) can be different in the last bit,
+	which is enough to change some colour bytes.
+	"""
+	
+	return numpy.fromiter((x ** exponent for x in array.tolist()), dtype = numpy.float64, count = len(array))
+
+def subdivideFacesNumpy(faces):
+	"""
+	Subdivide all faces into tile quads at once.
+	
+	Returns (points, quad_face) where points is a (quads, 4, 3) array of the
+	corners of each quad in segment coordinates and quad_face is the index of
+	the face each quad came from.
+	"""
+	
+	face_count = len(faces)
+	
+	# Per face info: excluded, s and t axes, location on e axis and the number
+	# of tiles along s and t
+	axes = numpy.zeros((face_count, 3), dtype = numpy.intp)
+	e_location = numpy.zeros(face_count)
+	s_counts = numpy.zeros(face_count, dtype = numpy.intp)
+	t_counts = numpy.zeros(face_count, dtype = numpy.intp)
+	
+	# Start and length of the tile rows and columns for every face
+	s_starts, s_lengths, t_starts, t_lengths = [], [], [], []
+	
+	for i, face in enumerate(faces):
+		minest = face.minest.asTuple()
+		maxest = face.maxest.asTuple()
+		
+		# Find which axes should be used
+		ax_e = [minest[a] == maxest[a] for a in range(3)].index(True)
+		ax_s, ax_t = [a for a in range(3) if a != ax_e]
+		
+		axes[i] = (ax_e, ax_s, ax_t)
+		e_location[i] = minest[ax_e]
+		
+		# Make sure min <= max on s and t
+		s_min, s_max = (maxest[ax_s], minest[ax_s]) if (minest[ax_s] > maxest[ax_s]) else (minest[ax_s], maxest[ax_s])
+		t_min, t_max = (maxest[ax_t], minest[ax_t]) if (minest[ax_t] > maxest[ax_t]) else (minest[ax_t], maxest[ax_t])
+		
+		starts, lengths = getTileSteps(s_min, s_max, face.s_size)
+		s_starts += starts
+		s_lengths += lengths
+		s_counts[i] = len(starts)
+		
+		starts, lengths = getTileSteps(t_min, t_max, face.t_size)
+		t_starts += starts
+		t_lengths += lengths
+		t_counts[i] = len(starts)
+	
+	s_starts, s_lengths = numpy.array(s_starts, dtype = numpy.float64), numpy.array(s_lengths, dtype = numpy.float64)
+	t_starts, t_lengths = numpy.array(t_starts, dtype = numpy.float64), numpy.array(t_lengths, dtype = numpy.float64)
+	
+	# Expand each face's rows and columns into a grid of quads (s major, t minor)
+	quad_counts = s_counts * t_counts
+	quad_face = numpy.repeat(numpy.arange(face_count), quad_counts)
+	quad_count = len(quad_face)
+	
+	local = numpy.arange(quad_count) - (numpy.cumsum(quad_counts) - quad_counts)[quad_face]
+	t_count = t_counts[quad_face]
+	s_index = (numpy.cumsum(s_counts) - s_counts)[quad_face] + local // numpy.maximum(t_count, 1)
+	t_index = (numpy.cumsum(t_counts) - t_counts)[quad_face] + local % numpy.maximum(t_count, 1)
+	
+	rows = numpy.arange(quad_count)
+	ax_e, ax_s, ax_t = axes[quad_face, 0], axes[quad_face, 1], axes[quad_face, 2]
+	
+	# First point of each quad
+	p1 = numpy.zeros((quad_count, 3))
+	p1[rows, ax_e] = e_location[quad_face]
+	p1[rows, ax_s] = s_starts[s_index]
+	p1[rows, ax_t] = t_starts[t_index]
+	
+	# Scaled unit vectors along s and t
+	s_unit = numpy.zeros((quad_count, 3))
+	s_unit[rows, ax_s] = s_lengths[s_index]
+	
+	t_unit = numpy.zeros((quad_count, 3))
+	t_unit[rows, ax_t] = t_lengths[t_index]
+	
+	# Other points, then translate to where the box is
+	offset = numpy.array([face.offset.asTuple() for face in faces]).reshape(-1, 3)[quad_face]
+	p2 = p1 + s_unit
+	p3 = p2 + t_unit
+	p4 = p1 + t_unit
+	
+	points = numpy.stack((p1 + offset, p2 + offset, p3 + offset, p4 + offset), axis = 1)
+	
+	return points, quad_face
+
+def doComputeLinearGradientNumpy(pos, gradient):
+	"""
+	doComputeLinearGradient for arrays of points, with one gradient per point
+	"""
+	
+	pa = gradient[:, 0:3]
+	pb = gradient[:, 3:6]
+	ca = gradient[:, 6:9]
+	cb = gradient[:, 9:12]
+	
+	rv = pb - pa
+	ra = pos - pa
+	
+	dot = (rv[:, 0] * ra[:, 0] + rv[:, 1] * ra[:, 1]) + rv[:, 2] * ra[:, 2]
+	dot = numpy.where(0.0 > dot, 0.0, dot)
+	rv_length_squared = (rv[:, 0] * rv[:, 0] + rv[:, 1] * rv[:, 1]) + rv[:, 2] * rv[:, 2]
+	
+	projected = (dot[:, None] * rv) / rv_length_squared[:, None]
+	projected_length = numpy.sqrt((projected[:, 0] * projected[:, 0] + projected[:, 1] * projected[:, 1]) + projected[:, 2] * projected[:, 2])
+	alongness = (projected_length / numpy.sqrt(rv_length_squared))[:, None]
+	
+	return alongness * cb + (1.0 - alongness) * ca
+
+class VertexGridNumpy:
+	"""
+	Uniform grid of points, used to find the vertices near a box
+	"""
+	
+	def __init__(self, points, cell_size):
+		self.cell_size = cell_size
+		self.count = len(points)
+		
+		keys = numpy.floor(points / cell_size).astype(numpy.int64)
+		unique, inverse = numpy.unique(keys, axis = 0, return_inverse = True)
+		order = numpy.argsort(inverse.reshape(-1), kind = "stable")
+		splits = numpy.cumsum(numpy.bincount(inverse.reshape(-1)))[:-1]
+		
+		self.cells = dict(zip(map(tuple, unique.tolist()), numpy.split(order, splits)))
+	
+	def query(self, lo, hi):
+		"""
+		Find the indices of points that might be between lo and hi. This may
+		include some points that are a bit outside of the region, but never
+		misses any that are in it.
+		"""
+		
+		# Extended by one cell on each side so that rounding can't cause a
+		# point right on the edge to be missed
+		lo = numpy.floor(lo / self.cell_size).astype(numpy.int64) - 1
+		hi = numpy.floor(hi / self.cell_size).astype(numpy.int64) + 1
+		
+		# Big boxes cover more cells than there are points
+		if (numpy.prod(hi - lo + 1) > len(self.cells)):
+			return numpy.arange(self.count)
+		
+		found = []
+		
+		for x in range(lo[0], hi[0] + 1):
+			for y in range(lo[1], hi[1] + 1):
+				for z in range(lo[2], hi[2] + 1):
+					points = self.cells.get((x, y, z), None)
+					
+					if (points is not None):
+						found.append(points)
+		
+		if (not found):
+			return numpy.zeros(0, dtype = numpy.intp)
+		
+		return numpy.concatenate(found)
+
+def doAmbientOcclusionNumpy(pos, normal, a, a_squared, gc):
+	"""
+	doAmbientOcclusion for arrays of vertices
+	"""
+	
+	settings = gc.settings
+	d = settings.ABMIENT_OCCLUSION_DELTA_BOX_SIZE
+	delta_box_volume = (2 * d) ** 3
+	
+	# The delta box around each vertex
+	centre = pos + (normal * d)
+	
+	# Corners shared by more than one tile (or face) only need to be done once
+	inverse = None
+	
+	if (settings.ABMIENT_OCCLUSION_PER_FACE and len(centre)):
+		centre, inverse = numpy.unique(centre, axis = 0, return_inverse = True)
+		inverse = inverse.reshape(-1)
+	
+	b_min = centre - d
+	b_max = centre + d
+	b_min, b_max = numpy.minimum(b_min, b_max), numpy.maximum(b_min, b_max)
+	
+	# Accumulate the intersection volume box by box, in the same order as
+	# boxcast so the sums round the same way
+	accum = numpy.zeros(len(centre))
+	
+	# Sort vertices into grid cells by where their delta box is, so only the
+	# vertices near a box need to be tested
+	cells = None
+	
+	if (settings.ABMIENT_OCCLUSION_USE_GRID and len(centre)):
+		cells = VertexGridNumpy(centre, settings.ABMIENT_OCCLUSION_GRID_CELL_SIZE)
+	
+	for box in gc.boxes:
+		a_min = numpy.array(box.pos.asTuple()) - numpy.array(box.size.asTuple())
+		a_max = numpy.array(box.pos.asTuple()) + numpy.array(box.size.asTuple())
+		a_min, a_max = numpy.minimum(a_min, a_max), numpy.maximum(a_min, a_max)
+		
+		if (cells is not None):
+			near = cells.query(a_min - d, a_max + d)
+			hit = near[numpy.all((a_max >= b_min[near]) & (b_max[near] >= a_min), axis = 1)]
+		else:
+			near = centre
+			hit = numpy.nonzero(numpy.all((a_max >= b_min) & (b_max >= a_min), axis = 1))[0]
+		
+		profile = gBakeThread.profile
+		
+		if (profile):
+			profile.count("boxcast_tests", len(near))
+			profile.count("boxcast_hits", len(hit))
+		
+		if (not len(hit)):
+			continue
+		
+		size = numpy.minimum(a_max, b_max[hit]) - numpy.maximum(a_min, b_min[hit])
+		volume = (2.0 * (0.5 * size[:, 0])) * (2.0 * (0.5 * size[:, 1])) * (2.0 * (0.5 * size[:, 2]))
+		accum[hit] += volume
 	
-	return quads
+	shade = numpy.where(0 > accum, 0, accum)
+	shade = numpy.where(delta_box_volume < shade, delta_box_volume, shade) / delta_box_volume
+	
+	# x ** 0.3 is zero for zero, which is most vertices
+	shaded = numpy.nonzero(shade)[0]
+	shade[shaded] = pyPowNumpy(shade[shaded], 0.3)
+	
+	if (inverse is not None):
+		shade = shade[inverse]
+	
+	return a_squared * (1.0 - 0.47 * shade)
 
-def meshIndexBytes(i0, i1, i2):
+def doLightingNumpy(pos, rgb, gc):
 	"""
-	Return the bytes for an index in the mesh
+	doLighting for arrays of vertices
 	"""
 	
-	c = bytearray()
+	add_color = numpy.zeros((len(pos), 3))
+	lights = gc.lights
 	
-	c += struct.pack('I', i0)
-	c += struct.pack('I', i1)
-	c += struct.pack('I', i2)
+	if (lights.culling):
+		scale = numpy.sqrt(numpy.max(numpy.abs(rgb), axis = 1))
 	
-	return c
+	for n, box in enumerate(lights.lights):
+		difference = numpy.array(box.pos.asTuple()) - pos
+		distance = numpy.sqrt((difference[:, 0] * difference[:, 0] + difference[:, 1] * difference[:, 1]) + difference[:, 2] * difference[:, 2])
+		
+		# Only vertices close enough for the light to make a difference, see
+		# LightIndex.near
+		if (lights.culling):
+			lit = numpy.nonzero(distance <= lights.sizes[n] + lights.reaches[n] * scale)[0]
+		else:
+			lit = slice(None)
+		
+		difference = difference[lit]
+		distance = distance[lit]
+		
+		# Find the nearest side coordinate index
+		d = numpy.abs(difference)
+		facing_side = numpy.where((d[:, 0] > d[:, 1]) & (d[:, 0] > d[:, 2]), 0, numpy.where(d[:, 1] > d[:, 2], 1, 2))
+		
+		box_color = numpy.array([box.color[i].asTuple() for i in range(3)])[facing_side]
+		radius = numpy.array(box.size.asTuple())[facing_side]
+		
+		# Intensity of the light, see findIntenstity in doLighting
+		intensity = numpy.where((radius + 0.0001) > distance, radius + 0.0001, distance) - radius
+		intensity = 1 / pyPowNumpy(intensity, 2)
+		intensity = numpy.where(0 > intensity, 0, intensity)
+		intensity = numpy.where(1 < intensity, 1, intensity)
+		
+		add_color[lit] += (((box_color * rgb[lit]) * intensity[:, None]) * box.glow) * 0.01
+	
+	return (rgb * numpy.array(gc.ambient.asTuple())) + add_color
 
-def rotateList(e, n):
+def cullHiddenQuadsNumpy(faces, points, quad_face, seg):
 	"""
-	Rotate n elements of a list e
+	Face.isQuadHidden for all quads, returns the points and quad_face arrays
+	without the hidden quads
 	"""
 	
-	n %= len(e)
+	lo = numpy.minimum(points[:, 0], points[:, 2])
+	hi = numpy.maximum(points[:, 0], points[:, 2])
+	hidden = numpy.zeros(len(quad_face), dtype = bool)
 	
-	for i in range(n):
-		e.append(e.pop(0))
+	for i, face in enumerate(faces):
+		if (not face.occluders):
+			continue
+		
+		# Quads are in face order
+		start, end = numpy.searchsorted(quad_face, (i, i + 1))
+		
+		for o_lo, o_hi in face.occluders:
+			hidden[start:end] |= numpy.all((numpy.array(o_lo) <= lo[start:end]) & (hi[start:end] <= numpy.array(o_hi)), axis = 1)
 	
-	return e
+	seg.culled_quads += int(hidden.sum())
+	
+	return points[~hidden], quad_face[~hidden]
 
-def getTextureCoords(rows, cols, bite_row, bite_col, rot, tile):
+def bakeFacesNumpy(faces, seg, counts = False):
 	"""
-	Gets the texture coordinates given the tile number.
-	
-	The tile bite is a small region of the tile that is clipped off.
+	Convert faces straight to vertex and index bytes.
 	
-	Returns ((u1, v1), (u2, v2), (u3, v3), (u4, v4))
+	Returns tuple of (vertex bytes, index bytes, number of vertexes, number of
+	indicies), with the number of quads for each face added if counts is True
 	"""
 	
-	bite_row = (bite_row / rows)
-	bite_col = (bite_col / cols)
-	u = ((tile % rows) / rows) + bite_row
-	v = ((tile // rows) / cols) + bite_col
-	w = (1 / rows) - (2 * bite_row)
-	h = (1 / cols) - (2 * bite_col)
+	if (not faces):
+		return (bytearray(), bytearray(), 0, 0, []) if counts else (bytearray(), bytearray(), 0, 0)
 	
-	return rotateList([(u, v), (u, v + h), (u + w, v + h), (u + w, v)], rot)
-
-def doAmbientOcclusion(x, y, z, a, gc, normal):
-	"""
-	Compute the light at a vertex
+	with profileTimer("subdivide"):
+		points, quad_face = subdivideFacesNumpy(faces)
 	
-	The following method is an idea that I had to get percise light information
-	about a point very quickly when a scene has only AABBs. Basically, we pick
-	a vertex then create a cube of a certian length, width and height around
-	that vertex. We then find every intersection with that box and sum the
-	volume of the union of those intersections. After this, we take the ratio
-	between the volume of half the delta box and the accumulated volume. With
-	this, we subtract half of the delta box volume from our accumulated volume,
-	max it with 0, divide that by half of the delta box volume and finally cube
-	root it which should give us an apprimation of the light that reaches this
-	point without preforming many many raycasts.
+	# Remove tiles that are covered by other boxes
+	if (any(f.occluders for f in faces)):
+		points, quad_face = cullHiddenQuadsNumpy(faces, points, quad_face, seg)
 	
-	This has some issues: overlaping boxes can cause the algorithm to overshade
-	some point dramatically.
+	quad_count = len(quad_face)
 	
-	Updated for 0.13: Now it increments the position by normal * deltaboxsize so
-	we are closer to just a raycast
-	"""
+	if (not quad_count):
+		return (bytearray(), bytearray(), 0, 0, [0] * len(faces)) if counts else (bytearray(), bytearray(), 0, 0)
 	
-	# Find the size and the volume of the delta box
-	delta_box_size = Vector3(ABMIENT_OCCLUSION_DELTA_BOX_SIZE, ABMIENT_OCCLUSION_DELTA_BOX_SIZE, ABMIENT_OCCLUSION_DELTA_BOX_SIZE)
-	delta_box_volume = (2 * ABMIENT_OCCLUSION_DELTA_BOX_SIZE) ** 3
+	# Four vertices per quad
+	vertex_face = numpy.repeat(quad_face, 4)
+	pos = points.reshape(-1, 3)
 	
-	# Find the box with largest volume intresecting the box around this vertex
-	accum, isect = gc.boxcast(Vector3(x, y, z) + (normal * ABMIENT_OCCLUSION_DELTA_BOX_SIZE), delta_box_size)
+	# Per face properties
+	settings = seg.settings
+	tex = numpy.array([getTextureCoords(settings.TILE_ROWS, settings.TILE_COLS, settings.TILE_BITE_ROW, settings.TILE_BITE_COL, f.tileRot, f.tile) for f in faces])
+	color = numpy.array([(f.color.x, f.color.y, f.color.z, f.color.a) for f in faces])
+	normal = numpy.array([f.normal.asTuple() for f in faces])
 	
-	# Find the light based on the volume taken
-	# This is min/max'd to not cause major issues if there is an overlaping box
-	shade = min(max(accum, 0), delta_box_volume) / delta_box_volume
+	rgb = color[vertex_face, 0:3]
+	a = color[vertex_face, 3]
 	
-	return (a ** 2) * (1.0 - 0.47 * shade ** 0.3)
+	# Gradients
+	has_gradient = numpy.array([bool(f.gradient) for f in faces])
+	
+	if (has_gradient.any()):
+		gradient = numpy.array([f.gradient if f.gradient else [0.0] * 12 for f in faces])
+		selected = numpy.nonzero(has_gradient[vertex_face])[0]
+		rgb[selected] = doComputeLinearGradientNumpy(pos[selected], gradient[vertex_face[selected]])
+	
+	if (settings.ABMIENT_OCCLUSION_ENABLED):
+		a_squared = numpy.array([f.color.a ** 2 for f in faces])[vertex_face]
+		with profileTimer("ambient_occlusion"):
+			a = doAmbientOcclusionNumpy(pos, normal[vertex_face], a, a_squared, seg)
+	
+	if (settings.LIGHTING_ENABLED):
+		with profileTimer("lighting"):
+			rgb = doLightingNumpy(pos, rgb, seg)
+	
+	rgba = numpy.concatenate((rgb * 0.5, a[:, None]), axis = 1)
+	rgba = numpy.where(1.0 < rgba, 1.0, rgba)
+	rgba = numpy.where(0.0 > rgba, 0.0, rgba)
+	
+	# Pack vertices
+	vertex = numpy.zeros(quad_count * 4, dtype = [("pos", "f4", 3), ("uv", "f4", 2), ("color", "u1", 4)])
+	vertex["pos"] = pos
+	vertex["uv"] = tex[quad_face].reshape(-1, 2)
+	vertex["color"] = (rgba * 255).astype(numpy.uint8)
+	
+	# Swap winding order in some situations so triangles don't get culled
+	p1, p3 = points[:, 0], points[:, 2]
+	swap = ((p1[:, 0] == p3[:, 0]) & (p1[:, 0] > 0)) | ((p1[:, 1] == p3[:, 1]) & (p1[:, 1] <= 1))
+	
+	index = numpy.where(swap[:, None], numpy.array([2, 1, 0, 3, 2, 0]), numpy.array([0, 1, 2, 0, 2, 3]))
+	index = (index + (4 * numpy.arange(quad_count))[:, None]).astype(numpy.uint32)
+	
+	if (counts):
+		return (vertex.tobytes(), index.tobytes(), quad_count * 4, quad_count * 6, numpy.bincount(quad_face, minlength = len(faces)).tolist())
+	
+	return (vertex.tobytes(), index.tobytes(), quad_count * 4, quad_count * 6)
 
-def doLighting(x, y, z, r, g, b, gc):
+## =============================================================================
+## =============================================================================
+## =============================================================================
+
+# Segment each worker process bakes part of, see bakeBoxesParallel
+gWorkerSegment = None
+
+# Merged faces of that segment, when merging coplanar faces
+gWorkerFaces = None
+
+def bakeMergedFaces(seg):
 	"""
-	Does a rough approximation of illumination for the current point.
-	This is very engineered and very approximate.
+	Bake the faces of every box in the segment and merge them, see
+	MERGE_COPLANAR_FACES
 	"""
 	
-	# Get amount of ambient light
-	ambient_light = gc.ambient
+	faces = []
 	
-	# Find the intensity of light
-	findIntenstity = lambda size, dist : min(max(1 / (((max(dist, size + 0.0001) - size) ** 2)), 0), 1)
+	for box in seg.boxes:
+		faces += box.bakeFaces()
 	
-	# Set a proper vector for the current color
-	old_color = Vector3(r, g, b)
+	return mergeCoplanarFaces(faces)
+
+def initBakeWorker(data, templates, settings, profile = False):
+	"""
+	Set up a worker process for parallel baking
+	"""
 	
-	# Color that will be added to old color
-	add_color = Vector3(0.0, 0.0, 0.0)
+	global gWorkerSegment, gWorkerFaces
 	
-	# Make a proper vector for the current point coordintes
-	point = Vector3(x, y, z)
+	gWorkerSegment = parseSegmentXML(data, templates, settings)
+	gBakeThread.profile = None
 	
-	for box in gc.boxes:
-		# Break if box is not a light
-		if (box.glow == 0.0): continue
-		
-		# Compute difference from point to box origin
-		difference = (box.pos - point)
-		distance = difference.length()
-		
-		# Find the nearest side coordinate index
-		facing_side = (0 if ((abs(difference.x) > abs(difference.y)) and (abs(difference.x) > abs(difference.z))) else (1 if (abs(difference.y) > abs(difference.z)) else 2))
-		
-		# Set box color
-		box_color = box.color[facing_side]
-		
-		# Find the "radius" of the box used to make sure box size is less likely
-		# to affect the amount of light cast
-		radius = [box.size.x, box.size.y, box.size.z][facing_side]
+	# Merging needs every face of the segment, so each worker merges all of
+	# them the same way the main process did and then bakes ranges of the
+	# merged faces
+	gWorkerFaces = bakeMergedFaces(gWorkerSegment) if gWorkerSegment.settings.MERGE_COPLANAR_FACES else None
+	gBakeThread.profile = BakeProfile() if profile else None
+
+def bakeBoxesWorker(shard):
+	"""
+	Bake the faces of the boxes in the given range in a worker process, or the
+	given range of merged faces when merging coplanar faces
+	
+	Returns tuple of (vertex bytes, index bytes, number of vertexes, number of
+	indicies, number of culled quads, profile dict or None)
+	"""
+	
+	seg = gWorkerSegment
+	seg.culled_quads = 0
+	
+	# Each range gets its own profile, which is added to the main one
+	if (gBakeThread.profile):
+		gBakeThread.profile = BakeProfile()
+	
+	if (gWorkerFaces != None):
+		faces = gWorkerFaces[shard[0]:shard[1]]
+	else:
+		faces = []
 		
-		# Find the new color of the point based on how much light was added to
-		# the point and its intensity.
-		add_color += box_color.compose(old_color) * findIntenstity(radius, distance) * box.glow * 0.01
+		with profileTimer("faces"):
+			for box in seg.boxes[shard[0]:shard[1]]:
+				faces += box.bakeFaces()
 	
-	# Get the final color by adding to base box color
-	r, g, b = (old_color.compose(ambient_light) + add_color).asTuple()
+	profile = gBakeThread.profile
 	
-	return (r, g, b)
+	return (*bakeFacesToBuffers(faces, seg), seg.culled_quads, profile.asDict() if profile else None)
 
-def doComputeLinearGradient(x, y, z, r, g, b, gradient):
-	# Endpoints of the gradient
-	pa = Vector3(gradient[0], gradient[1], gradient[2])
-	pb = Vector3(gradient[3], gradient[4], gradient[5])
+def canUseWorkerProcesses():
+	"""
+	Check if worker processes will be able to find the functions in this
+	module, see bakeBoxesParallel
+	"""
 	
-	# Color values of the gradient at each endpoint
-	ca = Vector3(gradient[6], gradient[7], gradient[8])
-	cb = Vector3(gradient[9], gradient[10], gradient[11])
+	module = sys.modules.get(__name__, None)
 	
-	# Make points relative to an origin (pa in this case)
-	rv = pb - pa
-	ra = Vector3(x, y, z) - pa
+	# Loaded again since, or not registered at all
+	if (module == None or getattr(module, "bakeBoxesWorker", None) is not bakeBoxesWorker):
+		return False
 	
-	# Dot product between them to find how far along the vector is when project
-	# against the other i fucking hate this shit i dont understand it anymore
-	# and im tired as FUCK aaaaaauhghghghghghh FUCK FUCK FUCK
-	alongness = ((max(rv * ra, 0.0) * rv) / rv.lengthSquared()).length() / rv.length()
+	# Forked workers already have the module
+	if (multiprocessing.get_start_method() == "fork"):
+		return True
 	
-	# Now we lerp which is much nicer :3
-	r, g, b = (alongness * cb + (1.0 - alongness) * ca).asTuple()
+	# The main script is run again in spawned workers
+	if (__name__ == "__main__"):
+		return True
 	
-	return (r, g, b)
+	# Otherwise they import it the same way it would be imported here
+	return importlib.machinery.PathFinder.find_spec(__name__.split(".")[0]) != None
 
-def doVertexColor(x, y, z, r, g, b, a, gc, normal, gradient):
+def bakeBoxesParallel(data, templates, seg, workers, progress = None):
 	"""
-	Do any final color correction operations and per-vertex lighting.
+	Bake the segment across several processes. Each process parses the whole
+	segment (it's needed for ambient occlusion) and bakes a range of boxes, or
+	a range of the merged faces when merging coplanar faces. The ranges are
+	joined back in order, so the result is exactly the same as baking in one
+	process.
+	
+	Note that the functions the workers run are sent to them by the name of
+	this module, so it has to be in sys.modules under that name, and unless
+	the workers are forked they import it again by that name. That doesn't
+	work when the module was loaded from its file under another name (like the
+	add-on does with util.load_module) and the start method isn't fork, which
+	it isn't by default on Windows and macOS. See canUseWorkerProcesses, the
+	segment is baked in one process in that case.
+	
+	Returns tuple of (vertex bytes, index bytes, number of vertexes, number of indicies)
 	"""
 	
-	if (gradient):
-		r, g, b = doComputeLinearGradient(x, y, z, r, g, b, gradient)
+	count = len(seg.boxes)
+	profile = gBakeThread.profile
 	
-	if (ABMIENT_OCCLUSION_ENABLED):
-		a = doAmbientOcclusion(x, y, z, a, gc, normal)
+	# Faces of different boxes can be merged, so they are merged here the same
+	# way as in a serial bake before being split up. This also counts the
+	# faces that are culled whole, since that happens when they are baked.
+	if (seg.settings.MERGE_COPLANAR_FACES):
+		with profileTimer("faces"):
+			count = len(bakeMergedFaces(seg))
 	
-	if (LIGHTING_ENABLED):
-		r, g, b = doLighting(x, y, z, r, g, b, gc)
+	# A few ranges per worker so that one slow range doesn't hold up the rest
+	shard_count = min(count, workers * 4)
+	ranges = [(count * i // shard_count, count * (i + 1) // shard_count) for i in range(shard_count)]
 	
-	return r * 0.5, g * 0.5, b * 0.5, a
+	parts = []
+	
+	with multiprocessing.Pool(workers, initializer = initBakeWorker, initargs = (data, templates, seg.settings.asDict(), bool(profile))) as pool:
+		for i, result in enumerate(pool.imap(bakeBoxesWorker, ranges)):
+			parts.append(result[:4])
+			seg.culled_quads += result[4]
+			
+			if (profile):
+				profile.merge(result[5])
+			
+			if (progress):
+				progress.update((i + 1) / shard_count)
+	
+	return joinMeshBuffers(parts)
 
-def meshPointBytes(x, y, z, u, v, r, g, b, a, gc, normal, gradient):
+class FragmentCache:
 	"""
-	Return bytes for the point in the mesh
-	
-	gc is the segment context that contains the box list for lighting
+	The baked geometry of single boxes from earlier bakes. Keep one of these
+	around between bakes so that re-baking a segment where only a few boxes
+	changed only needs to bake those boxes and the boxes around them. It can
+	be shared by bakes running in different threads.
 	"""
 	
-	r, g, b, a = doVertexColor(x, y, z, r, g, b, a, gc, normal, gradient)
-	
-	c = bytearray()
+	def __init__(self, max_fragments = 10000):
+		self.fragments = collections.OrderedDict()
+		self.max_fragments = max_fragments
+		self.lock = threading.Lock()
 	
-	c += struct.pack('f', x)
-	c += struct.pack('f', y)
-	c += struct.pack('f', z)
-	c += struct.pack('f', u)
-	c += struct.pack('f', v)
-	c += struct.pack('B', int(max(min(r, 1.0), 0.0) * 255))
-	c += struct.pack('B', int(max(min(g, 1.0), 0.0) * 255))
-	c += struct.pack('B', int(max(min(b, 1.0), 0.0) * 255))
-	c += struct.pack('B', int(max(min(a, 1.0), 0.0) * 255))
+	def get(self, key):
+		"""
+		Get the fragment for the key, or None if there isn't one
+		"""
+		
+		with self.lock:
+			fragment = self.fragments.get(key, None)
+			
+			if (fragment != None):
+				self.fragments.move_to_end(key)
+		
+		return fragment
 	
-	return c
+	def put(self, key, fragment):
+		"""
+		Add a fragment, forgetting the least recently used ones if there are too
+		many
+		"""
+		
+		with self.lock:
+			self.fragments[key] = fragment
+			self.fragments.move_to_end(key)
+			
+			while (len(self.fragments) > self.max_fragments):
+				self.fragments.popitem(last = False)
 
-def generateMeshData(data, seg = None, progress = None, extra_data = None):
+def bakeBoxesIncremental(seg, fragments, progress = None):
 	"""
-	Generates mesh data bytes
+	Bake the segment reusing the geometry of any box that is in the fragment
+	cache. Boxes that aren't are baked together and then split up again so
+	they can be added to the cache. The result is exactly the same as baking
+	all of the boxes without the cache.
+	
+	Returns tuple of (vertex bytes, index bytes, number of vertexes, number of indicies)
 	"""
 	
-	# Vertex and index data arrays
-	vertex = bytearray()
-	index = bytearray()
+	keys = seg.getFragmentKeys()
+	cached = [fragments.get(key) for key in keys]
+	dirty = [i for i in range(len(seg.boxes)) if cached[i] == None]
 	
-	vertex_count = 0
-	index_count = 0
+	# Bake the boxes that changed
+	faces = []
+	box_faces = []
+	box_culled = []
 	
-	i = 1
-	l = len(data)
+	with profileTimer("faces"):
+		for i in dirty:
+			culled = seg.culled_quads
+			box_faces.append(seg.boxes[i].bakeFaces())
+			box_culled.append(seg.culled_quads - culled)
+			faces += box_faces[-1]
 	
-	# Convert data to bytes
-	for d in data:
-		r = d.asData(vertex_count)
-		
-		if (progress):
-			progress.update(0.5 + 0.5 * (i / l))
-			i += 1
-		
-		vertex += r[0]
-		index += r[1]
-		vertex_count += r[2]
-		index_count += r[3]
+	if (progress):
+		progress.update(0.1)
 	
-	# Write out final data
-	outdata = bytearray()
-	outdata += struct.pack('I', vertex_count)
-	outdata += vertex
-	outdata += struct.pack('I', index_count)
-	outdata += index
+	vertex, index, vertex_count, index_count, face_quads = bakeFacesToBuffers(faces, seg, counts = True)
 	
-	if (extra_data):
-		outdata += extra_data.encode('utf-8')
+	if (progress):
+		progress.update(0.9)
 	
-	if (INCLUDE_VERSION_AND_INFO):
-		outdata += b"MB"
-		outdata += struct.pack('!H', VERSION[0])
-		outdata += struct.pack('!H', VERSION[1])
-		outdata += struct.pack('!H', VERSION[2])
-		outdata += struct.pack('!H', (0b1 if BAKE_UNSEEN_FACES else 0) | (0b10 if ABMIENT_OCCLUSION_ENABLED else 0) | (0b100 if LIGHTING_ENABLED else 0))
-		outdata += struct.pack('!H', TILE_ROWS)
-		outdata += struct.pack('!H', TILE_COLS)
-		outdata += struct.pack('!f', TILE_BITE_ROW)
-		outdata += struct.pack('!f', TILE_BITE_COL)
-		outdata += struct.pack('!f', ABMIENT_OCCLUSION_DELTA_BOX_SIZE)
+	# Split them up by box and remember them
+	quad_counts = []
+	face = 0
 	
-	outdata = zlib.compress(outdata, -1)
+	for i, this_faces in enumerate(box_faces):
+		quads = face_quads[face:face + len(this_faces)]
+		quad_counts.append(sum(quads))
+		box_culled[i] += sum(f.countQuads() - quads[j] for j, f in enumerate(this_faces) if f.occluders)
+		face += len(this_faces)
 	
-	return outdata
-
-## =============================================================================
-## =============================================================================
-## =============================================================================
+	# Culled quads were already counted for boxes that were just baked
+	seg.culled_quads += sum(fragment[4] for fragment in cached if fragment != None)
+	
+	for i, part, culled in zip(dirty, splitMeshBuffers(vertex, index, quad_counts), box_culled):
+		cached[i] = (*part, culled)
+		fragments.put(keys[i], cached[i])
+	
+	log(f"Reused {len(seg.boxes) - len(dirty)} of {len(seg.boxes)} boxes from earlier bakes")
+	
+	profile = gBakeThread.profile
+	
+	if (profile):
+		profile.count("reused_boxes", len(seg.boxes) - len(dirty))
+	
+	return joinMeshBuffers([fragment[:4] for fragment in cached])
 
-def bakeMeshFromBytesToBytes(data, templates_path = None, progress = None, extra_data = None):
+def bakeMeshFromBytesToBytes(data, templates_path = None, progress = None, extra_data = None, workers = 1, fragments = None, profile = None, settings = None):
 	"""
 	Bake a mesh from Smash Hit segment and return data
 	
 	data: Mesh data as a string
 	templates_path: Path to the templates file
+	workers: Number of processes to bake with
+	fragments: FragmentCache to reuse box geometry from and add it to
+	profile: BakeProfile to fill in with timers and counters
+	settings: Dict of settings (or BakeSettings) to use for only this bake,
+	anything not in it is the default from the module globals
 	"""
 	
-	seg = parseSegmentXML(data, parseTemplatesXml(templates_path) if templates_path else {})
+	settings = BakeSettings.get(settings)
+	gBakeThread.profile = profile
+	
+	try:
+		with profileTimer("total"):
+			vertex, index, vertex_count, index_count = bakeSegmentToBuffers(data, templates_path, progress, workers, fragments, settings)
+			return packMeshData(vertex_count, vertex, index_count, index, extra_data, settings)
+	finally:
+		gBakeThread.profile = None
+
+def bakeSegmentToBuffers(data, templates_path, progress, workers, fragments, settings):
+	"""
+	Does the actual baking for bakeMeshFromBytesToBytes and bakeMeshToFile
+	
+	Returns tuple of (vertex bytes, index bytes, number of vertexes, number of indicies)
+	"""
+	
+	with profileTimer("parse"):
+		templates = parseTemplatesXml(templates_path) if templates_path else {}
+		seg = parseSegmentXML(data, templates, settings)
+	
 	boxes = seg.boxes
 	
-	meshData = []
+	if (workers > 1 and not canUseWorkerProcesses()):
+		log("Worker processes can't import the baker here, baking in one process instead")
+		workers = 1
 	
-	i = 0
-	l = len(boxes)
+	profile = gBakeThread.profile
 	
-	for box in boxes:
-		if (progress):
-			progress.update(0.5 * (i / l))
-			i += 1
+	if (profile):
+		profile.count("boxes", len(boxes))
+	
+	# Fragments are per box, so they can't be used when faces of different boxes
+	# are merged
+	if (fragments != None and not settings.MERGE_COPLANAR_FACES):
+		vertex, index, vertex_count, index_count = bakeBoxesIncremental(seg, fragments, progress)
+	elif (workers > 1 and len(boxes) > 1):
+		vertex, index, vertex_count, index_count = bakeBoxesParallel(data, templates, seg, workers, progress)
+	else:
+		faces = []
+		
+		i = 0
+		l = len(boxes)
+		
+		with profileTimer("faces"):
+			for box in boxes:
+				if (progress):
+					progress.update(0.5 * (i / l))
+					i += 1
+				
+				faces += box.bakeFaces()
+			
+			if (settings.MERGE_COPLANAR_FACES):
+				faces = mergeCoplanarFaces(faces)
 		
-		meshData += box.bakeGeometry()
+		vertex, index, vertex_count, index_count = bakeFacesToBuffers(faces, seg, progress)
+	
+	if (progress):
+		progress.update(1.0)
+	
+	if (settings.CULL_HIDDEN_FACES):
+		log(f"Culled {seg.culled_quads} hidden quads")
 	
-	return generateMeshData(meshData, seg, progress, extra_data)
+	profile = gBakeThread.profile
+	
+	if (profile):
+		profile.count("culled_quads", seg.culled_quads)
+	
+	return (vertex, index, vertex_count, index_count)
 
-def bakeMeshToFile(data, output_file, template_file = None, progress = None, extra_data = None):
+def bakeMeshToFile(data, output_file, template_file = None, progress = None, extra_data = None, workers = 1, fragments = None, profile = None, settings = None):
 	"""
 	Given the segment data as a string, bake a mesh file, optionally using the
 	templates specififed.
+	
+	The mesh is compressed and written to the file as it goes instead of
+	being put together in memory first, see writeMeshData.
 	"""
 	
-	mesh_data = bakeMeshFromBytesToBytes(data, template_file, progress, extra_data)
+	settings = BakeSettings.get(settings)
+	gBakeThread.profile = profile
 	
-	f = open(output_file, "wb")
-	f.write(mesh_data)
-	f.close()
+	try:
+		with profileTimer("total"):
+			vertex, index, vertex_count, index_count = bakeSegmentToBuffers(data, template_file, progress, workers, fragments, settings)
+			
+			with open(output_file, "wb") as f:
+				writeMeshData(f, vertex_count, vertex, index_count, index, extra_data, settings)
+	finally:
+		gBakeThread.profile = None
 
-def bakeMesh(input_file, output_file, template_file = None, progress = None):
+def bakeMesh(input_file, output_file, template_file = None, progress = None, workers = 1, fragments = None, profile = None, settings = None):
 	"""
 	2024-01-18: Needed for mesh runner
 	
@@ -1089,25 +3146,203 @@ def bakeMesh(input_file, output_file, template_file = None, progress = None):
 		with open(input_file, "rb") as f:
 			input_data = f.read()
 	
-	bakeMeshToFile(input_data, output_file, template_file, progress)
+	bakeMeshToFile(input_data, output_file, template_file, progress, workers = workers, fragments = fragments, profile = profile, settings = settings)
 
-def main():
-	if (len(sys.argv) < 3):
-		print(f"""
-Usage:
-{sys.argv[0]} <input> <output> [<templates>]
+# Segment file endings and the mesh file endings that go with them, longest
+# first so that the right one is found
+SEGMENT_MESH_ENDINGS = [
+	(".xml.gz.mp3", ".mesh.mp3"),
+	(".xml.mp3", ".mesh.mp3"),
+	(".xml.gz", ".mesh"),
+	(".xml", ".mesh"),
+]
+
+def getMeshPath(segment_path):
+	"""
+	Get the path of the mesh for a segment file, or None if it isn't a segment
+	file
+	"""
+	
+	for segment_ending, mesh_ending in SEGMENT_MESH_ENDINGS:
+		if (segment_path.endswith(segment_ending)):
+			return segment_path[:-len(segment_ending)] + mesh_ending
+	
+	return None
+
+def findSegments(path):
+	"""
+	Find the segment files in an assets folder (in its segments folder) or
+	matching a glob pattern
+	"""
+	
+	if (os.path.isdir(path)):
+		segments = os.path.join(path, "segments") if os.path.isdir(os.path.join(path, "segments")) else path
+		paths = glob.glob(os.path.join(glob.escape(segments), "**", "*"), recursive = True)
+	else:
+		paths = glob.glob(path, recursive = True)
+	
+	return sorted(p for p in paths if os.path.isfile(p) and getMeshPath(p))
+
+def isMeshUpToDate(segment_path, mesh_path, template_file = None):
+	"""
+	Check if the mesh is newer than both the segment and the templates
+	"""
+	
+	if (not os.path.exists(mesh_path)):
+		return False
+	
+	mesh_time = os.path.getmtime(mesh_path)
+	
+	if (template_file and os.path.getmtime(template_file) > mesh_time):
+		return False
+	
+	return os.path.getmtime(segment_path) <= mesh_time
+
+def initBatchWorker(settings):
+	"""
+	Set up a worker process for batch baking
+	"""
+	
+	applySettings(settings)
+
+def bakeBatchWorker(job):
+	"""
+	Bake one segment for bakeBatch
+	
+	Returns tuple of (segment path, seconds taken, error message or None)
+	"""
+	
+	segment_path, mesh_path, template_file = job
+	start = time.perf_counter()
+	
+	try:
+		bakeMesh(segment_path, mesh_path, template_file)
+		error = None
+	except Exception as e:
+		error = "".join(traceback.format_exception_only(type(e), e)).strip()
+	
+	return (segment_path, time.perf_counter() - start, error)
+
+def bakeBatch(path, template_file = None, workers = 1, force = False):
+	"""
+	Bake every segment in an assets folder or matching a glob pattern, with
+	the segments split between worker processes. Meshes that are newer than
+	their segment and the templates are skipped unless force is True.
+	
+	Returns a list of (segment path, seconds taken, error message or None) for
+	the segments that were baked
+	"""
+	
+	# Use the templates in the assets folder if there are some
+	if (not template_file and os.path.isdir(path)):
+		for name in ["templates.xml.mp3", "templates.xml"]:
+			if (os.path.isfile(os.path.join(path, name))):
+				template_file = os.path.join(path, name)
+				break
+	
+	segments = findSegments(path)
+	jobs = [(p, getMeshPath(p), template_file) for p in segments if force or not isMeshUpToDate(p, getMeshPath(p), template_file)]
+	
+	log(f"Found {len(segments)} segments, {len(segments) - len(jobs)} already baked")
+	
+	results = []
+	
+	if (not jobs):
+		return results
+	
+	# Each worker bakes whole segments by itself, so there's no point in having
+	# more workers than segments
+	workers = max(min(workers, len(jobs)), 1)
+	
+	if (workers > 1 and not canUseWorkerProcesses()):
+		log("Worker processes can't import the baker here, baking in one process instead")
+		workers = 1
+	
+	if (workers == 1):
+		for job in jobs:
+			results.append(bakeBatchWorker(job))
+	else:
+		with multiprocessing.Pool(workers, initializer = initBatchWorker, initargs = (getSettings(),)) as pool:
+			for result in pool.imap_unordered(bakeBatchWorker, jobs):
+				results.append(result)
+	
+	return results
+
+def getBatchReport(results, seconds):
+	"""
+	Get a human readable summary of a batch bake
+	"""
+	
+	failed = [r for r in results if r[2]]
+	lines = [f"{'Segment':<60}{'Time':>12}"]
+	
+	for segment_path, taken, error in sorted(results, key = lambda r: r[1], reverse = True):
+		lines.append(f"{segment_path:<60}{taken * 1000:>10.1f}ms" + (" FAILED" if error else ""))
+	
+	for segment_path, taken, error in failed:
+		lines.append(f"{segment_path}: {error}")
+	
+	lines.append(f"Baked {len(results) - len(failed)} segments, {len(failed)} failed, in {seconds:.2f}s")
+	
+	return "\n".join(lines)
 
-Bakes a Smash Hit mesh from the file named <input> to the file named <output>,
+def main():
+	global COMPRESSION_LEVEL, COMPRESSION_STRATEGY, COMPRESSION_BEST
+	
+	parser = argparse.ArgumentParser(
+		description = """Bakes a Smash Hit mesh from the file named <input> to the file named <output>,
 using templates from <templates> if specified. It is automaticlly inferred if
 <input> is compressed by checking if it ends with the strings ".gz.mp3" or
 ".gz". If not it is assumed to be uncompressed.
-""")
-	else:
-		bakeMesh(
-			sys.argv[1],
-			sys.argv[2],
-			sys.argv[3] if len(sys.argv) >= 4 else None,
-		)
+
+With --batch, every segment in an assets folder (or matching a glob pattern) is
+baked instead, next to the segment, skipping meshes that are already newer
+than their segment:
+
+	bake_mesh.py --batch path/to/assets -j 4""",
+		formatter_class = argparse.RawDescriptionHelpFormatter,
+	)
+	parser.add_argument("input", nargs = "?", default = None, help = "segment file to bake")
+	parser.add_argument("output", nargs = "?", default = None, help = "where to write the mesh")
+	parser.add_argument("templates", nargs = "?", default = None, help = "templates file to use")
+	parser.add_argument("-j", "--workers", type = int, default = 1, help = "number of processes to bake with, in batch mode each one bakes whole segments")
+	parser.add_argument("-b", "--batch", metavar = "PATH", default = None, help = "bake every segment in this assets folder, or matching this glob pattern, instead of one file")
+	parser.add_argument("-t", "--templates-file", default = None, help = "templates file to use, the same as giving <templates>")
+	parser.add_argument("-f", "--force", action = "store_true", help = "in batch mode, bake segments even if their mesh is newer than them")
+	parser.add_argument("--profile", action = "store_true", help = "print how long each phase of baking took")
+	parser.add_argument("-l", "--compression-level", type = int, default = COMPRESSION_LEVEL, choices = range(-1, 10), metavar = "LEVEL", help = "zlib compression level from 0 to 9, or -1 for the default")
+	parser.add_argument("--compression-strategy", default = COMPRESSION_STRATEGY, choices = list(COMPRESSION_STRATEGIES.keys()), help = "zlib compression strategy")
+	parser.add_argument("--compression-best", action = "store_true", help = "try several compression levels and strategies and keep the smallest mesh")
+	
+	args = parser.parse_args()
+	
+	COMPRESSION_LEVEL = args.compression_level
+	COMPRESSION_STRATEGY = args.compression_strategy
+	COMPRESSION_BEST = args.compression_best
+	
+	templates = args.templates or args.templates_file
+	
+	if (args.batch):
+		start = time.perf_counter()
+		results = bakeBatch(args.batch, templates, args.workers, args.force)
+		print(getBatchReport(results, time.perf_counter() - start))
+		sys.exit(1 if any(r[2] for r in results) else 0)
+	
+	if (not args.input or not args.output):
+		parser.error("the input and output files are required when not in batch mode")
+	
+	profile = BakeProfile() if args.profile else None
+	
+	bakeMesh(
+		args.input,
+		args.output,
+		templates,
+		workers = args.workers,
+		profile = profile,
+	)
+	
+	if (profile):
+		print(profile.report())
 
 if (__name__ == "__main__"):
 	main()
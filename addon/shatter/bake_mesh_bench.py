@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the mesh baker
+
+This bakes a set of generated segments (and any real segments given on the
+command line) and times each phase of baking on its own: parsing, splitting
+boxes into quads, ambient occlusion, lighting, writing vertex and index data
+and compression. It also times a whole bake with the engine the baker would
+normally use.
+
+Results can be saved to a JSON file, and compared against an earlier results
+file to find phases that got slower:
+
+	python3 bake_mesh_bench.py -o baseline.json
+	(make some changes)
+	python3 bake_mesh_bench.py --compare baseline.json
+"""
+
+import bake_mesh
+import argparse
+import random
+import time
+import json
+import gzip
+import sys
+import os.path
+import platform
+
+# Generated segments to benchmark, see make_segment for what the options do
+CASES = {
+	"small": {"box_count": 50},
+	"large": {"box_count": 400},
+	"fine_tiles": {"box_count": 100, "tile_size": "0.25"},
+	"dense_overlap": {"box_count": 200, "overlap": 0.9},
+	"gradients": {"box_count": 100, "gradients": 1.0},
+	"lights": {"box_count": 100, "lights": 8},
+}
+
+# Phases that are timed for each segment
+PHASES = ["parse", "geometry", "ambient_occlusion", "lighting", "serialise", "compress", "bake"]
+
+def make_segment(box_count, tile_size = None, overlap = 0.0, gradients = 0.0, lights = 0, seed = 0):
+	"""
+	Make a segment with randomly placed boxes
+	
+	box_count: Number of boxes
+	tile_size: Tile size of every box, or None to pick randomly
+	overlap: From 0 to 1, how tightly packed together the boxes are
+	gradients: From 0 to 1, the fraction of boxes that have a gradient
+	lights: Number of boxes that glow
+	"""
+	
+	rng = random.Random(seed)
+	data = '<segment size="12 10 32">\n'
+	
+	# Length of the segment, boxes get closer together as overlap goes up
+	length = max(box_count * 0.5 * (1.0 - overlap), 4.0)
+	
+	for i in range(box_count):
+		pos = f"{rng.uniform(-6, 6)} {rng.uniform(-5, 5)} {rng.uniform(-length, 0)}"
+		size = f"{rng.uniform(0.25, 3)} {rng.uniform(0.25, 3)} {rng.uniform(0.25, 3)}"
+		tiles = tile_size if tile_size else rng.choice(["0.5", "1", "0.25 0.5 1"])
+		
+		data += f'<box pos="{pos}" size="{size}" tileSize="{tiles}"'
+		
+		if (rng.random() < gradients):
+			data += ' mb-gradient="0 1 0 0 -1 0 1 0.5 0.5 0.5 0.5 1"'
+		
+		if (i < lights):
+			data += f' glow="{rng.uniform(1, 10)}" color="{rng.random()} {rng.random()} {rng.random()}"'
+		
+		data += '/>\n'
+	
+	data += '</segment>'
+	
+	return data
+
+def load_segment(path):
+	"""
+	Load a real segment file, which might be gzipped
+	"""
+	
+	if (path.endswith(".gz.mp3") or path.endswith(".gz")):
+		with gzip.open(path, "rb") as f:
+			return f.read()
+	else:
+		with open(path, "rb") as f:
+			return f.read()
+
+def time_best(func, repeat):
+	"""
+	Run func repeat times and return the fastest time it took in seconds
+	"""
+	
+	best = None
+	
+	for _ in range(repeat):
+		start = time.perf_counter()
+		func()
+		elapsed = time.perf_counter() - start
+		best = elapsed if best == None else min(best, elapsed)
+	
+	return best
+
+def bench_segment(data, templates_path = None, repeat = 3):
+	"""
+	Time each phase of baking a segment
+	
+	Returns a dict with the number of boxes and quads and the time each phase
+	took in seconds
+	"""
+	
+	templates = bake_mesh.parseTemplatesXml(templates_path) if templates_path else {}
+	phases = {}
+	
+	# Timing the phases on their own is done with the pure Python functions,
+	# since the NumPy engine does them all at once
+	settings = {
+		"ABMIENT_OCCLUSION_ENABLED": False,
+		"LIGHTING_ENABLED": False,
+	}
+	
+	phases["parse"] = time_best(lambda: bake_mesh.parseSegmentXML(data, templates, settings), repeat)
+	
+	seg = bake_mesh.parseSegmentXML(data, templates, settings)
+	quads = []
+	
+	def geometry():
+		quads.clear()
+		
+		for box in seg.boxes:
+			quads.extend(box.bakeGeometry())
+	
+	phases["geometry"] = time_best(geometry, repeat)
+	
+	def ambient_occlusion():
+		for q in quads:
+			for p in (q.p1, q.p2, q.p3, q.p4):
+				bake_mesh.doAmbientOcclusion(p.x, p.y, p.z, q.color.a, seg, q.normal)
+	
+	phases["ambient_occlusion"] = time_best(ambient_occlusion, repeat)
+	
+	def lighting():
+		for q in quads:
+			for p in (q.p1, q.p2, q.p3, q.p4):
+				bake_mesh.doLighting(p.x, p.y, p.z, q.color.x, q.color.y, q.color.z, seg)
+	
+	phases["lighting"] = time_best(lighting, repeat)
+	
+	phases["serialise"] = time_best(lambda: bake_mesh.generateMeshBuffers(quads), repeat)
+	
+	vertex, index, vertex_count, index_count = bake_mesh.generateMeshBuffers(quads)
+	phases["compress"] = time_best(lambda: bake_mesh.packMeshData(vertex_count, vertex, index_count, index), repeat)
+	
+	# A whole bake the way the add-on would do it
+	settings = {
+		"ABMIENT_OCCLUSION_ENABLED": True,
+		"LIGHTING_ENABLED": any(box.glow != 0.0 for box in seg.boxes),
+	}
+	
+	phases["bake"] = time_best(lambda: bake_mesh.bakeMeshFromBytesToBytes(data, templates_path, settings = settings), repeat)
+	
+	return {
+		"boxes": len(seg.boxes),
+		"quads": len(quads),
+		"phases": phases,
+	}
+
+def run_benchmarks(cases, segments = [], templates_path = None, repeat = 3):
+	"""
+	Run the benchmarks for the generated cases and real segment files
+	
+	Returns a dict of results that can be saved as JSON
+	"""
+	
+	results = {}
+	
+	for name, options in cases.items():
+		bake_mesh.log(f"Benchmarking {name}")
+		results[name] = bench_segment(make_segment(**options), None, repeat)
+	
+	for path in segments:
+		bake_mesh.log(f"Benchmarking {path}")
+		results[os.path.basename(path)] = bench_segment(load_segment(path), templates_path, repeat)
+	
+	return {
+		"version": list(bake_mesh.VERSION),
+		"python": platform.python_version(),
+		"numpy": bool(bake_mesh.numpy and bake_mesh.NUMPY_ENGINE_ENABLED),
+		"repeat": repeat,
+		"cases": results,
+	}
+
+def print_results(results):
+	"""
+	Print the time each phase took for each case
+	"""
+	
+	print(f"{'case':<20}" + "".join(f"{phase:>18}" for phase in PHASES))
+	
+	for name, result in results["cases"].items():
+		print(f"{name:<20}" + "".join(f"{result['phases'][phase] * 1000:>16.1f}ms" for phase in PHASES))
+
+def compare_results(baseline, results, threshold):
+	"""
+	Compare results against a baseline and print how much each phase changed
+	
+	Returns a list of (case, phase, ratio) for phases that got slower by more
+	than the threshold
+	"""
+	
+	regressions = []
+	
+	print(f"{'case':<20}" + "".join(f"{phase:>18}" for phase in PHASES))
+	
+	for name, result in results["cases"].items():
+		if (name not in baseline["cases"]):
+			continue
+		
+		line = f"{name:<20}"
+		
+		for phase in PHASES:
+			old = baseline["cases"][name]["phases"].get(phase, None)
+			new = result["phases"][phase]
+			
+			if (not old):
+				line += f"{'-':>18}"
+				continue
+			
+			ratio = new / old
+			line += f"{(ratio - 1.0) * 100:>+16.1f}%" + ("!" if ratio > 1.0 + threshold else " ")
+			
+			if (ratio > 1.0 + threshold):
+				regressions.append((name, phase, ratio))
+		
+		print(line)
+	
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description = "Time how long each phase of baking a mesh takes")
+	parser.add_argument("segments", nargs = "*", help = "real segment files to benchmark as well as the generated ones")
+	parser.add_argument("-t", "--templates", default = None, help = "templates file for the real segments")
+	parser.add_argument("-r", "--repeat", type = int, default = 3, help = "number of runs to take the best time of")
+	parser.add_argument("-c", "--case", action = "append", choices = list(CASES.keys()), help = "only run this generated case, can be given more than once")
+	parser.add_argument("--no-generated", action = "store_true", help = "only benchmark the given segment files")
+	parser.add_argument("-o", "--output", default = None, help = "save the results to this JSON file")
+	parser.add_argument("--compare", default = None, help = "compare the results against this earlier JSON file")
+	parser.add_argument("--threshold", type = float, default = 0.1, help = "how much slower a phase can get before it counts as a regression (default 0.1 for 10%%)")
+	args = parser.parse_args()
+	
+	if (args.no_generated):
+		cases = {}
+	else:
+		cases = {name: CASES[name] for name in (args.case or CASES.keys())}
+	
+	results = run_benchmarks(cases, args.segments, args.templates, args.repeat)
+	
+	if (args.output):
+		with open(args.output, "w") as f:
+			json.dump(results, f, indent = "\t")
+	
+	if (args.compare):
+		with open(args.compare, "r") as f:
+			baseline = json.load(f)
+		
+		regressions = compare_results(baseline, results, args.threshold)
+		
+		for name, phase, ratio in regressions:
+			print(f"Regression: {phase} in {name} is {ratio:.2f}x slower")
+		
+		if (regressions):
+			sys.exit(1)
+	else:
+		print_results(results)
+
+if (__name__ == "__main__"):
+	main()
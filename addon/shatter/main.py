@@ -1022,6 +1022,38 @@ class ShatterPreferences(AddonPreferences):
 		default = "",
 	)
 	
+	mesh_command_jobs: IntProperty(
+		name = "Parallel bakes",
+		description = "How many external bake commands can run at the same time when exporting all segments",
+		default = 4,
+		min = 1,
+		max = 64,
+	)
+	
+	mesh_command_timeout: FloatProperty(
+		name = "Bake timeout",
+		description = "Stop an external bake command if it takes longer than this many seconds. Zero means there is no time limit",
+		default = 0.0,
+		min = 0.0,
+	)
+	
+	mesh_bake_profile: BoolProperty(
+		name = "Log bake profile",
+		description = "Log how long each phase of baking a mesh took and how much work it did. This makes baking a bit slower",
+		default = False,
+	)
+	
+	mesh_compression: EnumProperty(
+		name = "Mesh compression",
+		description = "How hard to try to make baked meshes smaller",
+		items = [
+			('fast', "Fast", "Compress meshes quickly, good for testing but the meshes are a bit bigger"),
+			('default', "Default", "Normal compression"),
+			('best', "Smallest", "Try a few different ways of compressing each mesh and keep the smallest one. This is a lot slower, so it is best for release builds"),
+		],
+		default = "default",
+	)
+	
 	def draw(self, context):
 		main = self.layout
 		
@@ -1071,6 +1103,11 @@ class ShatterPreferences(AddonPreferences):
 		
 		if (ui.prop("mesh_baker") == "command"):
 			ui.prop("mesh_command")
+			ui.prop("mesh_command_jobs")
+			ui.prop("mesh_command_timeout")
+		else:
+			ui.prop("mesh_compression")
+			ui.prop("mesh_bake_profile")
 		
 		ui.end()
 	
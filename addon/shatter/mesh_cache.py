@@ -0,0 +1,182 @@
+"""
+On-disk cache of baked meshes, so that exporting a segment that has not
+changed since it was last baked does not need to bake it again.
+
+Meshes are stored by a hash of everything that affects the bake result: the
+segment with its templates resolved, the segment's own template, the mesh baker
+settings and the mesh baker version.
+"""
+
+import util
+import common
+import os
+import os.path
+import shutil
+import tempfile
+import json
+import xml.etree.ElementTree as et
+
+# Where the cached meshes are kept
+CACHE_FOLDER = common.TOOLS_HOME_FOLDER + "/mesh_cache"
+
+# Total size of cached meshes after which the least recently used ones are
+# deleted, in bytes
+CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+class MeshCache:
+	"""
+	Size-bounded cache of baked mesh files
+	"""
+	
+	def __init__(self, folder, max_size):
+		self.folder = folder
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		
+		os.makedirs(self.folder, exist_ok = True)
+	
+	def get_key(self, segment_data, templates_path, settings, version):
+		"""
+		Get the cache key for a segment, or None if it can't be found (for
+		example, if the segment can't be parsed)
+		"""
+		
+		try:
+			if (type(segment_data) == bytes):
+				segment_data = segment_data.decode("utf-8")
+			
+			templates = util.load_templates(templates_path) if templates_path else {}
+			
+			# Templates on boxes are resolved in the segment, but the segment's
+			# own template isn't so it needs to be included separately
+			resolved = util.solve_templates(segment_data, templates)
+			segment_template = templates.get(et.fromstring(segment_data).attrib.get("template", None), {})
+		except Exception as e:
+			util.log(f"Mesh cache: can't compute key, not caching: {e}")
+			return None
+		
+		return util.sha256(json.dumps({
+			"segment": resolved,
+			"template": dict(segment_template),
+			"settings": settings,
+			"version": list(version),
+		}, sort_keys = True))
+	
+	def get_path(self, key):
+		return f"{self.folder}/{key}.mesh"
+	
+	def get(self, key, output_path):
+		"""
+		Copy the cached mesh for the key to the output path, if there is one.
+		Returns True on a cache hit.
+		"""
+		
+		path = self.get_path(key)
+		
+		# Another bake can evict the mesh at any time, so not being able to
+		# copy it is just a miss
+		try:
+			shutil.copyfile(path, output_path)
+			
+			# Mark as recently used
+			os.utime(path)
+		except OSError:
+			self.misses += 1
+			util.log(f"Mesh cache miss ({self.get_stats_string()})")
+			return False
+		
+		self.hits += 1
+		util.log(f"Mesh cache hit ({self.get_stats_string()})")
+		
+		return True
+	
+	def put(self, key, mesh_path):
+		"""
+		Add a baked mesh to the cache
+		"""
+		
+		path = self.get_path(key)
+		
+		# Each writer gets its own temporary file, since two bakes of the same
+		# segment can store the same key at once
+		with tempfile.NamedTemporaryFile(dir = self.folder, prefix = f"{key}.", suffix = ".tmp", delete = False) as f:
+			temp_path = f.name
+			
+			with open(mesh_path, "rb") as mesh:
+				shutil.copyfileobj(mesh, f)
+		
+		try:
+			os.replace(temp_path, path)
+		except OSError as e:
+			# Windows can't replace a file while another bake is copying it
+			# out, which just means the mesh was already cached
+			util.delete_path(temp_path)
+			util.log(f"Mesh cache: can't store mesh, not caching: {e}")
+			return
+		
+		self.evict()
+	
+	def evict(self):
+		"""
+		Delete the least recently used meshes until the cache fits in its max
+		size
+		"""
+		
+		entries = []
+		total = 0
+		
+		for name in os.listdir(self.folder):
+			if (not name.endswith(".mesh")):
+				continue
+			
+			path = f"{self.folder}/{name}"
+			
+			# Another bake might have just evicted it
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			
+			entries.append((stat.st_mtime, stat.st_size, path))
+			total += stat.st_size
+		
+		entries.sort()
+		
+		for mtime, size, path in entries:
+			if (total <= self.max_size):
+				break
+			
+			util.delete_path(path)
+			total -= size
+	
+	def get_stats(self):
+		"""
+		Get the hit and miss counts and the hit rate
+		"""
+		
+		total = self.hits + self.misses
+		
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"hit_rate": (self.hits / total) if total else 0.0,
+		}
+	
+	def get_stats_string(self):
+		stats = self.get_stats()
+		return f"{stats['hits']} hits, {stats['misses']} misses, {round(stats['hit_rate'] * 100)}% hit rate"
+
+gMeshCache = None
+
+def get_cache():
+	"""
+	Get the shared mesh cache
+	"""
+	
+	global gMeshCache
+	
+	if (not gMeshCache):
+		gMeshCache = MeshCache(CACHE_FOLDER, CACHE_MAX_SIZE)
+	
+	return gMeshCache
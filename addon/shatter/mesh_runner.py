@@ -7,15 +7,25 @@ is sync while running a server is async.
 """
 
 import util
+import mesh_cache
 import sys
 import os
+import gzip
 import shlex
+import subprocess
+import signal
+import time
+import concurrent.futures
 from pathlib import Path
 
 def bake(baker_type, inpath, templates = None, params = {}):
 	"""
 	Start a bake of a mesh with the specified baker and input xml path. This
 	will automatically determine the correct output file name.
+	
+	If the segment is already in memory, it can be given as the "data" param
+	(bytes or a string) and the built-in baker will use it instead of reading
+	the input file, which then doesn't need to be written yet.
 	"""
 	
 	global MESH_BAKE_CALLBACKS
@@ -38,37 +48,264 @@ def bake(baker_type, inpath, templates = None, params = {}):
 
 ################################################################################
 
+# The built-in baker module, loaded once and kept between bakes
+gBakeMesh = None
+gBakeMeshTime = None
+
+# Box geometry from earlier bakes with the built-in baker, kept between bakes
+# so that re-baking a segment after a small change only bakes what changed
+gFragmentCache = None
+
+# Profile of the last bake with the built-in baker, if it was profiled
+gLastProfile = None
+
+def get_last_profile():
+	"""
+	Get the timers and counters from the last profiled bake as a dict, or None
+	if there wasn't one
+	"""
+	
+	return gLastProfile
+
+def get_bake_mesh():
+	"""
+	Get the built-in baker module. It's only loaded again if bake_mesh.py has
+	changed since it was last loaded.
+	"""
+	
+	global gBakeMesh, gBakeMeshTime, gFragmentCache
+	
+	path = __file__[:-(len(__name__) + 3)] + "bake_mesh.py"
+	mtime = os.path.getmtime(path)
+	
+	if (gBakeMesh == None or mtime != gBakeMeshTime):
+		gBakeMesh = util.load_module(path)
+		gBakeMeshTime = mtime
+		
+		# Fragments from an older version of the baker might not be right
+		gFragmentCache = None
+	
+	return gBakeMesh
+
+def get_bake_settings(params):
+	"""
+	Get the built-in baker's settings for a bake from the bake params
+	"""
+	
+	return {
+		"BAKE_UNSEEN_FACES": params.get("BAKE_UNSEEN_FACES", False),
+		"ABMIENT_OCCLUSION_ENABLED": params.get("ABMIENT_OCCLUSION_ENABLED", True),
+		"LIGHTING_ENABLED": params.get("LIGHTING_ENABLED", False),
+		"LIGHTING_CUTOFF": params.get("LIGHTING_CUTOFF", 0.0),
+		"WELD_VERTICES": params.get("WELD_VERTICES", False),
+		"MERGE_COPLANAR_FACES": params.get("MERGE_COPLANAR_FACES", False),
+		"COMPRESSION_LEVEL": params.get("COMPRESSION_LEVEL", -1),
+		"COMPRESSION_STRATEGY": params.get("COMPRESSION_STRATEGY", "default"),
+		"COMPRESSION_BEST": params.get("COMPRESSION_BEST", False),
+	}
+
 def cb_bakemesh(fin, fout, templates, params):
-	# Dynamically load the module
-	bake_mesh = util.load_module(__file__[:-(len(__name__) + 3)] + "bake_mesh.py")
+	global gFragmentCache, gLastProfile
+	
+	bake_mesh = get_bake_mesh()
+	
+	# The settings only apply to this bake, so other bakes can run at the same
+	# time with their own
+	settings = bake_mesh.BakeSettings(get_bake_settings(params))
+	
+	# The segment, which is only read from the file if it wasn't given
+	segment = params.get("data", None)
+	
+	if (segment == None):
+		segment = read_segment(fin)
+	elif (type(segment) == str):
+		segment = segment.encode("utf-8")
+	
+	# Check if we already have this mesh baked
+	cache = mesh_cache.get_cache() if params.get("cache", True) else None
+	key = None
+	
+	if (cache):
+		key = cache.get_key(segment, templates, settings.asDict(), bake_mesh.VERSION)
+		
+		if (key and cache.get(key, fout)):
+			return 0
+	
+	# Reuse box geometry from earlier bakes, unless baking in parallel
+	workers = params.get("workers", 1)
+	fragments = None
 	
-	# Setup
-	bake_mesh.BAKE_UNSEEN_FACES = params.get("BAKE_UNSEEN_FACES", False)
-	bake_mesh.ABMIENT_OCCLUSION_ENABLED = params.get("ABMIENT_OCCLUSION_ENABLED", True)
-	bake_mesh.LIGHTING_ENABLED = params.get("LIGHTING_ENABLED", False)
+	if (params.get("incremental", True) and workers <= 1):
+		if (gFragmentCache == None):
+			gFragmentCache = bake_mesh.FragmentCache()
+		
+		fragments = gFragmentCache
+	
+	profile = bake_mesh.BakeProfile() if params.get("profile", False) else None
 	
 	# Actually bake the mesh
-	bake_mesh.bakeMesh(
-		fin,
+	bake_mesh.bakeMeshToFile(
+		segment,
 		fout,
 		templates,
+		workers = workers,
+		fragments = fragments,
+		profile = profile,
+		settings = settings,
 	)
 	
+	if (profile):
+		util.log(f"Mesh bake profile:\n{profile.report()}")
+		gLastProfile = profile.asDict()
+	
+	if (key):
+		cache.put(key, fout)
+	
 	return 0
 
-def cb_command(fin, fout, templates, params):
+def read_segment(path):
+	"""
+	Read a segment file, which might be gzipped
+	"""
+	
+	if (path.endswith(".gz.mp3") or path.endswith(".gz")):
+		with gzip.open(path, "rb") as f:
+			return f.read()
+	else:
+		with open(path, "rb") as f:
+			return f.read()
+
+def kill_command(process):
+	"""
+	Kill a command started by run_command and everything it started
+	"""
+	
+	if (os.name == "nt"):
+		subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], capture_output = True)
+		return
+	
+	try:
+		os.killpg(process.pid, signal.SIGKILL)
+	except ProcessLookupError:
+		pass
+
+def run_command(cmdline, timeout = None, fin = None, fout = None):
+	"""
+	Run an external bake command and wait for it to finish
+	
+	Returns a dict with the command, input and output paths, return code (None
+	if it timed out), what it printed to stdout and stderr and how long it took
+	"""
+	
+	util.log(f"Execute: {cmdline}")
+	
+	start = time.perf_counter()
+	
+	# The command gets its own process group, so that if it times out the
+	# baker the shell started can be killed along with the shell
+	process = subprocess.Popen(cmdline, shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE, text = True, errors = "replace", start_new_session = True)
+	
+	try:
+		stdout, stderr = process.communicate(timeout = timeout)
+		returncode, timed_out = process.returncode, False
+	except subprocess.TimeoutExpired:
+		kill_command(process)
+		stdout, stderr = process.communicate()
+		returncode, timed_out = None, True
+	
+	result = {
+		"command": cmdline,
+		"input": fin,
+		"output": fout,
+		"returncode": returncode,
+		"timed_out": timed_out,
+		"stdout": stdout or "",
+		"stderr": stderr or "",
+		"seconds": time.perf_counter() - start,
+	}
+	
+	if (timed_out):
+		util.log(f"External command timed out after {timeout}s: {cmdline}")
+	else:
+		util.log(f"External command result: {returncode}")
+	
+	if (result["stderr"]):
+		util.log(f"External command stderr:\n{result['stderr']}")
+	
+	return result
+
+class CommandJobRunner:
+	"""
+	Runs external bake commands in the background, with at most max_jobs of
+	them running at once. Pass one as the "jobs" param when baking with the
+	"command" baker to have the bakes queued here instead of waiting for each
+	one, then call wait to get the results.
+	"""
+	
+	def __init__(self, max_jobs = None, timeout = None):
+		self.max_jobs = max(max_jobs or os.cpu_count() or 1, 1)
+		self.timeout = timeout
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.max_jobs)
+		self.jobs = []
+	
+	def submit(self, cmdline, fin = None, fout = None):
+		"""
+		Queue a command to be run
+		"""
+		
+		self.jobs.append(self.executor.submit(run_command, cmdline, self.timeout, fin, fout))
+	
+	def wait(self):
+		"""
+		Wait for all of the queued commands to finish
+		
+		Returns a list of the results from run_command, in the order the
+		commands were queued
+		"""
+		
+		results = [job.result() for job in self.jobs]
+		self.jobs = []
+		
+		return results
+	
+	def close(self):
+		"""
+		Wait for the commands to finish and stop the background threads
+		"""
+		
+		self.executor.shutdown(wait = True)
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+def get_command_line(fin, fout, templates, params):
+	"""
+	Get the command line for an external bake command
+	"""
+	
 	cmdline = params["cmd"]
 	cmdline = cmdline.replace("$INPUT", shlex.quote(fin))
 	cmdline = cmdline.replace("$OUTPUT", shlex.quote(fout))
-	cmdline = cmdline.replace("$TEMPLATE", shlex.quote(templates))
+	cmdline = cmdline.replace("$TEMPLATE", shlex.quote(templates or ""))
 	
-	util.log(f"Execute: {cmdline}")
+	return cmdline
+
+def cb_command(fin, fout, templates, params):
+	cmdline = get_command_line(fin, fout, templates, params)
+	
+	# Queue the bake if there's a job runner, see CommandJobRunner
+	jobs = params.get("jobs", None)
 	
-	status = os.system(cmdline)
+	if (jobs):
+		jobs.submit(cmdline, fin, fout)
+		return 0
 	
-	util.log(f"External command result: {status}")
+	result = run_command(cmdline, params.get("timeout", None), fin, fout)
 	
-	return status
+	return result["returncode"] if not result["timed_out"] else -1
 
 MESH_BAKE_CALLBACKS = {
 	"bakemesh": cb_bakemesh,
@@ -7,7 +7,7 @@ Notes:
    excludes the port. We have to fix that.
 """
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from multiprocessing import Process
 import tempfile
 import xml.etree.ElementTree as et
@@ -23,6 +23,9 @@ CONTENT_LEVEL = """<level>
 
 TEMPDIR = tempfile.gettempdir() + "/shbt-testserver/"
 
+# Seconds an idle keep-alive connection is kept open for
+KEEP_ALIVE_TIMEOUT = 10
+
 def parsePath(url):
 	"""
 	Parse the path into parameters and the real URL
@@ -173,9 +176,42 @@ class AdServer(BaseHTTPRequestHandler):
 	The request handler for the test server
 	"""
 	
+	# Keep connections open between requests so that loading a room doesn't
+	# need a new connection for every file. This needs a Content-Length on
+	# every response.
+	protocol_version = "HTTP/1.1"
+	timeout = KEEP_ALIVE_TIMEOUT
+	
+	# Headers and body are written separately, so Nagle's algorithm would
+	# hold back the body until the client's delayed ACK
+	disable_nagle_algorithm = True
+	
 	def log_request(self, code = '-', size = '-'):
 		pass
 	
+	def handle_one_request(self):
+		# Cleared so log_error can tell if the connection timed out before any
+		# of the next request came in
+		self.raw_requestline = b""
+		
+		try:
+			super().handle_one_request()
+		except ConnectionResetError:
+			# Clients can also drop a connection they aren't using any more
+			# without closing it
+			if (self.raw_requestline):
+				raise
+			
+			self.close_connection = True
+	
+	def log_error(self, format, *args):
+		# Idle connections are closed by timing out while waiting for the next
+		# request, which isn't an error
+		if (not self.raw_requestline and format.startswith("Request timed out")):
+			return
+		
+		super().log_error(format, *args)
+	
 	def do_GET(self):
 		# Log the request
 		client_ip = self.client_address[0]
@@ -283,7 +319,9 @@ def runServer(no_blender = False):
 	Run the server
 	"""
 	
-	server = HTTPServer(("0.0.0.0", 8000), AdServer)
+	# Each connection gets its own thread, since kept alive connections would
+	# block each other otherwise
+	server = ThreadingHTTPServer(("0.0.0.0", 8000), AdServer)
 	
 	if (no_blender):
 		makeTestFiles()
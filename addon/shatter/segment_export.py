@@ -12,6 +12,7 @@ import os.path as ospath
 import pathlib
 import tempfile
 import json
+import concurrent.futures
 import pathlib
 import common
 import mesh_runner
@@ -595,17 +596,60 @@ def writeQuicktestInfo(tempdir, scene):
 def MB_progress_update_callback(value):
 	bpy.context.window_manager.progress_update(value)
 
-def bake_mesh(input_file, templates, params):
+def bake_mesh(input_file, templates, params, data = None):
+	"""
+	Bake the mesh for a segment file. data is the segment XML if it's already
+	in memory, which the built-in baker will use instead of reading the file.
+	"""
+	
+	compression = prefs().mesh_compression
+	
 	new_params = {
 		"BAKE_UNSEEN_FACES": params.get("bake_menu_segment", False),
 		"ABMIENT_OCCLUSION_ENABLED": params.get("bake_vertex_light", True),
 		"LIGHTING_ENABLED": params.get("lighting_enabled", False),
+		"COMPRESSION_LEVEL": 1 if compression == "fast" else -1,
+		"COMPRESSION_BEST": compression == "best",
 		
+		"profile": prefs().mesh_bake_profile,
 		"cmd": prefs().mesh_command,
+		"timeout": prefs().mesh_command_timeout or None,
+		"jobs": params.get("bake_jobs", None),
+		"data": data,
 	}
 	
 	mesh_runner.bake(prefs().mesh_baker, input_file, templates, new_params)
 
+def write_segment_file(filepath, data, compress = False):
+	with (gzip.open(filepath, "wb") if compress else open(filepath, "wb")) as f:
+		f.write(data)
+
+def write_segment_and_bake(filepath, content, templates, params, compress = False):
+	"""
+	Write the segment XML to a file and bake its mesh if needed. The built-in
+	baker bakes straight from the XML in memory while the file is being
+	written, instead of waiting for it and reading it back in.
+	"""
+	
+	data = content.encode()
+	bake = params.get("sh_box_bake_mode", "Mesh") == "Mesh"
+	
+	# External bakers need the file to be there first
+	if (not bake or prefs().mesh_baker == "command"):
+		write_segment_file(filepath, data, compress)
+		
+		if (bake):
+			bake_mesh(filepath, templates, params)
+		
+		return
+	
+	with concurrent.futures.ThreadPoolExecutor(max_workers = 1) as executor:
+		writing = executor.submit(write_segment_file, filepath, data, compress)
+		bake_mesh(filepath, templates, params, data)
+		
+		# Raises any error from writing the file
+		writing.result()
+
 def sh_export_segment_ext(filepath, context, scene, compress = False, params = {}):
 	"""
 	This function exports the blender scene to a Smash Hit compatible XML file.
@@ -671,13 +715,8 @@ def sh_export_segment_ext(filepath, context, scene, compress = False, params = {
 		if (ospath.exists(tempdir + "/segment.mesh")):
 			os.remove(tempdir + "/segment.mesh")
 		
-		# Write XML
-		with open(tempdir + "/segment.xml", "w") as f:
-			f.write(content)
-		
-		# Write mesh if needed
-		if (params.get("sh_box_bake_mode", "Mesh") == "Mesh"):
-			bake_mesh(tempdir + "/segment.xml", templates, params)
+		# Write XML and mesh if needed
+		write_segment_and_bake(tempdir + "/segment.xml", content, templates, params)
 		
 		context.window_manager.progress_end()
 		
@@ -699,13 +738,8 @@ def sh_export_segment_ext(filepath, context, scene, compress = False, params = {
 	if (prefs().resolve_templates and templates):
 		content = util.solve_templates(content, util.load_templates(templates))
 	
-	# Write out file
-	with (gzip.open(filepath, "wb") if compress else open(filepath, "wb")) as f:
-		f.write(content.encode())
-	
-	# Cook the mesh if we need to
-	if (params.get("sh_box_bake_mode", "Mesh") == "Mesh"):
-		bake_mesh(filepath, templates, params)
+	# Write out file and cook the mesh if we need to
+	write_segment_and_bake(filepath, content, templates, params, compress)
 	
 	# Display export warnings, if any and if enabled
 	params["warnings"].display()
@@ -716,20 +750,45 @@ def sh_export_segment_ext(filepath, context, scene, compress = False, params = {
 	context.window.cursor_set('DEFAULT')
 
 def sh_export_all_segments(context, compress = True):
-	for s in bpy.data.scenes:
-		util.log(f"Exporting a scene: {s} ...")
-		
-		sh_properties = s.sh_properties
-		
-		sh_export_segment_ext(None, context, s, compress, params = {
-				"sh_vrmultiply": sh_properties.sh_vrmultiply,
-				"sh_box_bake_mode": sh_properties.sh_box_bake_mode,
-				"sh_meshbake_template": tryTemplatesPath(),
-				"bake_menu_segment": sh_properties.sh_menu_segment,
-				"bake_vertex_light": sh_properties.sh_ambient_occlusion,
-				"lighting_enabled": sh_properties.sh_lighting,
-				"auto_find_filepath": True,
-			})
+	# External bake commands are run in the background while the other scenes
+	# are exported
+	jobs = None
+	
+	if (prefs().mesh_baker == "command"):
+		jobs = mesh_runner.CommandJobRunner(prefs().mesh_command_jobs, prefs().mesh_command_timeout or None)
+	
+	# The runner is closed even if exporting a scene fails, so bakes that were
+	# already queued aren't left running with nothing waiting for them
+	try:
+		for s in bpy.data.scenes:
+			util.log(f"Exporting a scene: {s} ...")
+			
+			sh_properties = s.sh_properties
+			
+			sh_export_segment_ext(None, context, s, compress, params = {
+					"sh_vrmultiply": sh_properties.sh_vrmultiply,
+					"sh_box_bake_mode": sh_properties.sh_box_bake_mode,
+					"sh_meshbake_template": tryTemplatesPath(),
+					"bake_menu_segment": sh_properties.sh_menu_segment,
+					"bake_vertex_light": sh_properties.sh_ambient_occlusion,
+					"lighting_enabled": sh_properties.sh_lighting,
+					"auto_find_filepath": True,
+					"bake_jobs": jobs,
+				})
+		
+		if (jobs):
+			results = jobs.wait()
+	finally:
+		if (jobs):
+			jobs.close()
+	
+	if (jobs):
+		failed = [r for r in results if r["timed_out"] or r["returncode"] != 0]
+		
+		util.log(f"Baked {len(results)} meshes with the external command, {len(failed)} failed")
+		
+		if (failed):
+			butil.show_message("Mesh bake error", f"{len(failed)} of {len(results)} meshes failed to bake with the external command. See the console for details.")
 
 def sh_export_segment(filepath, context, compress = False, testserver = False):
 	sh_properties = context.scene.sh_properties
@@ -0,0 +1,308 @@
+"""
+Tests for the asset server
+
+Run with python3 -m unittest discover tests
+"""
+
+import unittest
+import email.utils
+import gzip
+import http.client
+import importlib.util
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+
+ASSET_SERVER_PATH = os.path.join(os.path.dirname(__file__), "..", "addon", "shatter", "asset_server.py")
+
+def load_asset_server():
+	"""
+	Load asset_server.py. It raises an exception at the end when it's imported
+	instead of being run, since it isn't meant to be used as a library, but
+	everything in it is defined by then.
+	"""
+
+	spec = importlib.util.spec_from_file_location("asset_server", ASSET_SERVER_PATH)
+	module = importlib.util.module_from_spec(spec)
+
+	try:
+		spec.loader.exec_module(module)
+	except Exception as e:
+		if ("isn't a library" not in str(e)):
+			raise
+
+	return module
+
+asset_server = load_asset_server()
+
+class QuietRequestHandler(asset_server.AdRequestHandler):
+	timeout = 5
+
+	def log_message(self, format, *args):
+		pass
+
+# A segment that is big enough to be compressed, with an obstacle that is in a
+# folder inside the obstacles folder
+SEGMENT = '<segment size="12 10 16">' + '<box pos="0 0 -4" size="1 1 1" color="0.5 0.5 0.5" tile="3"/>' * 40 + '<obstacle type="boss/gate" pos="0 0 -8"/></segment>'
+
+class AssetServerTestCase(unittest.TestCase):
+	"""
+	Runs an asset server on an ephemeral port with its own assets folder
+	"""
+
+	max_workers = 4
+	max_connections = 64
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.folder)
+
+		self.write("levels/l.xml", '<level><room type="r"/></level>')
+		self.write("rooms/r.lua", 'function init() mgSegment("s", 0) end\n')
+		self.write("segments/s.xml", SEGMENT)
+		self.write("obstacles/boss/other.lua", "-- other\n")
+
+		asset_server.asset_reader = asset_server.AdServerAssetReader(self.folder, "l", True)
+
+		self.server = asset_server.BoundedHTTPServer(("127.0.0.1", 0), QuietRequestHandler, max_workers = self.max_workers, max_connections = self.max_connections)
+		self.port = self.server.server_address[1]
+
+		thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+		thread.start()
+
+		self.addCleanup(self.server.server_close)
+		self.addCleanup(self.server.shutdown)
+
+	def write(self, path, content):
+		"""
+		Write an asset, which are all stored with .mp3 on the end
+		"""
+
+		path = os.path.join(self.folder, path + ".mp3")
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+
+		with open(path, "w") as f:
+			f.write(content)
+
+		return path
+
+	def connect(self):
+		connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout = 5)
+		self.addCleanup(connection.close)
+		return connection
+
+	def get(self, path, headers = {}, connection = None):
+		"""
+		Get a path, returning the response and its body
+		"""
+
+		connection = connection or self.connect()
+		connection.request("GET", path, headers = headers)
+		response = connection.getresponse()
+
+		return response, response.read()
+
+	def get_timed(self, path):
+		"""
+		Get a path on a new connection, returning the response and how long it
+		took
+		"""
+
+		start = time.monotonic()
+		response, body = self.get(path)
+		return response, time.monotonic() - start
+
+class ResponseCacheTest(AssetServerTestCase):
+	def test_cached_response_is_reused(self):
+		cache = asset_server.asset_reader.cache
+
+		response, first = self.get("/segment?type=s&filetype=.xml")
+		self.assertEqual(response.status, 200)
+		self.assertEqual(cache.hits, 0)
+
+		response, second = self.get("/segment?type=s&filetype=.xml")
+		self.assertEqual(second, first)
+		self.assertEqual(cache.hits, 1)
+
+	def test_changed_file_is_read_again(self):
+		self.get("/room?type=r")
+		self.write("rooms/r.lua", 'function init() mgSegment("s", 1) end\n')
+
+		response, body = self.get("/room?type=r")
+		# mgSegment is replaced with a wrapper that points it at the server
+		self.assertIn(b'("s", 1)', body)
+
+	def test_etag_not_modified(self):
+		response, body = self.get("/segment?type=s&filetype=.xml")
+		etag = response.getheader("ETag")
+		self.assertTrue(etag)
+
+		response, body = self.get("/segment?type=s&filetype=.xml", {"If-None-Match": etag})
+		self.assertEqual(response.status, 304)
+		self.assertEqual(body, b"")
+		self.assertEqual(response.getheader("ETag"), etag)
+
+		# A different body has a different ETag
+		self.write("segments/s.xml", SEGMENT.replace("0.5 0.5 0.5", "0.25 0.5 0.5"))
+
+		response, body = self.get("/segment?type=s&filetype=.xml", {"If-None-Match": etag})
+		self.assertEqual(response.status, 200)
+		self.assertNotEqual(response.getheader("ETag"), etag)
+
+	def test_if_modified_since(self):
+		response, body = self.get("/room?type=r")
+		last_modified = response.getheader("Last-Modified")
+		self.assertTrue(last_modified)
+
+		response, body = self.get("/room?type=r", {"If-Modified-Since": last_modified})
+		self.assertEqual(response.status, 304)
+
+		earlier = email.utils.formatdate(email.utils.parsedate_to_datetime(last_modified).timestamp() - 60, usegmt = True)
+		response, body = self.get("/room?type=r", {"If-Modified-Since": earlier})
+		self.assertEqual(response.status, 200)
+		self.assertTrue(body)
+
+	def test_obstacle_in_folder(self):
+		path = "/segment?type=s&filetype=.xml&pv=3"
+
+		# There's no file for the obstacle yet, so the game's own one is used
+		response, body = self.get(path)
+		self.assertIn(b'type="obstacles/boss/gate"', body)
+
+		# Adding it doesn't change the obstacles folder itself, only the one
+		# inside of it
+		self.write("obstacles/boss/gate.lua", "-- gate\n")
+
+		response, body = self.get(path)
+		self.assertIn(b"/obstacle?type=boss%2Fgate", body)
+
+		response, body = self.get("/obstacle?type=boss/gate")
+		self.assertEqual(body, b"-- gate\n")
+
+		self.write("obstacles/boss/gate.lua", "-- gate, changed\n")
+
+		response, body = self.get("/obstacle?type=boss/gate")
+		self.assertEqual(body, b"-- gate, changed\n")
+
+class AcceptEncodingTest(AssetServerTestCase):
+	path = "/segment?type=s&filetype=.xml"
+
+	def test_preferred_encoding(self):
+		response, plain = self.get(self.path)
+		self.assertIsNone(response.getheader("Content-Encoding"))
+
+		response, body = self.get(self.path, {"Accept-Encoding": "gzip, deflate"})
+		self.assertEqual(response.getheader("Content-Encoding"), "gzip")
+		self.assertEqual(response.getheader("Vary"), "Accept-Encoding")
+		self.assertLess(len(body), len(plain))
+		self.assertEqual(gzip.decompress(body), plain)
+
+	def test_refused_encoding(self):
+		response, plain = self.get(self.path)
+
+		response, body = self.get(self.path, {"Accept-Encoding": "gzip;q=0, deflate"})
+		self.assertEqual(response.getheader("Content-Encoding"), "deflate")
+		self.assertEqual(zlib.decompress(body), plain)
+
+		response, body = self.get(self.path, {"Accept-Encoding": "gzip;q=0"})
+		self.assertIsNone(response.getheader("Content-Encoding"))
+		self.assertEqual(body, plain)
+
+	def test_identity(self):
+		response, plain = self.get(self.path)
+
+		response, body = self.get(self.path, {"Accept-Encoding": "identity"})
+		self.assertIsNone(response.getheader("Content-Encoding"))
+		self.assertEqual(body, plain)
+
+	def test_small_body_is_not_compressed(self):
+		response, body = self.get("/room?type=r", {"Accept-Encoding": "gzip, deflate"})
+		self.assertEqual(response.status, 200)
+		self.assertLess(len(body), asset_server.COMPRESS_MIN_SIZE)
+		self.assertIsNone(response.getheader("Content-Encoding"))
+		self.assertIsNone(response.getheader("Vary"))
+
+	def test_compressed_once(self):
+		"""
+		Requests for the same body at the same time share one compressed copy
+		"""
+
+		calls = []
+		encode_content = asset_server.encode_content
+
+		def counted_encode_content(content, encoding):
+			calls.append(encoding)
+			return encode_content(content, encoding)
+
+		asset_server.encode_content = counted_encode_content
+		self.addCleanup(setattr, asset_server, "encode_content", encode_content)
+
+		# Read it once first so only the compressing is left to race on
+		self.get(self.path)
+		cache = asset_server.asset_reader.cache
+		size = cache.size
+
+		request_count = 8
+		barrier = threading.Barrier(request_count)
+		bodies = []
+
+		def request():
+			connection = self.connect()
+			barrier.wait()
+			response, body = self.get(self.path, {"Accept-Encoding": "gzip"}, connection)
+			bodies.append(body)
+
+		threads = [threading.Thread(target = request) for i in range(request_count)]
+
+		for thread in threads:
+			thread.start()
+
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(calls, ["gzip"])
+		self.assertEqual(len(bodies), request_count)
+		self.assertEqual(len(set(bodies)), 1)
+		self.assertEqual(cache.size, size + len(bodies[0]))
+
+class IdleConnectionTest(AssetServerTestCase):
+	max_workers = 1
+
+	def test_idle_connection_does_not_block(self):
+		# Kept open after its request, waiting for another one
+		idle = self.connect()
+		response, body = self.get("/room?type=r", connection = idle)
+		self.assertEqual(response.status, 200)
+		self.assertIsNone(response.getheader("Connection"))
+
+		# Handled well before the idle connection times out
+		response, elapsed = self.get_timed("/room?type=r")
+		self.assertEqual(response.status, 200)
+		self.assertLess(elapsed, QuietRequestHandler.timeout / 2)
+
+class ConnectionLimitTest(AssetServerTestCase):
+	max_connections = 2
+
+	def test_full_server_closes_connections(self):
+		idle = self.connect()
+		response, body = self.get("/room?type=r", connection = idle)
+		self.assertIsNone(response.getheader("Connection"))
+
+		# The second connection fills the server, so it isn't kept open
+		response, body = self.get("/room?type=r")
+		self.assertEqual(response.getheader("Connection"), "close")
+
+		# A third client gets that connection's place instead of waiting for
+		# the idle one to time out
+		response, elapsed = self.get_timed("/room?type=r")
+		self.assertEqual(response.status, 200)
+		self.assertLess(elapsed, QuietRequestHandler.timeout / 2)
+
+		self.assertLessEqual(self.server.connections, self.max_connections)
+
+if (__name__ == "__main__"):
+	unittest.main()
@@ -0,0 +1,274 @@
+"""
+Tests for the mesh baker
+
+Run with python3 -m unittest discover tests
+"""
+
+import unittest
+import collections
+import contextlib
+import hashlib
+import io
+import os.path
+import random
+import struct
+import sys
+import threading
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "addon", "shatter"))
+
+with contextlib.redirect_stdout(io.StringIO()):
+	import bake_mesh
+
+def make_floor_segment(box_count):
+	"""
+	Make a segment of boxes that all look the same and are on the same floor,
+	with some of them overlapping, so that a lot of their faces can be merged
+	"""
+	
+	data = '<segment size="12 10 32">'
+	
+	for i in range(box_count):
+		x = (i % 8) - 4 + (0.5 if i % 3 == 0 else 0.0)
+		z = -(i // 4) - (0.5 if i % 5 == 0 else 0.0)
+		data += f'<box pos="{x} -1 {z}" size="1 0.5 1" color="0.5 0.7 0.9" tile="3"/>'
+	
+	return data + '</segment>'
+
+def make_random_segment(box_count, seed):
+	"""
+	Make a segment of boxes with random positions, sizes, colours, tiles,
+	gradients and lights, the same every time for the same seed
+	"""
+	
+	r = random.Random(seed)
+	fmt = lambda *v: " ".join(repr(round(x, 3)) for x in v)
+	
+	data = '<segment size="12 10 16" lightLeft="0.8" lightTop="1.1" ambient="0.9 0.95 1">'
+	
+	for i in range(box_count):
+		pos = (r.choice([r.uniform(-6, 6), float(r.randint(-6, 6))]), r.choice([r.uniform(-3, 5), 1.0, -0.5]), r.uniform(-box_count * 0.2, 0))
+		size = (r.choice([r.uniform(0.1, 3), 0.5, 1.0]), r.choice([r.uniform(0.1, 3), 0.5]), r.choice([r.uniform(0.1, 3), 1.0]))
+		box = f'<box pos="{fmt(*pos)}" size="{fmt(*size)}" color="{fmt(*[r.random() * 1.3 for _ in range(r.choice([3, 9]))])}" tile="{r.choice(["0", "5", "1 2 3"])}" tileSize="{r.choice(["1", "0.5", "1 0.5 0.75"])}" tileRot="{r.choice(["0", "1", "1 2 3"])}"'
+		
+		if (r.random() < 0.15):
+			box += f' mb-glow="{fmt(r.uniform(0.5, 50))}"'
+		
+		if (r.random() < 0.15):
+			box += ' mb-gradient="0 1 0 0 -1 0 1 0 0 0 0 1"'
+		
+		data += box + '/>'
+	
+	return data + '</segment>'
+
+def read_mesh(mesh):
+	"""
+	Decompress a mesh and split it into a list of quads, each one a tuple of
+	its four vertices as bytes
+	"""
+	
+	data = zlib.decompress(mesh)
+	vertex_count = struct.unpack_from('I', data, 0)[0]
+	vertex = data[4:4 + vertex_count * 24]
+	
+	return [tuple(vertex[(i + j) * 24:(i + j + 1) * 24] for j in range(4)) for i in range(0, vertex_count, 4)]
+
+def bake(data, settings, workers = 1):
+	"""
+	Bake a segment with the given settings, returning the mesh and the profile
+	"""
+	
+	profile = bake_mesh.BakeProfile()
+	
+	with contextlib.redirect_stdout(io.StringIO()):
+		mesh = bake_mesh.bakeMeshFromBytesToBytes(data, workers = workers, profile = profile, settings = settings)
+	
+	return mesh, profile
+
+class MergeCoplanarFacesTest(unittest.TestCase):
+	def test_parallel_bake_is_same_as_serial(self):
+		data = make_floor_segment(120)
+		
+		for numpy_engine in (True, False):
+			for cull in (False, True):
+				with self.subTest(numpy_engine = numpy_engine, cull = cull):
+					settings = {
+						"MERGE_COPLANAR_FACES": True,
+						"NUMPY_ENGINE_ENABLED": numpy_engine,
+						"CULL_HIDDEN_FACES": cull,
+					}
+					
+					serial, serial_profile = bake(data, settings)
+					parallel, parallel_profile = bake(data, settings, workers = 4)
+					
+					# Make sure this is actually testing merging
+					self.assertGreater(serial_profile.counters["merged_faces"], 0)
+					
+					self.assertEqual(serial, parallel)
+					self.assertEqual(serial_profile.counters["merged_faces"], parallel_profile.counters["merged_faces"])
+					self.assertEqual(serial_profile.counters["culled_quads"], parallel_profile.counters["culled_quads"])
+
+class BakeSettingsTest(unittest.TestCase):
+	def test_bakes_in_threads_use_their_own_settings(self):
+		data = make_floor_segment(40)
+		variants = [
+			{"LIGHTING_ENABLED": True, "CULL_HIDDEN_FACES": True},
+			{"ABMIENT_OCCLUSION_ENABLED": False, "BAKE_UNSEEN_FACES": True, "WELD_VERTICES": True},
+			{"NUMPY_ENGINE_ENABLED": False, "TILE_ROWS": 16, "COMPRESSION_LEVEL": 9},
+			{"MERGE_COPLANAR_FACES": True, "ABMIENT_OCCLUSION_DELTA_BOX_SIZE": 0.25},
+		]
+		defaults = bake_mesh.getSettings()
+		
+		serial = [bake(data, settings)[0] for settings in variants]
+		threaded = [None] * len(variants)
+		
+		def bake_variant(i):
+			threaded[i] = bake_mesh.bakeMeshFromBytesToBytes(data, settings = variants[i])
+		
+		threads = [threading.Thread(target = bake_variant, args = (i,)) for i in range(len(variants))]
+		
+		# Only redirected once, since redirecting in each thread isn't thread safe
+		with contextlib.redirect_stdout(io.StringIO()):
+			for thread in threads:
+				thread.start()
+			
+			for thread in threads:
+				thread.join()
+		
+		self.assertEqual(len(set(serial)), len(variants))
+		self.assertEqual(serial, threaded)
+		self.assertEqual(bake_mesh.getSettings(), defaults)
+
+class EngineTest(unittest.TestCase):
+	# Hash of the uncompressed mesh for make_random_segment(30, 1) from the
+	# baker before any of the faster ways of baking were added, with ambient
+	# occlusion and lighting on
+	ORIGINAL_MESH_SHA256 = "2df780d2bdc11b19200759301c1dcb166dc628d194cd0e781131a2a7daf272fa"
+	
+	def setUp(self):
+		self.data = make_random_segment(30, 1)
+		self.base = {
+			"ABMIENT_OCCLUSION_ENABLED": True,
+			"LIGHTING_ENABLED": True,
+			"LIGHTING_CUTOFF": 0.0,
+		}
+	
+	def bake_with(self, **settings):
+		return bake(self.data, {**self.base, **settings})[0]
+	
+	def test_python_engine_is_same_as_original(self):
+		mesh = self.bake_with(NUMPY_ENGINE_ENABLED = False, ABMIENT_OCCLUSION_USE_GRID = False, ABMIENT_OCCLUSION_PER_FACE = False)
+		
+		self.assertEqual(hashlib.sha256(zlib.decompress(mesh)).hexdigest(), self.ORIGINAL_MESH_SHA256)
+	
+	def test_faster_paths_are_same(self):
+		reference = self.bake_with(NUMPY_ENGINE_ENABLED = False, ABMIENT_OCCLUSION_USE_GRID = False, ABMIENT_OCCLUSION_PER_FACE = False)
+		engines = [False, True] if bake_mesh.numpy else [False]
+		
+		for numpy_engine in engines:
+			for grid in (False, True):
+				for per_face in (False, True):
+					with self.subTest(numpy_engine = numpy_engine, grid = grid, per_face = per_face):
+						mesh = self.bake_with(NUMPY_ENGINE_ENABLED = numpy_engine, ABMIENT_OCCLUSION_USE_GRID = grid, ABMIENT_OCCLUSION_PER_FACE = per_face)
+						self.assertEqual(mesh, reference)
+
+class IncrementalBakeTest(unittest.TestCase):
+	def test_changed_box_is_same_as_full_bake(self):
+		data = make_random_segment(30, 2)
+		settings = {"ABMIENT_OCCLUSION_ENABLED": True, "LIGHTING_ENABLED": True}
+		fragments = bake_mesh.FragmentCache()
+		
+		with contextlib.redirect_stdout(io.StringIO()):
+			first = bake_mesh.bakeMeshFromBytesToBytes(data, fragments = fragments, settings = settings)
+		
+		self.assertEqual(first, bake(data, settings)[0])
+		
+		# Move one box, which changes it and the boxes near it
+		start = data.index('pos="', data.index('<box', len(data) // 2)) + 5
+		end = data.index('"', start)
+		changed = data[:start] + "0.25 0.75 -2.5" + data[end:]
+		
+		profile = bake_mesh.BakeProfile()
+		
+		with contextlib.redirect_stdout(io.StringIO()):
+			incremental = bake_mesh.bakeMeshFromBytesToBytes(changed, fragments = fragments, profile = profile, settings = settings)
+		
+		self.assertGreater(profile.counters["reused_boxes"], 0)
+		self.assertNotEqual(incremental, first)
+		self.assertEqual(incremental, bake(changed, settings)[0])
+
+class CullHiddenFacesTest(unittest.TestCase):
+	def test_touching_faces_are_culled(self):
+		# The right side of the first box and the left side of the second one
+		# are exactly on top of each other
+		data = '<segment size="12 10 8"><box pos="-1 0 -4" size="1 1 1" tile="2"/><box pos="1 0 -4" size="1 1 1" tile="2"/></segment>'
+		settings = {"BAKE_UNSEEN_FACES": True, "ABMIENT_OCCLUSION_ENABLED": False}
+		
+		full, _ = bake(data, {**settings, "CULL_HIDDEN_FACES": False})
+		culled, profile = bake(data, {**settings, "CULL_HIDDEN_FACES": True})
+		
+		full_quads = collections.Counter(read_mesh(full))
+		culled_quads = collections.Counter(read_mesh(culled))
+		hidden = full_quads - culled_quads
+		
+		# Only the two faces between the boxes (four tiles each) are gone,
+		# everything else is baked exactly the same
+		self.assertEqual(culled_quads - full_quads, collections.Counter())
+		self.assertEqual(sum(hidden.values()), 2 * 4)
+		self.assertEqual(profile.counters["culled_quads"], 2 * 4)
+		
+		for quad in hidden:
+			for vertex in quad:
+				self.assertEqual(struct.unpack_from('f', vertex, 0)[0], 0.0)
+
+class CompressionTest(unittest.TestCase):
+	def setUp(self):
+		with contextlib.redirect_stdout(io.StringIO()):
+			seg = bake_mesh.parseSegmentXML(make_random_segment(20, 3))
+		
+		faces = []
+		
+		for box in seg.boxes:
+			faces += box.bakeFaces()
+		
+		self.vertex, self.index, self.vertex_count, self.index_count = bake_mesh.bakeFacesToBuffers(faces, seg)
+		self.expected = struct.pack('I', self.vertex_count) + bytes(self.vertex) + struct.pack('I', self.index_count) + bytes(self.index)
+	
+	def write(self, settings):
+		f = io.BytesIO()
+		bake_mesh.writeMeshData(f, self.vertex_count, self.vertex, self.index_count, self.index, settings = settings)
+		return f.getvalue()
+	
+	def test_streamed_mesh_is_same_as_packed(self):
+		settings = bake_mesh.BakeSettings()
+		packed = bake_mesh.packMeshData(self.vertex_count, self.vertex, self.index_count, self.index, settings = settings)
+		
+		# Small chunks so the mesh is compressed in a lot of pieces
+		chunk_size = bake_mesh.MESH_WRITE_CHUNK_SIZE
+		bake_mesh.MESH_WRITE_CHUNK_SIZE = 1000
+		
+		try:
+			streamed = self.write(settings)
+		finally:
+			bake_mesh.MESH_WRITE_CHUNK_SIZE = chunk_size
+		
+		self.assertEqual(zlib.decompress(packed), self.expected)
+		self.assertEqual(zlib.decompress(streamed), self.expected)
+	
+	def test_compression_settings(self):
+		for level in range(-1, 10):
+			for strategy in bake_mesh.COMPRESSION_STRATEGIES:
+				with self.subTest(level = level, strategy = strategy):
+					mesh = self.write({"COMPRESSION_LEVEL": level, "COMPRESSION_STRATEGY": strategy})
+					self.assertEqual(zlib.decompress(mesh), self.expected)
+		
+		candidates = bake_mesh.COMPRESSION_BEST_CANDIDATES
+		best = self.write({"COMPRESSION_BEST": True})
+		sizes = [len(self.write({"COMPRESSION_LEVEL": level, "COMPRESSION_STRATEGY": strategy})) for level, strategy in candidates]
+		
+		self.assertEqual(zlib.decompress(best), self.expected)
+		self.assertEqual(len(best), min(sizes))
+
+if (__name__ == "__main__"):
+	unittest.main()